@@ -0,0 +1,645 @@
+"""
+Микробенчмарки для bot.py.
+Ничего не ходит в Telegram: работаем с in-memory состоянием и временной папкой.
+
+Запуск:
+    python bench.py              — все бенчмарки
+    python bench.py users_click  — только выбранные
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import tempfile
+import contextlib
+from types import SimpleNamespace
+from typing import Optional
+
+import httpx
+import tornado.web
+from telegram import InputMediaPhoto, InputMediaVideo
+from telegram.ext import ExtBot
+
+import bot
+
+
+@contextlib.contextmanager
+def _tmp_workdir():
+    # bot.py пишет файлы по относительным путям — гоняем всё во временной папке
+    old_cwd = os.getcwd()
+    tmp = tempfile.mkdtemp(prefix="bench_")
+    os.chdir(tmp)
+    try:
+        yield tmp
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _timeit(fn, repeat: int) -> float:
+    """Среднее время одного вызова, мкс."""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat * 1_000_000
+
+
+def _fill_users(n_users: int, titles_per_user: int = 10) -> None:
+    rnd = random.Random(42)
+    slugs = [f"title{i}" for i in range(200)]
+    bot.USER_PROGRESS = {}
+    bot.USER_FAVORITES = {}
+    bot.USER_WATCHED_TITLES = {}
+    bot.CURRENT_TRACK = {}
+    for uid in range(n_users):
+        picked = rnd.sample(slugs, titles_per_user)
+        bot.USER_PROGRESS[uid] = {s: rnd.randint(1, 24) for s in picked}
+        bot.USER_FAVORITES[uid] = set(picked[:3])
+        bot.USER_WATCHED_TITLES[uid] = set(picked[3:6])
+        bot.CURRENT_TRACK[uid] = {s: "aniliberty" for s in picked}
+
+
+# ===============================
+# users: стоимость одного клика
+# ===============================
+def bench_users_click() -> None:
+    """
+    Старый путь: полный save_users() на каждый клик.
+    Новый: одна строка в users.journal (снапшот — только при компакции).
+    """
+    print("users_click: стоимость одного изменения пользователя")
+    with _tmp_workdir():
+        for n_users in (100, 1_000, 10_000):
+            _fill_users(n_users)
+            repeat = max(5, 20_000 // n_users)
+
+            bot.USERS_JOURNAL_ENABLED = False
+            bot.USERS_FSYNC = "never"
+            full_us = _timeit(bot.save_users, repeat)
+
+            bot.USERS_JOURNAL_ENABLED = True
+            clicks = iter(range(10**9))
+            journal_us = _timeit(
+                lambda: bot._journal_append("progress", 1, "title1", next(clicks)),
+                repeat * 50,
+            )
+            bot.close_users_journal()
+
+            print(
+                f"  {n_users:>6} users: save_users {full_us:>10.1f} µs/click, "
+                f"journal {journal_us:>6.1f} µs/click  (x{full_us / journal_us:.0f})"
+            )
+
+
+def _fake_catalog_json(n_titles: int, episodes: int = 12) -> dict:
+    """Каталог в формате anime.json (как его видит load_anime)."""
+    rnd = random.Random(7)
+    genres = ["драма", "экшен", "комедия", "фэнтези", "романтика", "детектив", "приключения"]
+    data = {}
+    for i in range(n_titles):
+        data[f"title{i}"] = {
+            "title": f"Тайтл номер {i}",
+            "genres": rnd.sample(genres, 3),
+            "status": rnd.choice(["ongoing", "finish"]),
+            "episodes": {
+                str(ep): {"tracks": {"aniliberty": {"source": f"FILE{i}_{ep}", "skip": "1:30"}}}
+                for ep in range(1, episodes + 1)
+            },
+        }
+    return data
+
+
+# ===============================
+# catalog: старт с anime.json и со снапшота
+# ===============================
+def bench_catalog_load() -> None:
+    print("catalog_load: загрузка каталога при старте")
+    with _tmp_workdir():
+        for n_titles in (100, 1_000, 10_000):
+            with open(bot.ANIME_JSON_PATH, "w", encoding="utf-8") as f:
+                json.dump(_fake_catalog_json(n_titles), f, ensure_ascii=False, indent=2)
+            if os.path.exists(bot.ANIME_SNAPSHOT_PATH):
+                os.remove(bot.ANIME_SNAPSHOT_PATH)
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                bot.load_anime()  # полный разбор + запись снапшота
+                json_ms = bot.CATALOG_LOAD_STATS["ms"]
+                bot.load_anime()  # быстрый путь
+                snap_ms = bot.CATALOG_LOAD_STATS["ms"]
+
+            print(
+                f"  {n_titles:>6} titles: anime.json {json_ms:>8.1f} ms, "
+                f"snapshot {snap_ms:>8.1f} ms  (x{json_ms / snap_ms:.1f})"
+            )
+
+
+# ===============================
+# search: линейный проход по каталогу против триграммного индекса
+# ===============================
+_CONSONANTS = "бвгджзклмнпрстфхцчшщ"
+_VOWELS = "аеиоуыэюя"
+
+
+def _fake_word(rnd: random.Random) -> str:
+    return "".join(rnd.choice(_CONSONANTS) + rnd.choice(_VOWELS) for _ in range(rnd.randint(2, 4)))
+
+
+def _fake_titles(n_titles: int) -> dict:
+    rnd = random.Random(11)
+    words = [_fake_word(rnd) for _ in range(20_000)]
+    return {
+        f"title{i}": {"title": " ".join(rnd.sample(words, rnd.randint(2, 4))).capitalize(), "genres": []}
+        for i in range(n_titles)
+    }
+
+
+def _typo(word: str, rnd: random.Random) -> str:
+    i = rnd.randrange(len(word))
+    return word[:i] + rnd.choice("абвгдежз") + word[i + 1:]
+
+
+def bench_search() -> None:
+    print("search: поиск по названию (мкс на запрос)")
+    rnd = random.Random(5)
+    for n_titles in (1_000, 10_000, 100_000):
+        bot.ANIME = _fake_titles(n_titles)
+        bot.rebuild_catalog_indexes()
+        titles = [a["title"] for a in bot.ANIME.values()]
+        queries = [rnd.choice(rnd.choice(titles).split()) for _ in range(50)]
+        typos = [_typo(q, rnd) for q in queries]
+
+        def scan():
+            for q in queries:
+                q = q.lower()
+                [slug for slug, anime in bot.ANIME.items() if q in anime["title"].lower()]
+
+        def index():
+            for q in queries:
+                bot.search_titles(q)
+
+        def index_typos():
+            for q in typos:
+                bot.search_titles(q)
+
+        scan_us = _timeit(scan, 3) / len(queries)
+        index_us = _timeit(index, 3) / len(queries)
+        typo_us = _timeit(index_typos, 3) / len(queries)
+        found = sum(1 for q, t in zip(queries, typos) if bot.search_titles(t))
+        print(
+            f"  {n_titles:>7} titles: scan {scan_us:>9.1f}, index {index_us:>8.1f} "
+            f"(x{scan_us / index_us:.1f}), typo {typo_us:>8.1f}; "
+            f"typo queries with results: {found}/{len(typos)}"
+        )
+
+
+def bench_inline() -> None:
+    print("inline: поиск по префиксу на каждое нажатие (мкс на запрос, без кэша)")
+    rnd = random.Random(6)
+    for n_titles in (1_000, 10_000, 100_000):
+        bot.ANIME = _fake_titles(n_titles)
+        started = time.perf_counter()
+        bot.rebuild_catalog_indexes()
+        build_ms = (time.perf_counter() - started) * 1000
+        titles = [bot._normalize_search_text(a["title"]) for a in bot.ANIME.values()]
+        words = [rnd.choice(rnd.choice(titles).split()) for _ in range(50)]
+        line = f"  {n_titles:>7} titles (индексы {build_ms:>7.0f} ms):"
+        for length in (1, 2, 3, 5, 10):
+            prefixes = [w[:length] for w in words]
+            us = _timeit(lambda: [bot.prefix_search(p) for p in prefixes], 3) / len(prefixes)
+            line += f"  {length}ch {us:>7.1f}"
+        print(line)
+
+
+# ===============================
+# fake Bot API: локальная заглушка вместо api.telegram.org
+# ===============================
+class _FakeBotApiHandler(tornado.web.RequestHandler):
+    def initialize(self, api: "FakeBotApi") -> None:
+        self.api = api
+
+    def post(self, token: str, method: str) -> None:
+        arrived = time.perf_counter()
+        # файлы из multipart не нужны — берём только обычные поля
+        params = {key: self.get_body_argument(key) for key in self.request.body_arguments}
+        self.api.record(arrived, method, params)
+        self.write({"ok": True, "result": self.api.result(method, params)})
+
+
+class FakeBotApi:
+    """
+    Сервер Bot API в том же event loop, что и бот (tornado — он уже есть для webhook'ов):
+    отвечает правдоподобными результатами и записывает каждый вызов.
+    """
+
+    def __init__(self):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}/bot"
+        self.calls: list[tuple[float, str, dict]] = []
+        self._first: dict[tuple[str, str], float] = {}
+        self._message_id = 0
+        self._server = None
+
+    async def __aenter__(self) -> "FakeBotApi":
+        app = tornado.web.Application([(r"/bot([^/]+)/(\w+)", _FakeBotApiHandler, {"api": self})])
+        self._server = app.listen(self.port, address="127.0.0.1")
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._server.stop()
+
+    def record(self, arrived: float, method: str, params: dict) -> None:
+        self.calls.append((arrived, method, params))
+        self._first.setdefault((method, params.get("chat_id", "")), arrived)
+
+    def result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if not (method.startswith("send") or method.startswith("editMessage")):
+            return True
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+        }
+        if method in ("sendPhoto", "editMessageMedia"):
+            message["photo"] = [
+                {"file_id": f"photo{self._message_id}", "file_unique_id": "u", "width": 1, "height": 1}
+            ]
+        return message
+
+    def arrival(self, method: str, chat_id: int) -> Optional[float]:
+        return self._first.get((method, str(chat_id)))
+
+    def count(self) -> dict[str, int]:
+        counts: dict[str, int] = {}
+        for _, method, _ in self.calls:
+            counts[method] = counts.get(method, 0) + 1
+        return counts
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+# ===============================
+# webhook: апдейт по HTTP -> хэндлер -> вызов Bot API, без Telegram
+# ===============================
+def _text_update(update_id: int, chat_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "text": "привет",
+        },
+    }
+
+
+def _callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "chat_instance": "bench",
+            "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}},
+        },
+    }
+
+
+async def _wait_arrival(api: FakeBotApi, method: str, chat_id: int, timeout: float = 10.0) -> float:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        arrived = api.arrival(method, chat_id)
+        if arrived is not None:
+            return arrived
+        await asyncio.sleep(0.0005)
+    raise TimeoutError(f"{method} for chat {chat_id} never arrived")
+
+
+async def _webhook_harness(n_updates: int) -> None:
+    with _tmp_workdir():
+        async with FakeBotApi() as api:
+            await _webhook_scenarios(api, n_updates)
+
+
+async def _webhook_scenarios(api: FakeBotApi, n_updates: int) -> None:
+    with open(bot.ANIME_JSON_PATH, "w", encoding="utf-8") as f:
+        json.dump(_fake_catalog_json(200), f, ensure_ascii=False)
+
+    bot.BOT_TOKEN = "123456:bench"
+    bot.BOT_API_URL = api.url
+    bot.WEBHOOK_URL = "https://bench.invalid"
+    bot.WEBHOOK_LISTEN = "127.0.0.1"
+    bot.WEBHOOK_PORT = _free_port()
+    bot.WEBHOOK_SECRET = "bench-secret"
+    # меряем обработку, а не лимиты исходящих запросов
+    bot.OUTBOUND_GLOBAL_RATE = bot.OUTBOUND_GLOBAL_BURST = 1e9
+    bot.OUTBOUND = bot.OutboundScheduler()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot.load_state()
+    app = bot.build_application()
+    settings = bot.webhook_settings()
+    url = f"http://127.0.0.1:{settings['port']}/{settings['url_path']}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": settings["secret_token"]}
+
+    async with app:
+        await app.updater.start_webhook(**settings)
+        await app.start()
+        await bot.on_startup(app)
+        try:
+            async with httpx.AsyncClient() as client:
+                # без секрета апдейт не принимается
+                rejected = await client.post(url, json=_text_update(1, 1))
+                print(f"  без секрета: HTTP {rejected.status_code}")
+
+                # по одному апдейту: POST -> первый вызов Bot API из хэндлера
+                scenarios = [
+                    ("текст (deleteMessage)", "deleteMessage",
+                     lambda i, chat: _text_update(i, chat)),
+                    ("кнопка «Каталог» (editMessageCaption)", "editMessageCaption",
+                     lambda i, chat: _callback_update(i, chat, "catalog")),
+                ]
+                update_id = 10
+                for s_index, (label, method, make_update) in enumerate(scenarios):
+                    latencies = []
+                    for i in range(n_updates):
+                        update_id += 1
+                        chat_id = 1_000_000 * (s_index + 1) + i
+                        bot.session(chat_id).message_id = 1
+                        posted = time.perf_counter()
+                        await client.post(url, json=make_update(update_id, chat_id), headers=headers)
+                        arrived = await _wait_arrival(api, method, chat_id)
+                        latencies.append((arrived - posted) * 1000)
+                    print(
+                        f"  {label:<42} p50 {_percentile(latencies, 0.5):6.2f} ms, "
+                        f"p95 {_percentile(latencies, 0.95):6.2f} ms"
+                    )
+
+                # пачка апдейтов от разных чатов разом
+                chats = [9_000_000 + i for i in range(n_updates)]
+                started = time.perf_counter()
+                await asyncio.gather(*(
+                    client.post(url, json=_text_update(update_id + 1 + i, chat), headers=headers)
+                    for i, chat in enumerate(chats)
+                ))
+                for chat in chats:
+                    await _wait_arrival(api, "deleteMessage", chat)
+                elapsed = time.perf_counter() - started
+                print(f"  {n_updates} апдейтов разом: {elapsed * 1000:.0f} ms ({n_updates / elapsed:.0f} апдейтов/с)")
+        finally:
+            await app.updater.stop()
+            await app.stop()
+            with contextlib.redirect_stdout(io.StringIO()):
+                await bot.on_shutdown(app)
+
+
+def bench_webhook() -> None:
+    print("webhook: локальный webhook-сервер + заглушка Bot API")
+    asyncio.run(_webhook_harness(200))
+
+
+# ===============================
+# screens: сколько вызовов Bot API стоит смена экрана
+# ===============================
+async def _legacy_screen(ext: ExtBot, chat_id: int, msg_id: int, kind: str, media, caption: str, markup) -> None:
+    """Смена экрана, как было раньше: медиа и клавиатура — двумя отдельными запросами."""
+    if kind == "caption":
+        await ext.edit_message_caption(chat_id=chat_id, message_id=msg_id, caption=caption, reply_markup=markup)
+        return
+    if kind == "video":
+        input_media = InputMediaVideo(media=media, caption=caption)
+    else:
+        input_media = InputMediaPhoto(media=media, caption=caption)
+    await ext.edit_message_media(media=input_media, chat_id=chat_id, message_id=msg_id)
+    await ext.edit_message_reply_markup(chat_id=chat_id, message_id=msg_id, reply_markup=markup)
+
+
+async def _screens_harness(n_screens: int) -> None:
+    with _tmp_workdir():
+        async with FakeBotApi() as api:
+            await _screens_scenarios(api, n_screens)
+
+
+async def _screens_scenarios(api: FakeBotApi, n_screens: int) -> None:
+    with open(bot.ANIME_JSON_PATH, "w", encoding="utf-8") as f:
+        json.dump(_fake_catalog_json(20), f, ensure_ascii=False)
+    os.makedirs(os.path.dirname(bot.WELCOME_PHOTO), exist_ok=True)
+    with open(bot.WELCOME_PHOTO, "wb") as f:
+        f.write(os.urandom(32 * 1024))
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot.load_state()
+
+    ext = ExtBot("123456:bench", base_url=api.url)
+    await ext.initialize()
+    context = SimpleNamespace(bot=ext)
+
+    def menu(chat_id, i):
+        return bot.show_main_menu(chat_id, context)
+
+    def episode(chat_id, i):
+        return bot.show_episode(chat_id, context, "title0", i % 12 + 1)
+
+    def genres(chat_id, i):
+        return bot.show_genres(chat_id, context)
+
+    # (название, экраны по очереди: (новый путь, как выглядел бы тот же экран раньше))
+    scenarios = [
+        ("серии подряд (видео -> видео)", [(episode, "video")]),
+        ("меню <-> серия (фото <-> видео)", [(menu, "photo"), (episode, "video")]),
+        ("меню <-> каталог (фото, подпись)", [(menu, "photo"), (genres, "caption")]),
+    ]
+    try:
+        for s_index, (label, steps) in enumerate(scenarios):
+            chat_id = 100 + s_index
+            # исходный экран: одно сообщение с фото, как после /start
+            await bot.show_main_menu(chat_id, context)
+            photo_id = bot.photo_media(bot.WELCOME_PHOTO)[0]
+
+            before = len(api.calls)
+            started = time.perf_counter()
+            for i in range(n_screens):
+                show, _ = steps[i % len(steps)]
+                await show(chat_id, i)
+            new_ms = (time.perf_counter() - started) / n_screens * 1000
+            new_calls = (len(api.calls) - before) / n_screens
+
+            msg_id = bot.session(chat_id).message_id
+            markup = bot.build_main_menu_keyboard(chat_id)
+            before = len(api.calls)
+            started = time.perf_counter()
+            for i in range(n_screens):
+                _, kind = steps[i % len(steps)]
+                media = f"FILE0_{i % 12 + 1}" if kind == "video" else photo_id
+                await _legacy_screen(ext, chat_id, msg_id, kind, media, f"экран {i}", markup)
+            old_ms = (time.perf_counter() - started) / n_screens * 1000
+            old_calls = (len(api.calls) - before) / n_screens
+
+            print(
+                f"  {label:<34} было {old_calls:.2f} вызова/экран ({old_ms:.2f} ms), "
+                f"стало {new_calls:.2f} ({new_ms:.2f} ms)"
+            )
+        for name, st in sorted(bot.TRANSITION_STATS.items()):
+            print(f"  {name:<14} экранов: {st['renders']:5d}, вызовов на экран: {st['calls'] / st['renders']:.2f}")
+    finally:
+        await ext.shutdown()
+
+
+def bench_screens() -> None:
+    print("screens: вызовы Bot API на смену экрана (заглушка Bot API)")
+    asyncio.run(_screens_harness(500))
+
+
+# ===============================
+# callbacks: разбор callback_data — прежняя цепочка if/startswith против таблицы
+# ===============================
+def _legacy_callback_parse(data: str):
+    """Прежний handle_callback без хэндлеров: те же проверки в том же порядке и тот же разбор."""
+    if data == "menu":
+        return "menu", ()
+    if data == "catalog":
+        return "catalog", ()
+    if data == "random":
+        return "random", ()
+    if data == "ongoings":
+        return "ongoings", ()
+    if data == "continue":
+        return "continue", ()
+    if data == "continue_list":
+        return "continue_list", ()
+    if data.startswith("continue_page:"):
+        _, page_str = data.split(":", 1)
+        try:
+            page = int(page_str)
+        except ValueError:
+            page = 0
+        return "continue_page", (page,)
+    if data.startswith("cont:"):
+        return "cont", (data.split(":", 1)[1],)
+    if data.startswith("cont_play:"):
+        return "cont_play", (data.split(":", 1)[1],)
+    if data.startswith("cont_remove:"):
+        return "cont_remove", (data.split(":", 1)[1],)
+    if data == "search":
+        return "search", ()
+    if data == "favorites":
+        return "favorites", ()
+    if data == "watched":
+        return "watched", ()
+    if data.startswith("watched:"):
+        _, page_str = data.split(":", 1)
+        try:
+            page = int(page_str)
+        except ValueError:
+            page = 0
+        return "watched", (page,)
+    if data.startswith("genre:"):
+        return "genre", (data.split(":", 1)[1],)
+    if data.startswith("genre_page:"):
+        _, genre, page_str = data.split(":", 2)
+        try:
+            page = int(page_str)
+        except ValueError:
+            page = 0
+        return "genre_page", (genre, page)
+    if data.startswith("anime:"):
+        return "anime", (data.split(":", 1)[1],)
+    if data.startswith("list:"):
+        return "list", (data.split(":", 1)[1],)
+    if data.startswith("ep:"):
+        _, slug, ep_str = data.split(":")
+        return "ep", (slug, int(ep_str))
+    if data.startswith("next:"):
+        _, slug, ep_str = data.split(":")
+        return "next", (slug, int(ep_str))
+    if data.startswith("next_other:"):
+        _, slug, ep_str = data.split(":")
+        return "next_other", (slug, int(ep_str))
+    if data.startswith("prev:"):
+        _, slug, ep_str = data.split(":")
+        return "prev", (slug, int(ep_str))
+    if data.startswith("fav_add:"):
+        return "fav_add", (data.split(":", 1)[1],)
+    if data.startswith("fav_remove:"):
+        return "fav_remove", (data.split(":", 1)[1],)
+    if data.startswith("watch_title:"):
+        return "watch_title", (data.split(":", 1)[1],)
+    if data.startswith("unwatch_title:"):
+        return "unwatch_title", (data.split(":", 1)[1],)
+    if data.startswith("track:"):
+        _, slug, ep_str, safe_tname = data.split(":", 3)
+        return "track", (slug, int(ep_str), safe_tname.replace("__colon__", ":"))
+    return None
+
+
+# все виды кнопок, которые строит bot.py
+_CALLBACK_SAMPLES = [
+    "menu", "catalog", "random", "ongoings", "continue", "continue_list", "continue_page:2",
+    "cont:title7", "cont_play:title7", "cont_remove:title7", "search", "favorites",
+    "watched", "watched:3", "genre:драма", "genre_page:драма:4", "anime:title7", "list:title7",
+    "ep:title7:5", "next:title7:5", "next_other:title7:5", "prev:title7:5",
+    "fav_add:title7", "fav_remove:title7", "watch_title:title7", "unwatch_title:title7",
+    "track:title7:5:aniliberty__colon__tv",
+]
+
+
+def bench_callbacks() -> None:
+    print("callbacks: разбор callback_data (нс на кнопку)")
+    for data in _CALLBACK_SAMPLES:
+        route, args = bot.parse_callback(data)
+        assert route is not None and args is not None, data
+        old = _legacy_callback_parse(data)
+        assert old is not None and old[1][:len(args)] == args, (data, old, args)
+
+    repeat = 20_000
+    total_old = total_new = 0.0
+    for data in _CALLBACK_SAMPLES:
+        old_ns = _timeit(lambda: _legacy_callback_parse(data), repeat) * 1000
+        new_ns = _timeit(lambda: bot.parse_callback(data), repeat) * 1000
+        total_old += old_ns
+        total_new += new_ns
+        print(f"  {data:<38} цепочка {old_ns:>6.0f}, таблица {new_ns:>6.0f}")
+    n = len(_CALLBACK_SAMPLES)
+    print(f"  в среднем: цепочка {total_old / n:.0f} нс, таблица {total_new / n:.0f} нс")
+
+    for data in ("ep:title7:", "next:title7:x", "track:title7", "menu:extra", "nope"):
+        route, args = bot.parse_callback(data)
+        verdict = "неизвестная" if route is None else ("кривая" if args is None else "ok")
+        print(f"  {data!r:<20} -> {verdict}")
+
+
+BENCHES = {
+    "users_click": bench_users_click,
+    "catalog_load": bench_catalog_load,
+    "search": bench_search,
+    "inline": bench_inline,
+    "webhook": bench_webhook,
+    "screens": bench_screens,
+    "callbacks": bench_callbacks,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        if name not in BENCHES:
+            print(f"Unknown benchmark: {name}. Available: {', '.join(BENCHES)}")
+            sys.exit(1)
+        BENCHES[name]()
@@ -1,6 +1,22 @@
 import os
+import sys
 import json
+import heapq
+import math
+import time
+import bisect
 import random
+import pickle
+import asyncio
+import hashlib
+import secrets
+import functools
+import sqlite3
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from typing import Optional
 
 from telegram import (
@@ -9,12 +25,18 @@ from telegram import (
     InlineKeyboardButton,
     InputMediaPhoto,
     InputMediaVideo,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
     Message,
 )
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
     ContextTypes,
     filters,
@@ -26,15 +48,102 @@ from telegram.ext import (
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 
+# режим работы: "polling" или "webhook" (встроенный сервер PTB, нужен python-telegram-bot[webhooks])
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+# адрес Bot API: свой telegram-bot-api сервер или локальная заглушка для замеров
+BOT_API_URL = os.environ.get("BOT_API_URL", "https://api.telegram.org/bot")
+# публичный https-адрес бота без пути; Telegram шлёт апдейты на WEBHOOK_URL/WEBHOOK_PATH
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+# если не задан — генерируется при каждом старте (webhook всё равно перерегистрируется)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# сколько одновременных соединений с апдейтами Telegram может открыть к нам (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+
 WELCOME_PHOTO = "images/welcome.jpg"
 SOURCE_CHAT_ID = -1003362969236
 
 ANIME_JSON_PATH = "anime.json"
 USERS_JSON_PATH = "users.json"
+# file_id уже загруженных в Telegram картинок (путь -> sha256 файла + file_id)
+MEDIA_REGISTRY_PATH = "media.json"
+# сессии чатов (id и тип сообщения бота) — чтобы после рестарта редактировать, а не слать заново
+SESSIONS_PATH = "sessions.json"
+SESSIONS_SNAPSHOT_VERSION = 1
+
+# бинарный снапшот уже нормализованного каталога рядом с anime.json (быстрый старт)
+ANIME_SNAPSHOT_PATH = "anime.snapshot"
+# менять при любом изменении in-memory формата ANIME — старые снапшоты станут невалидными
+ANIME_SNAPSHOT_VERSION = 6
+# снапшот пишем не после каждого save_anime, а последнюю версию раз в N секунд (и при остановке)
+ANIME_SNAPSHOT_DELAY = float(os.environ.get("ANIME_SNAPSHOT_DELAY", "30"))
+
+# хранилище каталога: "json" (anime.json целиком) или "sqlite" (построчные upsert'ы)
+CATALOG_BACKEND = os.environ.get("CATALOG_BACKEND", "json")
+CATALOG_DB_PATH = os.environ.get("CATALOG_DB_PATH", "anime.db")
+# "sharded": по файлу на тайтл + manifest.json со списком slug'ов
+CATALOG_SHARDS_DIR = os.environ.get("CATALOG_SHARDS_DIR", "anime_shards")
+CATALOG_LOAD_WORKERS = int(os.environ.get("CATALOG_LOAD_WORKERS", "8"))
 
 ADMIN_ID = 852405425
 ADMIN2_ID = 8505295670  # второй админ
 
+# write-behind для users.json: сбрасываем на диск не чаще раза в N секунд
+# или раньше, если накопилось USERS_FLUSH_MAX_DIRTY изменений
+USERS_FLUSH_INTERVAL = float(os.environ.get("USERS_FLUSH_INTERVAL", "5"))
+USERS_FLUSH_MAX_DIRTY = int(os.environ.get("USERS_FLUSH_MAX_DIRTY", "50"))
+# в лог пишем только медленные flush'и (остальное видно в /stats)
+USERS_FLUSH_SLOW_MS = float(os.environ.get("USERS_FLUSH_SLOW_MS", "250"))
+
+# хранилище пользовательских данных: "json" (users.json + журнал) или "sqlite"
+USERS_BACKEND = os.environ.get("USERS_BACKEND", "json")
+USERS_DB_PATH = os.environ.get("USERS_DB_PATH", "users.db")
+# sqlite: сколько "горячих" пользователей держим в памяти (LRU)
+USERS_CACHE_SIZE = int(os.environ.get("USERS_CACHE_SIZE", "10000"))
+
+# журнал изменений пользователей (append-only) поверх снапшота users.json
+USERS_JOURNAL_PATH = "users.journal"
+USERS_JOURNAL_ENABLED = os.environ.get("USERS_JOURNAL_ENABLED", "1") == "1"
+# как только журнал вырос больше порога — сворачиваем его обратно в users.json
+USERS_JOURNAL_COMPACT_BYTES = int(os.environ.get("USERS_JOURNAL_COMPACT_BYTES", str(1024 * 1024)))
+# fsync: "always" — на каждую запись, "batch" — на каждый flush, "never" — не делаем
+USERS_FSYNC = os.environ.get("USERS_FSYNC", "batch")
+
+# мониторинг блокировок event loop: как часто меряем и что считаем "подвисанием"
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_STALL_MS = float(os.environ.get("LOOP_STALL_MS", "50"))
+
+# сколько апдейтов обрабатываем одновременно (апдейты одного чата — всё равно по очереди)
+UPDATES_CONCURRENCY = int(os.environ.get("UPDATES_CONCURRENCY", "64"))
+
+# исходящие запросы к Bot API: общий лимит бота и лимит на чат (запросов в секунду + запас)
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_GLOBAL_BURST = float(os.environ.get("OUTBOUND_GLOBAL_BURST", "30"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "3"))
+OUTBOUND_CHAT_BURST = float(os.environ.get("OUTBOUND_CHAT_BURST", "6"))
+# в группы Telegram разрешает ~20 сообщений в минуту
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", str(20 / 60)))
+OUTBOUND_GROUP_BURST = float(os.environ.get("OUTBOUND_GROUP_BURST", "3"))
+# сколько раз повторяем запрос после RetryAfter, прежде чем отдать ошибку хэндлеру
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+
+# прогрев картинок при старте: все images/* заливаются в этот приватный чат
+# до начала polling'а (0 — выключено), не больше N загрузок одновременно
+MEDIA_DIR = "images"
+MEDIA_WARMUP_CHAT_ID = int(os.environ.get("MEDIA_WARMUP_CHAT_ID", "0"))
+MEDIA_WARMUP_CONCURRENCY = int(os.environ.get("MEDIA_WARMUP_CONCURRENCY", "4"))
+
+# сессии чатов (сообщение бота, режимы): простаивающие дольше SESSION_TTL секунд выкидываем
+# (через 48 часов Telegram всё равно не даёт боту удалить своё сообщение) и держим
+# не больше SESSION_MAX_COUNT самых свежих; проверка раз в SESSION_SWEEP_INTERVAL секунд
+SESSION_TTL = float(os.environ.get("SESSION_TTL", str(48 * 3600)))
+SESSION_MAX_COUNT = int(os.environ.get("SESSION_MAX_COUNT", "100000"))
+SESSION_SWEEP_INTERVAL = float(os.environ.get("SESSION_SWEEP_INTERVAL", "60"))
+# как часто сохраняем сессии в sessions.json (только если что-то изменилось)
+SESSION_SNAPSHOT_INTERVAL = float(os.environ.get("SESSION_SNAPSHOT_INTERVAL", "30"))
+
 # ===============================
 # ACHIEVEMENTS (просмотренные тайтлы)
 # ===============================
@@ -114,9 +223,42 @@ ACHIEVEMENT_THRESHOLDS = sorted(ACHIEVEMENTS.keys())
 # ===============================
 # IN-MEM STORAGE
 # ===============================
-LAST_MESSAGE: dict[int, int] = {}
-LAST_MESSAGE_TYPE: dict[int, str] = {}
-SEARCH_MODE: dict[int, bool] = {}
+class ChatSession:
+    """Всё, что бот помнит о чате между апдейтами."""
+
+    __slots__ = ("message_id", "message_type", "search_mode", "random_mode", "render", "last_active")
+
+    def __init__(self):
+        # единственное сообщение бота в чате, которое мы редактируем
+        self.message_id: Optional[int] = None
+        # "text" / "photo" / "video" — чем это сообщение является
+        self.message_type: Optional[str] = None
+        self.search_mode = False
+        # режим случайного — чтобы показать кнопку "Случайное" на экране серии
+        self.random_mode = False
+        # (message_id, картинка/видео, hash(подпись, клавиатура)) того, что сейчас на экране;
+        # после рестарта hash неизвестен (None) — остаётся только картинка/видео
+        self.render: Optional[tuple[int, Optional[str], Optional[int]]] = None
+        self.last_active = time.time()
+
+
+# chat_id -> ChatSession, от давно неактивных к свежим (так их дёшево вытеснять)
+SESSIONS: "OrderedDict[int, ChatSession]" = OrderedDict()
+
+SESSION_STATS = {"created": 0, "evicted_ttl": 0, "evicted_lru": 0, "restored": 0}
+
+
+def session(chat_id: int) -> ChatSession:
+    """Сессия чата (создаётся при первом обращении); заодно отмечает активность."""
+    s = SESSIONS.get(chat_id)
+    if s is None:
+        s = SESSIONS[chat_id] = ChatSession()
+        SESSION_STATS["created"] += 1
+    else:
+        s.last_active = time.time()
+        SESSIONS.move_to_end(chat_id)
+    return s
+
 
 # user_id -> {slug: ep}
 USER_PROGRESS: dict[int, dict[str, int]] = {}
@@ -130,240 +272,2525 @@ USER_WATCHED_TITLES: dict[int, set[str]] = {}
 # user_id -> {slug: track_name}  ТЕКУЩАЯ ОЗВУЧКА ДЛЯ ТАЙТЛА
 CURRENT_TRACK: dict[int, dict[str, str]] = {}
 
-# chat_id -> bool  (режим случайного — чтобы показать кнопку "Случайное" на экране серии)
-RANDOM_MODE: dict[int, bool] = {}
-
 # slug -> {title, genres, status, episodes{ep: {"tracks": {track_name: {source, skip}}}}}
 ANIME: dict[str, dict] = {}
 
 # limits
 CONTINUE_LIMIT = 20
 CONTINUE_PAGE_SIZE = 10
+# поиск по названию: сколько тайтлов показать и какая доля триграмм запроса должна совпасть
+SEARCH_LIMIT = 20
+SEARCH_MIN_SIMILARITY = 0.5
+# inline-режим (@bot <название>, включается в BotFather через /setinline)
+INLINE_LIMIT = 50  # больше Telegram всё равно не покажет
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "300"))
+INLINE_CACHE_SIZE = int(os.environ.get("INLINE_CACHE_SIZE", "2048"))
+# глубина префиксного дерева; более длинные запросы дофильтровываем по ключам
+TITLE_TRIE_DEPTH = 8
+
+# ===============================
+# PERSIST EXECUTOR: запись на диск вне event loop
+# ===============================
+# Хэндлеры только снимают дешёвую копию состояния и отдают запись сюда.
+# Поток один — значит записи выполняются строго в порядке постановки
+# (строки журнала, снапшот, обрезка журнала, upsert'ы в базу).
+_PERSIST_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+PERSIST_STATS = {
+    "submitted": 0,  # пишет только event loop
+    "done": 0,       # пишет только поток персистентности
+    "failed": 0,
+    "busy_ms": 0.0,
+    "max_ms": 0.0,
+}
+
+
+def _persist_executor() -> ThreadPoolExecutor:
+    global _PERSIST_EXECUTOR
+    if _PERSIST_EXECUTOR is None:
+        _PERSIST_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+    return _PERSIST_EXECUTOR
+
+
+def _run_persist_job(fn, args: tuple) -> None:
+    started = time.perf_counter()
+    try:
+        fn(*args)
+    except Exception as e:
+        PERSIST_STATS["failed"] += 1
+        print(f"Persist job {getattr(fn, '__name__', fn)} failed:", e)
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        PERSIST_STATS["busy_ms"] += elapsed_ms
+        PERSIST_STATS["max_ms"] = max(PERSIST_STATS["max_ms"], elapsed_ms)
+        PERSIST_STATS["done"] += 1
+
+
+def submit_persist(fn, *args) -> None:
+    """
+    Отдаёт запись в поток персистентности и сразу возвращается.
+    Вне event loop (миграция, бенчмарк, старт) выполняет запись сразу.
+    """
+    PERSIST_STATS["submitted"] += 1
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        _run_persist_job(fn, args)
+        return
+    _persist_executor().submit(_run_persist_job, fn, args)
+
+
+async def wait_persist() -> None:
+    """Дождаться, пока уйдёт на диск всё, что поставлено в очередь до этого момента."""
+    if _PERSIST_EXECUTOR is None:
+        return
+    await asyncio.get_running_loop().run_in_executor(_PERSIST_EXECUTOR, lambda: None)
+
+
+def shutdown_persist() -> None:
+    global _PERSIST_EXECUTOR
+    if _PERSIST_EXECUTOR is not None:
+        _PERSIST_EXECUTOR.shutdown(wait=True)
+        _PERSIST_EXECUTOR = None
+
 
 # ===============================
 # JSON SAVE/LOAD: ANIME
 # ===============================
+def _normalize_anime_entry(anime: dict) -> dict:
+    """
+    Один тайтл старого или нового формата -> новый формат:
+    episodes[ep] = {"tracks": {track_name: {"source": ..., "skip": ...}}}
+    """
+    title = anime.get("title", "")
+    genres = anime.get("genres", [])
+    status = anime.get("status", "ongoing")  # по умолчанию считаем онгоингом
+    episodes_raw = anime.get("episodes", {})
+
+    episodes: dict[int, dict] = {}
+    for ep_str, ep_data in episodes_raw.items():
+        try:
+            ep_int = int(ep_str)
+        except ValueError:
+            continue
+
+        # Новый формат или старый?
+        if isinstance(ep_data, dict) and "tracks" in ep_data:
+            # Уже новый формат
+            tracks = ep_data.get("tracks", {})
+            # Нормализуем треки: ensure dict with source/skip
+            norm_tracks = {}
+            for tname, tdata in tracks.items():
+                if isinstance(tdata, dict):
+                    source = tdata.get("source")
+                    skip = tdata.get("skip")
+                else:
+                    # если вдруг хранили просто строку
+                    source = tdata
+                    skip = None
+                if source:
+                    norm_tracks[tname] = {"source": source, "skip": skip}
+            if norm_tracks:
+                episodes[ep_int] = {"tracks": norm_tracks}
+        else:
+            # Старый формат:
+            # может быть {"source": "...", "skip": "...", "ozv": "..."} или просто {"source": "..."}
+            if not isinstance(ep_data, dict):
+                continue
+            source = ep_data.get("source")
+            if not source:
+                continue
+            skip = ep_data.get("skip")
+            ozv = ep_data.get("ozv") or "default"
+            episodes[ep_int] = {
+                "tracks": {
+                    ozv: {
+                        "source": source,
+                        "skip": skip,
+                    }
+                }
+            }
+
+    return {
+        "title": title,
+        "genres": genres,
+        "status": status,
+        "episodes": episodes,
+    }
+
+
+def _anime_entry_to_json(anime: dict) -> dict:
+    """Один тайтл из ANIME -> объект для anime.json (ключи серий — строки)."""
+    episodes = anime.get("episodes", {})
+    eps_json = {}
+    for ep_int, ep_data in episodes.items():
+        ep_obj = {}
+        # сохраняем в новом формате
+        tracks = ep_data.get("tracks", {})
+        ep_obj["tracks"] = {}
+        for tname, tinfo in tracks.items():
+            ep_obj["tracks"][tname] = {
+                "source": tinfo.get("source"),
+                "skip": tinfo.get("skip"),
+            }
+        eps_json[str(ep_int)] = ep_obj
+
+    return {
+        "title": anime.get("title", ""),
+        "genres": anime.get("genres", []),
+        "status": anime.get("status", "ongoing"),
+        "episodes": eps_json,
+    }
+
+
+# ===============================
+# CATALOG INDEXES: производные индексы каталога
+# ===============================
+# Строятся целиком при загрузке и точечно обновляются через reindex_title(slug)
+# при добавлении серии, /clear_slug и /clear_ep.
+
+# genre -> slug'и этого жанра, отсортированные по названию
+GENRE_INDEX: dict[str, list[str]] = {}
+# genre -> ключи сортировки тех же slug'ов, по позициям (bisect без key=, он есть только с 3.10)
+_GENRE_KEYS: dict[str, list[tuple[str, str]]] = {}
+
+# все slug'и каталога по названию и позиция каждого в этом порядке —
+# списки на экранах сортируем по целому рангу, а не по title.lower()
+TITLE_ORDER: list[str] = []
+TITLE_RANK: dict[str, int] = {}
+# ключи сортировки TITLE_ORDER, по позициям
+_TITLE_KEYS: list[tuple[str, str]] = []
+
+# slug -> (жанры, ключ сортировки), под которыми тайтл сейчас лежит в индексах
+_INDEXED_TITLES: dict[str, tuple[tuple[str, ...], tuple[str, str]]] = {}
+
+# триграмма -> slug'и, в ключах поиска которых она встречается
+TRIGRAM_INDEX: dict[str, set[str]] = {}
+# slug -> (ключи поиска: название, его транслит, slug; триграммы всех ключей)
+_SEARCH_TITLES: dict[str, tuple[tuple[str, ...], frozenset[str]]] = {}
+
+# префиксное дерево по началам слов ключей поиска: узел — dict символ -> узел,
+# в узле под ключом "" лежат slug'и, у которых есть ключ с таким префиксом с начала слова
+TITLE_TRIE: dict = {}
+
+# нормализованный inline-запрос -> готовые результаты; сбрасывается при любом reindex
+INLINE_CACHE: "OrderedDict[str, list]" = OrderedDict()
+
+# растёт при каждом изменении каталога (загрузка, новая серия, /clear_slug, /clear_ep)
+CATALOG_VERSION = 0
+
+_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z",
+    "и": "i", "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p",
+    "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "h", "ц": "ts", "ч": "ch",
+    "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+})
+
+
+def _title_sort_key(slug: str, anime: dict) -> tuple[str, str]:
+    return (anime.get("title", slug).lower(), slug)
+
+
+def _normalize_search_text(text: str) -> str:
+    """Нижний регистр, ё -> е, пунктуация -> пробел."""
+    text = text.lower().replace("ё", "е")
+    return " ".join("".join(ch if ch.isalnum() else " " for ch in text).split())
+
+
+def _trigrams(text: str) -> frozenset[str]:
+    """Триграммы каждого слова с отступами по краям (как pg_trgm): "  б", " ба", "баш", ..."""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return frozenset(grams)
+
+
+def _search_entry(slug: str, anime: dict) -> tuple[tuple[str, ...], frozenset[str]]:
+    # ключи считаем один раз здесь — запрос нормализуется один раз и сверяется со всеми
+    title = _normalize_search_text(anime.get("title", slug))
+    keys = tuple(dict.fromkeys(
+        k for k in (title, title.translate(_TRANSLIT), _normalize_search_text(slug)) if k
+    ))
+    grams = frozenset().union(*(_trigrams(k) for k in keys))
+    return (keys, grams)
+
+
+def _trie_paths(keys: tuple[str, ...]) -> set[str]:
+    """Хвосты ключей с начала каждого слова, обрезанные до глубины дерева."""
+    paths = set()
+    for key in keys:
+        words = key.split(" ")
+        for i in range(len(words)):
+            paths.add(" ".join(words[i:])[:TITLE_TRIE_DEPTH])
+    return paths
+
+
+def _trie_add(trie: dict, path: str, slug: str) -> None:
+    node = trie
+    for ch in path:
+        node = node.setdefault(ch, {})
+        node.setdefault("", set()).add(slug)
+
+
+def _trie_remove(trie: dict, path: str, slug: str) -> None:
+    walked = []
+    node = trie
+    for ch in path:
+        child = node.get(ch)
+        if child is None:
+            break
+        child[""].discard(slug)
+        walked.append((node, ch, child))
+        node = child
+    # slug'и потомка — подмножество slug'ов родителя: пустые узлы срезаем снизу вверх
+    for parent, ch, child in reversed(walked):
+        if child[""]:
+            break
+        del parent[ch]
+
+
+def _build_catalog_indexes(anime_map: dict[str, dict]) -> dict:
+    """Строит индексы по копии каталога — можно звать и из фонового потока."""
+    indexed = {
+        slug: (tuple(dict.fromkeys(anime.get("genres", []))), _title_sort_key(slug, anime))
+        for slug, anime in anime_map.items()
+    }
+    order = sorted(indexed, key=lambda s: indexed[s][1])
+    genres: dict[str, list[str]] = {}
+    for slug in order:
+        for g in indexed[slug][0]:
+            genres.setdefault(g, []).append(slug)
+
+    search = {slug: _search_entry(slug, anime) for slug, anime in anime_map.items()}
+    trigrams, trie = _build_search_indexes(search)
+    return {
+        "genres": genres,
+        "titles": indexed,
+        "order": order,
+        "search": search,
+        "trigrams": trigrams,
+        "trie": trie,
+    }
+
+
+def _build_search_indexes(search: dict) -> tuple[dict[str, set[str]], dict]:
+    """Триграммы и trie по уже посчитанным ключам поиска."""
+    trigrams: dict[str, set[str]] = {}
+    trie: dict = {}
+    for slug, (keys, grams) in search.items():
+        for gram in grams:
+            trigrams.setdefault(gram, set()).add(slug)
+        for path in _trie_paths(keys):
+            _trie_add(trie, path, slug)
+    return trigrams, trie
+
+
+def _install_catalog_indexes(indexes: dict) -> None:
+    global GENRE_INDEX, _GENRE_KEYS, _INDEXED_TITLES, TITLE_ORDER, TITLE_RANK, _TITLE_KEYS
+    global TRIGRAM_INDEX, _SEARCH_TITLES, TITLE_TRIE
+    GENRE_INDEX = indexes["genres"]
+    _INDEXED_TITLES = indexes["titles"]
+    _GENRE_KEYS = {
+        g: [_INDEXED_TITLES[s][1] for s in slugs] for g, slugs in GENRE_INDEX.items()
+    }
+    TITLE_ORDER = indexes["order"]
+    TITLE_RANK = {slug: rank for rank, slug in enumerate(TITLE_ORDER)}
+    _TITLE_KEYS = [_INDEXED_TITLES[s][1] for s in TITLE_ORDER]
+    _SEARCH_TITLES = indexes["search"]
+    TRIGRAM_INDEX = indexes["trigrams"]
+    TITLE_TRIE = indexes["trie"]
+    INLINE_CACHE.clear()
+    _bump_catalog_version()
+
+
+def _bump_catalog_version() -> None:
+    global CATALOG_VERSION
+    CATALOG_VERSION += 1
+    # клавиатуры старой версии больше никогда не попадут — не держим их в памяти
+    RENDER_CACHE.clear()
+
+
+def title_rank(slug: str) -> tuple[int, str]:
+    """
+    Ключ сортировки по названию для любых списков тайтлов.
+    Тайтлы, которых уже нет в каталоге, — в конец списка, между собой по slug.
+    """
+    return (TITLE_RANK.get(slug, len(TITLE_ORDER)), slug)
+
+
+def _renumber_title_ranks(start: int) -> None:
+    for rank in range(start, len(TITLE_ORDER)):
+        TITLE_RANK[TITLE_ORDER[rank]] = rank
+
+
+def rebuild_catalog_indexes() -> None:
+    _install_catalog_indexes(_build_catalog_indexes(ANIME))
+
+
+def _reindex_search(slug: str, anime: Optional[dict]) -> None:
+    old = _SEARCH_TITLES.pop(slug, None)
+    if old is not None:
+        for gram in old[1]:
+            slugs = TRIGRAM_INDEX.get(gram)
+            if slugs is None:
+                continue
+            slugs.discard(slug)
+            if not slugs:
+                del TRIGRAM_INDEX[gram]
+        for path in _trie_paths(old[0]):
+            _trie_remove(TITLE_TRIE, path, slug)
+    if anime is None:
+        return
+    entry = _search_entry(slug, anime)
+    _SEARCH_TITLES[slug] = entry
+    for gram in entry[1]:
+        TRIGRAM_INDEX.setdefault(gram, set()).add(slug)
+    for path in _trie_paths(entry[0]):
+        _trie_add(TITLE_TRIE, path, slug)
+
+
+def _substring_hits(q: str) -> set[str]:
+    """Тайтлы, в ключах которых q встречается как есть (как прежний поиск подстрокой)."""
+    # любое вхождение q содержит все триграммы из середины его слов — сужаем по ним
+    grams = {word[i:i + 3] for word in q.split() for i in range(len(word) - 2)}
+    if grams:
+        postings = sorted((TRIGRAM_INDEX.get(gram, set()) for gram in grams), key=len)
+        pool = postings[0].intersection(*postings[1:])
+    else:
+        # в запросе нет слов длиннее двух букв — триграммы не помогут, перебираем
+        pool = _SEARCH_TITLES.keys()
+    return {slug for slug in pool if any(q in key for key in _SEARCH_TITLES[slug][0])}
+
+
+def search_titles(query: str, limit: int = SEARCH_LIMIT) -> list[str]:
+    """
+    Поиск по названию через триграммный индекс, с опечатками и латиницей.
+    Всегда находятся тайтлы, где запрос входит в ключ целиком (даже в середину слова
+    или из одной-двух букв); сверх того — похожие, у которых есть не меньше
+    SEARCH_MIN_SIMILARITY триграмм запроса. Сначала точные вхождения, потом похожие;
+    внутри — по доле совпавших триграмм и по названию.
+    """
+    q = _normalize_search_text(query)
+    if not q:
+        return []
+    exact = _substring_hits(q)
+    postings = sorted((TRIGRAM_INDEX.get(gram, ()) for gram in _trigrams(q)), key=len)
+    need = max(1, math.ceil(len(postings) * SEARCH_MIN_SIMILARITY))
+
+    # у подходящего тайтла хотя бы одна из need общих триграмм попадёт в
+    # len - need + 1 самых коротких списков — кандидатов берём только оттуда
+    candidates = set(exact)
+    for slugs in postings[:len(postings) - need + 1]:
+        candidates.update(slugs)
+
+    scored = []
+    for slug in candidates:
+        n = sum(1 for slugs in postings if slug in slugs)
+        contains = slug in exact
+        if n < need and not contains:
+            continue
+        scored.append((not contains, -n, title_rank(slug), slug))
+    scored.sort()
+    return [item[3] for item in scored[:limit]]
+
+
+def prefix_search(q: str, limit: int = INLINE_LIMIT) -> list[str]:
+    """
+    Тайтлы, у которых какое-то слово ключа поиска начинается с q, по названию.
+    q уже нормализован (_normalize_search_text).
+    """
+    if not q:
+        return TITLE_ORDER[:limit]
+    node = TITLE_TRIE
+    for ch in q[:TITLE_TRIE_DEPTH]:
+        node = node.get(ch)
+        if node is None:
+            return []
+    slugs = node[""]
+    if len(q) > TITLE_TRIE_DEPTH:
+        needle = " " + q
+        slugs = [s for s in slugs if any(needle in " " + key for key in _SEARCH_TITLES[s][0])]
+    elif len(slugs) * len(slugs) > limit * len(TITLE_ORDER):
+        # короткий префикс, под который подходит большая часть каталога:
+        # первые limit нашлись бы в TITLE_ORDER быстрее, чем отбор из всего множества
+        found = []
+        for slug in TITLE_ORDER:
+            if slug in slugs:
+                found.append(slug)
+                if len(found) == limit:
+                    break
+        return found
+    return heapq.nsmallest(limit, slugs, key=title_rank)
+
+
+def reindex_title(slug: str) -> None:
+    """
+    Тайтл добавлен, изменён или удалён — переставляем только его записи в индексах.
+    """
+    INLINE_CACHE.clear()
+    _bump_catalog_version()
+    _reindex_search(slug, ANIME.get(slug))
+    old = _INDEXED_TITLES.pop(slug, None)
+    # с какой позиции TITLE_ORDER сдвинулись ранги
+    renumber_from = len(TITLE_ORDER)
+    if old is not None:
+        old_genres, old_key = old
+        pos = TITLE_RANK.pop(slug)
+        del TITLE_ORDER[pos]
+        del _TITLE_KEYS[pos]
+        renumber_from = pos
+        for g in old_genres:
+            slugs = GENRE_INDEX.get(g)
+            if not slugs:
+                continue
+            keys = _GENRE_KEYS[g]
+            pos = bisect.bisect_left(keys, old_key)
+            if pos < len(slugs) and slugs[pos] == slug:
+                del slugs[pos]
+                del keys[pos]
+            if not slugs:
+                del GENRE_INDEX[g]
+                del _GENRE_KEYS[g]
+
+    anime = ANIME.get(slug)
+    if anime is None:
+        _renumber_title_ranks(renumber_from)
+        return
+
+    genres = tuple(dict.fromkeys(anime.get("genres", [])))
+    key = _title_sort_key(slug, anime)
+    _INDEXED_TITLES[slug] = (genres, key)
+    for g in genres:
+        keys = _GENRE_KEYS.setdefault(g, [])
+        pos = bisect.bisect_left(keys, key)
+        keys.insert(pos, key)
+        GENRE_INDEX.setdefault(g, []).insert(pos, slug)
+
+    pos = bisect.bisect_left(_TITLE_KEYS, key)
+    _TITLE_KEYS.insert(pos, key)
+    TITLE_ORDER.insert(pos, slug)
+    _renumber_title_ranks(min(pos, renumber_from))
+
+
+# ===============================
+# ANIME SNAPSHOT: бинарная копия нормализованного каталога
+# ===============================
+# Формат файла: строка-заголовок "ANIMESNAP <версия> <sha256 anime.json>\n" + pickle.
+# Снапшот годен, только если версия совпадает и он снят ровно с текущего anime.json.
+_ANIME_SNAPSHOT_MAGIC = b"ANIMESNAP"
+
+# как загрузился каталог при старте
+CATALOG_LOAD_STATS = {"source": "", "ms": 0.0}
+
+# сколько раз сохраняли каталог и сколько снапшотов из этого реально записали
+ANIME_SNAPSHOT_STATS = {"saves": 0, "written": 0}
+
+# снапшот отстаёт от anime.json; CATALOG_VERSION на момент последнего save_anime
+_ANIME_SNAPSHOT_DIRTY = False
+_ANIME_SNAPSHOT_SAVED_VERSION = 0
+_ANIME_SNAPSHOT_TIMER: Optional[asyncio.TimerHandle] = None
+
+# последняя копия, ушедшая в anime.json, и её sha256 — трогает только поток персистентности
+_ANIME_JSON_WRITTEN: dict = {"data": None, "checksum": ""}
+
+
+def _read_anime_snapshot(checksum: str) -> Optional[dict]:
+    """Возвращает {"anime": ..., "indexes": ...} или None, если снапшот не подходит."""
+    try:
+        with open(ANIME_SNAPSHOT_PATH, "rb") as f:
+            header = f.readline().split()
+            if (
+                len(header) != 3
+                or header[0] != _ANIME_SNAPSHOT_MAGIC
+                or header[1] != str(ANIME_SNAPSHOT_VERSION).encode()
+                or header[2] != checksum.encode()
+            ):
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print("Failed to read anime.snapshot:", e)
+        return None
+
+
+def _write_anime_binary_snapshot(anime_map: dict[str, dict], checksum: str, indexes: dict) -> None:
+    try:
+        if "trigrams" not in indexes:
+            # копия живых индексов без производных частей — достраиваем здесь, в фоне
+            indexes = dict(indexes)
+            indexes["trigrams"], indexes["trie"] = _build_search_indexes(indexes["search"])
+        header = b"%s %d %s\n" % (_ANIME_SNAPSHOT_MAGIC, ANIME_SNAPSHOT_VERSION, checksum.encode())
+        payload = pickle.dumps(
+            {"anime": anime_map, "indexes": indexes},
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        _atomic_write_bytes(ANIME_SNAPSHOT_PATH, header + payload, fsync=False)
+        ANIME_SNAPSHOT_STATS["written"] += 1
+    except Exception as e:
+        print("Failed to save anime.snapshot:", e)
+
+
+def _catalog_indexes_copy() -> dict:
+    """
+    Копия индексов, которые держит в актуальном виде reindex_title, — для снапшота.
+    Значения в titles/search неизменяемые, так что хватает поверхностных копий;
+    триграммы и trie строятся из search, их достроит поток персистентности.
+    """
+    return {
+        "genres": {g: list(slugs) for g, slugs in GENRE_INDEX.items()},
+        "titles": dict(_INDEXED_TITLES),
+        "order": list(TITLE_ORDER),
+        "search": dict(_SEARCH_TITLES),
+    }
+
+
 def load_anime() -> None:
     """
     Грузим старый или новый формат и конвертим в новый:
     episodes[ep] = {"tracks": {track_name: {"source": ..., "skip": ...}}}
+    Если рядом лежит снапшот, снятый с этого же anime.json, — берём его и ничего не конвертим.
     """
     global ANIME
+    started = time.perf_counter()
     if not os.path.exists(ANIME_JSON_PATH):
         ANIME = {}
+        rebuild_catalog_indexes()
         return
     try:
-        with open(ANIME_JSON_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        fixed_data = {}
-        for slug, anime in data.items():
-            title = anime.get("title", "")
-            genres = anime.get("genres", [])
-            status = anime.get("status", "ongoing")  # по умолчанию считаем онгоингом
-            episodes_raw = anime.get("episodes", {})
+        with open(ANIME_JSON_PATH, "rb") as f:
+            raw = f.read()
+        checksum = hashlib.sha256(raw).hexdigest()
+
+        snapshot = _read_anime_snapshot(checksum)
+        if snapshot is not None:
+            ANIME = snapshot["anime"]
+            _install_catalog_indexes(snapshot["indexes"])
+            source = ANIME_SNAPSHOT_PATH
+        else:
+            data = json.loads(raw)
+
+            fixed_data = {}
+            for slug, anime in data.items():
+                fixed_data[slug] = _normalize_anime_entry(anime)
+
+            ANIME = fixed_data
+            indexes = _build_catalog_indexes(ANIME)
+            _install_catalog_indexes(indexes)
+            source = ANIME_JSON_PATH
+            # в следующий раз стартуем быстро
+            _write_anime_binary_snapshot(ANIME, checksum, indexes)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        CATALOG_LOAD_STATS["source"] = source
+        CATALOG_LOAD_STATS["ms"] = elapsed_ms
+        print(f"Loaded ANIME from {source}, items: {len(ANIME)} in {elapsed_ms:.1f} ms")
+    except Exception as e:
+        print("Failed to load anime.json:", e)
+        ANIME = {}
+        rebuild_catalog_indexes()
 
-            episodes: dict[int, dict] = {}
-            for ep_str, ep_data in episodes_raw.items():
-                try:
-                    ep_int = int(ep_str)
-                except ValueError:
-                    continue
 
-                # Новый формат или старый?
-                if isinstance(ep_data, dict) and "tracks" in ep_data:
-                    # Уже новый формат
-                    tracks = ep_data.get("tracks", {})
-                    # Нормализуем треки: ensure dict with source/skip
-                    norm_tracks = {}
-                    for tname, tdata in tracks.items():
-                        if isinstance(tdata, dict):
-                            source = tdata.get("source")
-                            skip = tdata.get("skip")
-                        else:
-                            # если вдруг хранили просто строку
-                            source = tdata
-                            skip = None
-                        if source:
-                            norm_tracks[tname] = {"source": source, "skip": skip}
-                    if norm_tracks:
-                        episodes[ep_int] = {"tracks": norm_tracks}
-                else:
-                    # Старый формат:
-                    # может быть {"source": "...", "skip": "...", "ozv": "..."} или просто {"source": "..."}
-                    if not isinstance(ep_data, dict):
-                        continue
-                    source = ep_data.get("source")
-                    if not source:
-                        continue
-                    skip = ep_data.get("skip")
-                    ozv = ep_data.get("ozv") or "default"
-                    episodes[ep_int] = {
-                        "tracks": {
-                            ozv: {
-                                "source": source,
-                                "skip": skip,
-                            }
-                        }
-                    }
+def _anime_snapshot() -> dict:
+    """Копия каталога в формате anime.json — дальше её можно писать из другого потока."""
+    return {slug: _anime_entry_to_json(anime) for slug, anime in ANIME.items()}
 
-            fixed_data[slug] = {
-                "title": title,
-                "genres": genres,
-                "status": status,
-                "episodes": episodes,
-            }
 
-        ANIME = fixed_data
-        print(f"Loaded ANIME from {ANIME_JSON_PATH}, items:", len(ANIME))
+def _write_anime_snapshot(data_to_save: dict) -> None:
+    try:
+        raw = json.dumps(data_to_save, ensure_ascii=False, indent=2).encode("utf-8")
+        _atomic_write_bytes(ANIME_JSON_PATH, raw)
     except Exception as e:
-        print("Failed to load anime.json:", e)
-        ANIME = {}
+        # что теперь на диске — неизвестно, снапшот под такой anime.json не пишем
+        _ANIME_JSON_WRITTEN["data"] = None
+        print("Failed to save anime.json:", e)
+        return
+    _ANIME_JSON_WRITTEN["data"] = data_to_save
+    _ANIME_JSON_WRITTEN["checksum"] = hashlib.sha256(raw).hexdigest()
+
+
+def _write_pending_anime_binary_snapshot(indexes: dict) -> None:
+    # очередь одна: к этому моменту записан последний anime.json, поставленный до снапшота
+    data = _ANIME_JSON_WRITTEN["data"]
+    if data is None:
+        return
+    _write_anime_binary_snapshot(
+        {slug: _normalize_anime_entry(entry) for slug, entry in data.items()},
+        _ANIME_JSON_WRITTEN["checksum"],
+        indexes,
+    )
+
+
+def flush_anime_snapshot() -> None:
+    """Поставить в очередь бинарный снапшот, если он отстаёт от сохранённого каталога."""
+    global _ANIME_SNAPSHOT_DIRTY, _ANIME_SNAPSHOT_TIMER
+    if _ANIME_SNAPSHOT_TIMER is not None:
+        _ANIME_SNAPSHOT_TIMER.cancel()
+        _ANIME_SNAPSHOT_TIMER = None
+    if not _ANIME_SNAPSHOT_DIRTY:
+        return
+    if CATALOG_VERSION != _ANIME_SNAPSHOT_SAVED_VERSION:
+        # индексы уже ушли вперёд от anime.json — снимем после следующего save_anime
+        return
+    _ANIME_SNAPSHOT_DIRTY = False
+    submit_persist(_write_pending_anime_binary_snapshot, _catalog_indexes_copy())
+
+
+def _on_anime_snapshot_timer() -> None:
+    global _ANIME_SNAPSHOT_TIMER
+    _ANIME_SNAPSHOT_TIMER = None
+    flush_anime_snapshot()
 
 
 def save_anime() -> None:
+    """
+    Сохранить anime.json в фоне (снапшот снимаем здесь, пишем в потоке персистентности).
+    Бинарный снапшот схлопываем: пишется только последняя версия, раз в ANIME_SNAPSHOT_DELAY.
+    """
+    global _ANIME_SNAPSHOT_DIRTY, _ANIME_SNAPSHOT_SAVED_VERSION, _ANIME_SNAPSHOT_TIMER
+    submit_persist(_write_anime_snapshot, _anime_snapshot())
+    ANIME_SNAPSHOT_STATS["saves"] += 1
+    _ANIME_SNAPSHOT_DIRTY = True
+    _ANIME_SNAPSHOT_SAVED_VERSION = CATALOG_VERSION
     try:
-        data_to_save = {}
-        for slug, anime in ANIME.items():
-            episodes = anime.get("episodes", {})
-            eps_json = {}
-            for ep_int, ep_data in episodes.items():
-                ep_obj = {}
-                # сохраняем в новом формате
-                tracks = ep_data.get("tracks", {})
-                ep_obj["tracks"] = {}
-                for tname, tinfo in tracks.items():
-                    ep_obj["tracks"][tname] = {
-                        "source": tinfo.get("source"),
-                        "skip": tinfo.get("skip"),
-                    }
-                eps_json[str(ep_int)] = ep_obj
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # вне event loop (миграция, бенчмарк) — пишем сразу
+        flush_anime_snapshot()
+        return
+    if _ANIME_SNAPSHOT_TIMER is None:
+        _ANIME_SNAPSHOT_TIMER = loop.call_later(ANIME_SNAPSHOT_DELAY, _on_anime_snapshot_timer)
 
-            data_to_save[slug] = {
-                "title": anime.get("title", ""),
-                "genres": anime.get("genres", []),
-                "status": anime.get("status", "ongoing"),
-                "episodes": eps_json,
-            }
 
-        with open(ANIME_JSON_PATH, "w", encoding="utf-8") as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print("Failed to save anime.json:", e)
 # ===============================
-# JSON SAVE/LOAD: USERS
+# CATALOG STORAGE: интерфейс и бэкенды
 # ===============================
-def load_users() -> None:
-    global USER_PROGRESS, USER_FAVORITES, USER_WATCHED_TITLES, CURRENT_TRACK
-    if not os.path.exists(USERS_JSON_PATH):
-        USER_PROGRESS = {}
-        USER_FAVORITES = {}
-        USER_WATCHED_TITLES = {}
-        CURRENT_TRACK = {}
-        return
+class CatalogStore(ABC):
+    """
+    Хранилище каталога. ANIME в памяти — рабочая копия, хэндлеры меняют её сами,
+    а хранилищу сообщают, что именно поменялось.
+    """
+    name = "base"
 
-    try:
-        with open(USERS_JSON_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    @abstractmethod
+    def load(self) -> None:
+        ...
 
-        # progress: user_id -> {slug: ep}
-        USER_PROGRESS = {}
-        for user_id_str, prog_map in data.get("progress", {}).items():
-            try:
-                user_id = int(user_id_str)
-            except ValueError:
-                continue
-            if isinstance(prog_map, dict):
-                res = {}
-                for slug, ep in prog_map.items():
-                    if isinstance(slug, str) and isinstance(ep, int):
-                        res[slug] = ep
-                if res:
-                    USER_PROGRESS[user_id] = res
+    @abstractmethod
+    def upsert_track(self, slug: str, ep: int, track_name: str) -> None:
+        """Тайтл (title/genres/status) и одна дорожка серии — из ANIME[slug]."""
 
-        # favorites: user_id -> [slug, ...]
-        USER_FAVORITES = {}
-        for user_id_str, fav_list in data.get("favorites", {}).items():
-            try:
-                user_id = int(user_id_str)
-            except ValueError:
-                continue
-            if isinstance(fav_list, list):
-                USER_FAVORITES[user_id] = set(
-                    [slug for slug in fav_list if isinstance(slug, str)]
-                )
-            else:
-                USER_FAVORITES[user_id] = set()
+    @abstractmethod
+    def delete_episode(self, slug: str, ep: int) -> None:
+        ...
 
-        # watched_titles: user_id -> [slug, ...]
-        USER_WATCHED_TITLES = {}
-        for user_id_str, wt_list in data.get("watched_titles", {}).items():
-            try:
-                user_id = int(user_id_str)
-            except ValueError:
-                continue
-            if isinstance(wt_list, list):
-                USER_WATCHED_TITLES[user_id] = set(
-                    [slug for slug in wt_list if isinstance(slug, str)]
-                )
-            else:
-                USER_WATCHED_TITLES[user_id] = set()
+    @abstractmethod
+    def delete_title(self, slug: str) -> None:
+        ...
 
-        # current_track: user_id -> {slug: track_name}
-        CURRENT_TRACK = {}
-        for user_id_str, track_map in data.get("current_track", {}).items():
-            try:
-                user_id = int(user_id_str)
-            except ValueError:
-                continue
-            if isinstance(track_map, dict):
-                res = {}
-                for slug, tname in track_map.items():
-                    if isinstance(slug, str) and isinstance(tname, str):
-                        res[slug] = tname
-                if res:
-                    CURRENT_TRACK[user_id] = res
+    def export_json(self) -> None:
+        """
+        Выгрузить каталог в anime.json в текущем формате (для /dump_all).
+        Запись асинхронная — дождаться её можно через wait_persist().
+        """
+        save_anime()
+
+    def close(self) -> None:
+        pass
+
+    def stats_lines(self) -> list[str]:
+        return []
+
+
+class JsonCatalogStore(CatalogStore):
+    """Весь каталог в anime.json — любое изменение переписывает файл целиком."""
+    name = "json"
+
+    def load(self) -> None:
+        load_anime()
+
+    def upsert_track(self, slug: str, ep: int, track_name: str) -> None:
+        save_anime()
+
+    def delete_episode(self, slug: str, ep: int) -> None:
+        save_anime()
+
+    def delete_title(self, slug: str) -> None:
+        save_anime()
+
+    def export_json(self) -> None:
+        # anime.json и так актуален
+        pass
+
+    def stats_lines(self) -> list[str]:
+        st = ANIME_SNAPSHOT_STATS
+        return [f"\n📦 anime.snapshot: сохранений каталога {st['saves']}, записано снапшотов {st['written']}"]
+
+
+class SqliteCatalogStore(CatalogStore):
+    """
+    Каталог в SQLite: titles / genres / episodes / tracks.
+    Новая дорожка — один upsert тайтла и один upsert дорожки, а не перезапись всего каталога.
+    """
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS titles (
+            slug TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            status TEXT NOT NULL,
+            seq INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS titles_status ON titles (status);
+
+        CREATE TABLE IF NOT EXISTS genres (
+            slug TEXT NOT NULL,
+            genre TEXT NOT NULL,
+            pos INTEGER NOT NULL,
+            PRIMARY KEY (slug, genre)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS genres_genre ON genres (genre);
+
+        CREATE TABLE IF NOT EXISTS episodes (
+            slug TEXT NOT NULL,
+            ep INTEGER NOT NULL,
+            PRIMARY KEY (slug, ep)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS tracks (
+            slug TEXT NOT NULL,
+            ep INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            source TEXT NOT NULL,
+            skip TEXT,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (slug, ep, name)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.seq = 0
+        self.stats = {"writes": 0}
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            # читаем при старте в основном потоке, пишем — из потока персистентности
+            self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(self.SCHEMA)
+            # seq — общий счётчик порядка добавления для titles и tracks
+            row = self.conn.execute(
+                "SELECT MAX(m) FROM (SELECT MAX(seq) AS m FROM titles UNION ALL SELECT MAX(seq) FROM tracks)"
+            ).fetchone()
+            self.seq = row[0] or 0
+        return self.conn
+
+    def load(self) -> None:
+        global ANIME
+        conn = self.connect()
+
+        (count,) = conn.execute("SELECT COUNT(*) FROM titles").fetchone()
+        if not count and os.path.exists(ANIME_JSON_PATH):
+            # первая загрузка — переносим текущий anime.json в базу
+            load_anime()
+            self.import_all(ANIME)
+            print(f"Imported {ANIME_JSON_PATH} into {self.path}, items:", len(ANIME))
+            return
+
+        data: dict[str, dict] = {}
+        for slug, title, status in conn.execute("SELECT slug, title, status FROM titles ORDER BY seq"):
+            data[slug] = {"title": title, "genres": [], "status": status, "episodes": {}}
+        for slug, genre in conn.execute("SELECT slug, genre FROM genres ORDER BY slug, pos"):
+            if slug in data:
+                data[slug]["genres"].append(genre)
+        for slug, ep in conn.execute("SELECT slug, ep FROM episodes ORDER BY slug, ep"):
+            if slug in data:
+                data[slug]["episodes"][ep] = {"tracks": {}}
+        # порядок добавления сохраняем: от него зависят списки тайтлов
+        # и дорожка по умолчанию (первая у серии)
+        for slug, ep, name, source, skip in conn.execute(
+            "SELECT slug, ep, name, source, skip FROM tracks ORDER BY slug, ep, seq"
+        ):
+            ep_obj = data.get(slug, {}).get("episodes", {}).get(ep)
+            if ep_obj is not None:
+                ep_obj["tracks"][name] = {"source": source, "skip": skip}
+
+        ANIME = data
+        rebuild_catalog_indexes()
+        print(f"Loaded ANIME from {self.path}, items:", len(ANIME))
+
+    def _write_title(self, conn: sqlite3.Connection, slug: str, title: str, status: str, genres: list[str]) -> None:
+        self.seq += 1
+        conn.execute(
+            "INSERT INTO titles (slug, title, status, seq) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (slug) DO UPDATE SET title = excluded.title, status = excluded.status",
+            (slug, title, status, self.seq),
+        )
+        stored = [g for (g,) in conn.execute("SELECT genre FROM genres WHERE slug = ? ORDER BY pos", (slug,))]
+        if stored != genres:
+            conn.execute("DELETE FROM genres WHERE slug = ?", (slug,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO genres (slug, genre, pos) VALUES (?, ?, ?)",
+                [(slug, g, pos) for pos, g in enumerate(genres)],
+            )
+
+    def _write_track(self, conn: sqlite3.Connection, slug: str, ep: int, name: str, info: dict) -> None:
+        conn.execute("INSERT OR IGNORE INTO episodes (slug, ep) VALUES (?, ?)", (slug, ep))
+        self.seq += 1
+        conn.execute(
+            "INSERT INTO tracks (slug, ep, name, source, skip, seq) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (slug, ep, name) DO UPDATE SET source = excluded.source, skip = excluded.skip",
+            (slug, ep, name, info.get("source"), info.get("skip"), self.seq),
+        )
+
+    def import_all(self, anime_map: dict[str, dict]) -> None:
+        conn = self.connect()
+        with conn:
+            conn.execute("BEGIN")
+            for slug, anime in anime_map.items():
+                self._write_title(conn, slug, anime.get("title", ""), anime.get("status", "ongoing"), anime.get("genres", []))
+                for ep, ep_obj in anime.get("episodes", {}).items():
+                    for name, info in ep_obj.get("tracks", {}).items():
+                        self._write_track(conn, slug, ep, name, info)
+
+    def upsert_track(self, slug: str, ep: int, track_name: str) -> None:
+        anime = ANIME[slug]
+        submit_persist(
+            self._upsert_track_job,
+            slug,
+            anime.get("title", ""),
+            anime.get("status", "ongoing"),
+            list(anime.get("genres", [])),
+            ep,
+            track_name,
+            dict(anime["episodes"][ep]["tracks"][track_name]),
+        )
+
+    def _upsert_track_job(
+        self, slug: str, title: str, status: str, genres: list[str], ep: int, track_name: str, info: dict
+    ) -> None:
+        try:
+            conn = self.connect()
+            with conn:
+                conn.execute("BEGIN")
+                self._write_title(conn, slug, title, status, genres)
+                self._write_track(conn, slug, ep, track_name, info)
+            self.stats["writes"] += 1
+        except Exception as e:
+            print("Failed to upsert track into catalog db:", e)
+
+    def delete_episode(self, slug: str, ep: int) -> None:
+        submit_persist(self._delete_episode_job, slug, ep)
+
+    def _delete_episode_job(self, slug: str, ep: int) -> None:
+        try:
+            conn = self.connect()
+            with conn:
+                conn.execute("BEGIN")
+                conn.execute("DELETE FROM tracks WHERE slug = ? AND ep = ?", (slug, ep))
+                conn.execute("DELETE FROM episodes WHERE slug = ? AND ep = ?", (slug, ep))
+            self.stats["writes"] += 1
+        except Exception as e:
+            print("Failed to delete episode from catalog db:", e)
+
+    def delete_title(self, slug: str) -> None:
+        submit_persist(self._delete_title_job, slug)
+
+    def _delete_title_job(self, slug: str) -> None:
+        try:
+            conn = self.connect()
+            with conn:
+                conn.execute("BEGIN")
+                for table in ("tracks", "episodes", "genres", "titles"):
+                    conn.execute(f"DELETE FROM {table} WHERE slug = ?", (slug,))
+            self.stats["writes"] += 1
+        except Exception as e:
+            print("Failed to delete title from catalog db:", e)
+
+    def close(self) -> None:
+        submit_persist(self._close_job)
+
+    def _close_job(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def stats_lines(self) -> list[str]:
+        return [f"\n🗄 anime.db (sqlite):\nзаписей: {self.stats['writes']}"]
+
+
+class ShardedCatalogStore(CatalogStore):
+    """
+    Каталог по файлу на тайтл: <dir>/<slug>.shard.json + <dir>/manifest.json (порядок тайтлов).
+    Новая серия переписывает только шард своего тайтла; manifest — только когда
+    появился или пропал тайтл. Шарды при старте читаются параллельно.
+    """
+    name = "sharded"
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path: str, workers: int):
+        self.path = path
+        self.workers = workers
+        self.stats = {"shard_writes": 0, "manifest_writes": 0}
+        # какие шарды уже есть на диске (смотрим на них из event loop, а не в файловую систему)
+        self.known: set[str] = set()
+
+    def _shard_path(self, slug: str) -> str:
+        # slug приходит из подписи к видео — экранируем, чтобы не вылезти из папки,
+        # а свой суффикс не даёт тайтлу "manifest" затереть manifest.json
+        return os.path.join(self.path, quote(slug, safe="") + ".shard.json")
+
+    def _legacy_shard_path(self, slug: str) -> Optional[str]:
+        """Старое имя шарда <slug>.json — читаем, пока тайтл не перезапишется."""
+        path = os.path.join(self.path, quote(slug, safe="") + ".json")
+        return None if path == self._manifest_path() else path
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.path, self.MANIFEST)
+
+    def _read_shard(self, slug: str) -> Optional[dict]:
+        path = self._shard_path(slug)
+        if not os.path.exists(path):
+            path = self._legacy_shard_path(slug) or path
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return _normalize_anime_entry(json.load(f))
+        except Exception as e:
+            print(f"Failed to load shard {slug}:", e)
+            return None
+
+    def load(self) -> None:
+        global ANIME
+        if not os.path.exists(self._manifest_path()):
+            # первая загрузка — раскладываем текущий anime.json по шардам
+            load_anime()
+            os.makedirs(self.path, exist_ok=True)
+            for slug in ANIME:
+                self._write_shard(slug, _anime_entry_to_json(ANIME[slug]))
+            self._write_manifest(list(ANIME.keys()))
+            self.known = set(ANIME.keys())
+            print(f"Split {ANIME_JSON_PATH} into {self.path}, items:", len(ANIME))
+            return
+
+        try:
+            with open(self._manifest_path(), "r", encoding="utf-8") as f:
+                slugs = json.load(f).get("slugs", [])
+        except Exception as e:
+            print("Failed to load shards manifest:", e)
+            ANIME = {}
+            rebuild_catalog_indexes()
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            entries = list(pool.map(self._read_shard, slugs))
+
+        ANIME = {slug: entry for slug, entry in zip(slugs, entries) if entry is not None}
+        self.known = set(ANIME.keys())
+        rebuild_catalog_indexes()
+        print(f"Loaded ANIME from {self.path}, items:", len(ANIME))
+
+    def _write_shard(self, slug: str, entry: dict) -> None:
+        try:
+            _atomic_write_text(
+                self._shard_path(slug),
+                json.dumps(entry, ensure_ascii=False, indent=2),
+            )
+            self.stats["shard_writes"] += 1
+        except Exception as e:
+            print(f"Failed to save shard {slug}:", e)
+
+    def _write_manifest(self, slugs: list[str]) -> None:
+        try:
+            _atomic_write_text(
+                self._manifest_path(),
+                json.dumps({"slugs": slugs}, ensure_ascii=False, indent=2),
+            )
+            self.stats["manifest_writes"] += 1
+        except Exception as e:
+            print("Failed to save shards manifest:", e)
+
+    def _remove_shard(self, slug: str) -> None:
+        try:
+            for path in (self._shard_path(slug), self._legacy_shard_path(slug)):
+                if path and os.path.exists(path):
+                    os.remove(path)
+        except Exception as e:
+            print(f"Failed to delete shard {slug}:", e)
+
+    def upsert_track(self, slug: str, ep: int, track_name: str) -> None:
+        submit_persist(self._write_shard, slug, _anime_entry_to_json(ANIME[slug]))
+        if slug not in self.known:
+            self.known.add(slug)
+            submit_persist(self._write_manifest, list(ANIME.keys()))
+
+    def delete_episode(self, slug: str, ep: int) -> None:
+        submit_persist(self._write_shard, slug, _anime_entry_to_json(ANIME[slug]))
+
+    def delete_title(self, slug: str) -> None:
+        self.known.discard(slug)
+        # сначала manifest без тайтла, потом сам файл — тогда упасть посередине безопасно
+        submit_persist(self._write_manifest, list(ANIME.keys()))
+        submit_persist(self._remove_shard, slug)
+
+    def stats_lines(self) -> list[str]:
+        st = self.stats
+        return [
+            f"\n🗂 {self.path} (шарды):\n"
+            f"записей шардов: {st['shard_writes']}, manifest: {st['manifest_writes']}"
+        ]
+
+
+def create_catalog_store() -> CatalogStore:
+    if CATALOG_BACKEND == "sqlite":
+        return SqliteCatalogStore(CATALOG_DB_PATH)
+    if CATALOG_BACKEND == "sharded":
+        return ShardedCatalogStore(CATALOG_SHARDS_DIR, CATALOG_LOAD_WORKERS)
+    return JsonCatalogStore()
+
+
+CATALOG_STORE: CatalogStore = JsonCatalogStore()
+# ===============================
+# JSON SAVE/LOAD: USERS
+# ===============================
+def load_users() -> None:
+    """
+    Грузим снапшот users.json и докатываем поверх него журнал изменений.
+    """
+    _load_users_snapshot()
+    if USERS_JOURNAL_ENABLED:
+        replay_users_journal()
+
+
+def _load_users_snapshot() -> None:
+    global USER_PROGRESS, USER_FAVORITES, USER_WATCHED_TITLES, CURRENT_TRACK
+    global _USERS_JOURNAL_SEQ
+    _USERS_JOURNAL_SEQ = 0
+    if not os.path.exists(USERS_JSON_PATH):
+        USER_PROGRESS = {}
+        USER_FAVORITES = {}
+        USER_WATCHED_TITLES = {}
+        CURRENT_TRACK = {}
+        return
+
+    try:
+        with open(USERS_JSON_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        # progress: user_id -> {slug: ep}
+        USER_PROGRESS = {}
+        for user_id_str, prog_map in data.get("progress", {}).items():
+            try:
+                user_id = int(user_id_str)
+            except ValueError:
+                continue
+            if isinstance(prog_map, dict):
+                res = {}
+                for slug, ep in prog_map.items():
+                    if isinstance(slug, str) and isinstance(ep, int):
+                        res[slug] = ep
+                if res:
+                    USER_PROGRESS[user_id] = res
+
+        # favorites: user_id -> [slug, ...]
+        USER_FAVORITES = {}
+        for user_id_str, fav_list in data.get("favorites", {}).items():
+            try:
+                user_id = int(user_id_str)
+            except ValueError:
+                continue
+            if isinstance(fav_list, list):
+                USER_FAVORITES[user_id] = set(
+                    [slug for slug in fav_list if isinstance(slug, str)]
+                )
+            else:
+                USER_FAVORITES[user_id] = set()
+
+        # watched_titles: user_id -> [slug, ...]
+        USER_WATCHED_TITLES = {}
+        for user_id_str, wt_list in data.get("watched_titles", {}).items():
+            try:
+                user_id = int(user_id_str)
+            except ValueError:
+                continue
+            if isinstance(wt_list, list):
+                USER_WATCHED_TITLES[user_id] = set(
+                    [slug for slug in wt_list if isinstance(slug, str)]
+                )
+            else:
+                USER_WATCHED_TITLES[user_id] = set()
+
+        # current_track: user_id -> {slug: track_name}
+        CURRENT_TRACK = {}
+        for user_id_str, track_map in data.get("current_track", {}).items():
+            try:
+                user_id = int(user_id_str)
+            except ValueError:
+                continue
+            if isinstance(track_map, dict):
+                res = {}
+                for slug, tname in track_map.items():
+                    if isinstance(slug, str) and isinstance(tname, str):
+                        res[slug] = tname
+                if res:
+                    CURRENT_TRACK[user_id] = res
+
+        _USERS_JOURNAL_SEQ = int(data.get("journal_seq", 0) or 0)
+
+        print("Loaded users from users.json")
+
+    except Exception as e:
+        print("Failed to load users.json:", e)
+        USER_PROGRESS = {}
+        USER_FAVORITES = {}
+        USER_WATCHED_TITLES = {}
+        CURRENT_TRACK = {}
+
+
+def _users_snapshot() -> dict:
+    """
+    Копия пользовательских данных в формате users.json.
+    Снимается в event loop (дёшево), а сериализуется и пишется уже в потоке персистентности.
+    """
+    data_to_save = {
+        "progress": {},
+        "favorites": {},
+        "watched_titles": {},
+        "current_track": {},
+        # до какой записи журнала включительно этот снапшот актуален
+        "journal_seq": _USERS_JOURNAL_SEQ,
+    }
+
+    # progress: user_id -> {slug: ep}
+    for user_id, prog_map in USER_PROGRESS.items():
+        data_to_save["progress"][str(user_id)] = dict(prog_map)
+
+    # favorites
+    for user_id, fav_set in USER_FAVORITES.items():
+        data_to_save["favorites"][str(user_id)] = list(fav_set)
+
+    # watched titles
+    for user_id, wt_set in USER_WATCHED_TITLES.items():
+        data_to_save["watched_titles"][str(user_id)] = list(wt_set)
+
+    # current_track
+    for user_id, track_map in CURRENT_TRACK.items():
+        data_to_save["current_track"][str(user_id)] = dict(track_map)
+
+    return data_to_save
+
+
+def _write_users_snapshot(data_to_save: dict) -> bool:
+    try:
+        _atomic_write_text(
+            USERS_JSON_PATH,
+            json.dumps(data_to_save, ensure_ascii=False, indent=2),
+            fsync=USERS_FSYNC != "never",
+        )
+        return True
+
+    except Exception as e:
+        print("Failed to save users.json:", e)
+        return False
+
+
+def save_users() -> bool:
+    """Синхронно сохранить users.json (миграция, бенчмарки)."""
+    return _write_users_snapshot(_users_snapshot())
+
+
+def _atomic_write_bytes(path: str, data: bytes, fsync: bool = True) -> None:
+    """
+    Пишем во временный файл рядом и атомарно подменяем им целевой,
+    чтобы при падении посреди записи на диске остался старый целый файл.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _atomic_write_text(path: str, text: str, fsync: bool = True) -> None:
+    _atomic_write_bytes(path, text.encode("utf-8"), fsync=fsync)
+
+
+# ===============================
+# USERS JOURNAL: append-only лог изменений
+# ===============================
+# Каждая строка — [seq, op, user_id, slug, value].
+# Снапшот users.json хранит journal_seq, поэтому записи, которые уже
+# в снапшоте (например, упали между компакцией и обрезкой журнала), пропускаем.
+_USERS_JOURNAL_SEQ = 0
+_USERS_JOURNAL_FILE = None
+
+USERS_JOURNAL_STATS = {
+    "appends": 0,
+    "replayed": 0,
+    "compactions": 0,
+}
+
+
+def _apply_user_op(op: str, user_id: Optional[int], slug: str, value=None) -> None:
+    """
+    Применяет одно изменение к in-memory состоянию (и при работе, и при replay журнала).
+    """
+    if op == "progress":
+        USER_PROGRESS.setdefault(user_id, {})[slug] = value
+    elif op == "progress_del":
+        prog = USER_PROGRESS.get(user_id)
+        if prog and slug in prog:
+            del prog[slug]
+            if not prog:
+                del USER_PROGRESS[user_id]
+    elif op == "fav_add":
+        USER_FAVORITES.setdefault(user_id, set()).add(slug)
+    elif op == "fav_del":
+        USER_FAVORITES.setdefault(user_id, set()).discard(slug)
+    elif op == "watched_add":
+        USER_WATCHED_TITLES.setdefault(user_id, set()).add(slug)
+    elif op == "watched_del":
+        USER_WATCHED_TITLES.setdefault(user_id, set()).discard(slug)
+    elif op == "track":
+        CURRENT_TRACK.setdefault(user_id, {})[slug] = value
+    elif op == "purge":
+        # тайтл удалён — чистим его у всех пользователей
+        for uid in list(USER_PROGRESS.keys()):
+            if slug in USER_PROGRESS[uid]:
+                del USER_PROGRESS[uid][slug]
+                if not USER_PROGRESS[uid]:
+                    del USER_PROGRESS[uid]
+
+        for uid in list(USER_FAVORITES.keys()):
+            USER_FAVORITES[uid].discard(slug)
+
+        for uid in list(USER_WATCHED_TITLES.keys()):
+            USER_WATCHED_TITLES[uid].discard(slug)
+
+        for uid in list(CURRENT_TRACK.keys()):
+            if slug in CURRENT_TRACK[uid]:
+                del CURRENT_TRACK[uid][slug]
+                if not CURRENT_TRACK[uid]:
+                    del CURRENT_TRACK[uid]
+
+
+def _journal_append(op: str, user_id: Optional[int], slug: str, value=None) -> None:
+    global _USERS_JOURNAL_SEQ
+    # seq назначаем в event loop, а саму запись отдаём в поток персистентности
+    _USERS_JOURNAL_SEQ += 1
+    line = json.dumps([_USERS_JOURNAL_SEQ, op, user_id, slug, value], ensure_ascii=False)
+    submit_persist(_journal_write, line)
+
+
+def _journal_write(line: str) -> None:
+    global _USERS_JOURNAL_FILE
+    try:
+        if _USERS_JOURNAL_FILE is None:
+            _USERS_JOURNAL_FILE = open(USERS_JOURNAL_PATH, "a", encoding="utf-8")
+        _USERS_JOURNAL_FILE.write(line + "\n")
+        _USERS_JOURNAL_FILE.flush()
+        if USERS_FSYNC == "always":
+            os.fsync(_USERS_JOURNAL_FILE.fileno())
+        USERS_JOURNAL_STATS["appends"] += 1
+    except Exception as e:
+        print("Failed to append users.journal:", e)
+
+
+def replay_users_journal() -> None:
+    """
+    Докатываем журнал поверх загруженного снапшота.
+    Недописанная последняя строка (упали посреди записи) — конец журнала: её обрезаем,
+    иначе следующая запись приклеится к обрывку и при следующем старте всё после него потеряется.
+    """
+    global _USERS_JOURNAL_SEQ
+    if not os.path.exists(USERS_JOURNAL_PATH):
+        return
+
+    replayed = 0
+    # конец последней целой строки
+    good_end = 0
+    torn = False
+    try:
+        with open(USERS_JOURNAL_PATH, "rb") as f:
+            for raw in f:
+                try:
+                    seq, op, user_id, slug, value = json.loads(raw)
+                except (ValueError, TypeError):
+                    torn = True
+                    break
+                if not raw.endswith(b"\n"):
+                    # запись целая, но без перевода строки — допишем его ниже
+                    torn = True
+                good_end += len(raw)
+                if seq <= _USERS_JOURNAL_SEQ:
+                    continue
+                _apply_user_op(op, user_id, slug, value)
+                _USERS_JOURNAL_SEQ = seq
+                replayed += 1
+        if torn:
+            with open(USERS_JOURNAL_PATH, "r+b") as f:
+                f.truncate(good_end)
+                if good_end:
+                    f.seek(good_end - 1)
+                    if f.read(1) != b"\n":
+                        f.seek(good_end)
+                        f.write(b"\n")
+            print(f"Truncated torn tail of users.journal at {good_end} bytes")
+    except Exception as e:
+        print("Failed to replay users.journal:", e)
+
+    USERS_JOURNAL_STATS["replayed"] = replayed
+    if replayed:
+        print(f"Replayed users.journal: {replayed} mutation(s)")
+
+
+def _journal_size() -> int:
+    try:
+        return os.path.getsize(USERS_JOURNAL_PATH)
+    except OSError:
+        return 0
+
+
+def _sync_users_journal() -> bool:
+    if _USERS_JOURNAL_FILE is None:
+        return True
+    try:
+        _USERS_JOURNAL_FILE.flush()
+        if USERS_FSYNC == "batch":
+            os.fsync(_USERS_JOURNAL_FILE.fileno())
+        return True
+    except Exception as e:
+        print("Failed to sync users.journal:", e)
+        return False
+
+
+def compact_users() -> bool:
+    """Синхронно свернуть журнал в users.json (миграция)."""
+    return _compact_users_job(_users_snapshot())
+
+
+def _compact_users_job(data_to_save: dict) -> bool:
+    """
+    Сворачиваем журнал в users.json: пишем снапшот атомарно, потом обрезаем журнал.
+    Выполняется в потоке персистентности: строки журнала, поставленные в очередь
+    до снапшота, уже записаны, а после — ещё нет, поэтому обрезка ничего не теряет.
+    """
+    global _USERS_JOURNAL_FILE
+    if not _write_users_snapshot(data_to_save):
+        return False
+    if not USERS_JOURNAL_ENABLED:
+        return True
+
+    try:
+        if _USERS_JOURNAL_FILE is not None:
+            _USERS_JOURNAL_FILE.close()
+        _USERS_JOURNAL_FILE = open(USERS_JOURNAL_PATH, "w", encoding="utf-8")
+    except Exception as e:
+        print("Failed to truncate users.journal:", e)
+        _USERS_JOURNAL_FILE = None
+    USERS_JOURNAL_STATS["compactions"] += 1
+    return True
+
+
+def close_users_journal() -> None:
+    submit_persist(_close_users_journal_file)
+
+
+def _close_users_journal_file() -> None:
+    global _USERS_JOURNAL_FILE
+    if _USERS_JOURNAL_FILE is not None:
+        _sync_users_journal()
+        _USERS_JOURNAL_FILE.close()
+        _USERS_JOURNAL_FILE = None
+
+
+# ===============================
+# USER STORAGE: интерфейс и бэкенды
+# ===============================
+class UserStore(ABC):
+    """
+    Хранилище пользовательских данных.
+    Словари USER_PROGRESS / USER_FAVORITES / USER_WATCHED_TITLES / CURRENT_TRACK —
+    это in-memory вид на хранилище: ensure_user() гарантирует, что данные
+    пользователя загружены, record() сохраняет одно уже применённое изменение.
+    """
+    name = "base"
+
+    @abstractmethod
+    def load(self) -> None:
+        ...
+
+    def ensure_user(self, user_id: int) -> None:
+        pass
+
+    @abstractmethod
+    def record(self, op: str, user_id: Optional[int], slug: str, value=None) -> None:
+        ...
+
+    @abstractmethod
+    def export_json(self) -> None:
+        """
+        Выгрузить актуальное состояние в users.json (для /dump_all).
+        Запись асинхронная — дождаться её можно через wait_persist().
+        """
+
+    def close(self) -> None:
+        pass
+
+    def stats_lines(self) -> list[str]:
+        return []
+
+
+class JsonUserStore(UserStore):
+    """
+    Всё в памяти, на диске — снапшот users.json + журнал users.journal
+    с отложенной записью (write-behind).
+    """
+    name = "json"
+
+    def load(self) -> None:
+        load_users()
+
+    def record(self, op: str, user_id: Optional[int], slug: str, value=None) -> None:
+        if USERS_JOURNAL_ENABLED:
+            _journal_append(op, user_id, slug, value)
+        mark_users_dirty()
+
+    def export_json(self) -> None:
+        flush_users(force_snapshot=True)
+
+    def close(self) -> None:
+        # последний принудительный flush, чтобы не потерять прогресс при рестарте
+        flush_users(force_snapshot=True)
+        close_users_journal()
+
+    def stats_lines(self) -> list[str]:
+        fs = USERS_FLUSH_STATS
+        avg_ms = fs["total_ms"] / fs["flushes"] if fs["flushes"] else 0.0
+        lines = [
+            "\n💾 users.json (write-behind):\n"
+            f"ожидают записи: {_USERS_DIRTY}\n"
+            f"flush'ей: {fs['flushes']}, изменений: {fs['mutations']}\n"
+            f"время flush: посл. {fs['last_ms']:.1f} мс, ср. {avg_ms:.1f} мс, макс. {fs['max_ms']:.1f} мс\n"
+            f"схлопнуто за flush: посл. {fs['last_coalesced']}, макс. {fs['max_coalesced']}"
+        ]
+        if USERS_JOURNAL_ENABLED:
+            js = USERS_JOURNAL_STATS
+            lines.append(
+                "\n📒 Журнал users.journal:\n"
+                f"seq: {_USERS_JOURNAL_SEQ}, размер: {_journal_size()} байт\n"
+                f"записей: {js['appends']}, докатано при старте: {js['replayed']}, компакций: {js['compactions']}"
+            )
+        return lines
+
+
+class SqliteUserStore(UserStore):
+    """
+    SQLite (WAL): каждое изменение — одна строка, пользователи читаются
+    лениво при первом обращении, в памяти держим только LRU горячих.
+    """
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS progress (
+            user_id INTEGER NOT NULL,
+            slug TEXT NOT NULL,
+            ep INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (user_id, slug)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS progress_slug ON progress (slug);
+
+        CREATE TABLE IF NOT EXISTS favorites (
+            user_id INTEGER NOT NULL,
+            slug TEXT NOT NULL,
+            PRIMARY KEY (user_id, slug)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS favorites_slug ON favorites (slug);
+
+        CREATE TABLE IF NOT EXISTS watched (
+            user_id INTEGER NOT NULL,
+            slug TEXT NOT NULL,
+            PRIMARY KEY (user_id, slug)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS watched_slug ON watched (slug);
+
+        CREATE TABLE IF NOT EXISTS current_track (
+            user_id INTEGER NOT NULL,
+            slug TEXT NOT NULL,
+            track TEXT NOT NULL,
+            PRIMARY KEY (user_id, slug)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS current_track_slug ON current_track (slug);
+    """
+
+    # op -> SQL; у progress seq сохраняет порядок вставки (как у dict),
+    # при обновлении серии позиция тайтла в "Продолжить" не меняется
+    SQL = {
+        "progress": (
+            "INSERT INTO progress (user_id, slug, ep, seq) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id, slug) DO UPDATE SET ep = excluded.ep"
+        ),
+        "progress_del": "DELETE FROM progress WHERE user_id = ? AND slug = ?",
+        "fav_add": "INSERT OR IGNORE INTO favorites (user_id, slug) VALUES (?, ?)",
+        "fav_del": "DELETE FROM favorites WHERE user_id = ? AND slug = ?",
+        "watched_add": "INSERT OR IGNORE INTO watched (user_id, slug) VALUES (?, ?)",
+        "watched_del": "DELETE FROM watched WHERE user_id = ? AND slug = ?",
+        "track": (
+            "INSERT INTO current_track (user_id, slug, track) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, slug) DO UPDATE SET track = excluded.track"
+        ),
+    }
+
+    def __init__(self, path: str, cache_size: int):
+        self.path = path
+        self.cache_size = cache_size
+        # conn пишет (из потока персистентности), reader читает (из event loop) — WAL это позволяет
+        self.conn: Optional[sqlite3.Connection] = None
+        self.reader: Optional[sqlite3.Connection] = None
+        self.hot: OrderedDict[int, None] = OrderedDict()
+        self.seq = 0
+        # номер последней поставленной записи по пользователю и последней выполненной —
+        # пользователя с незаписанными изменениями из памяти не вытесняем
+        self.write_no = 0
+        self.user_write_no: dict[int, int] = {}
+        self.done_write_no = 0
+        # (write_no, slug) поставленных, но, возможно, ещё не выполненных purge —
+        # холодный пользователь, прочитанный из базы раньше DELETE, получает их поверх
+        self.pending_purges: list[tuple[int, str]] = []
+        self.stats = {"hits": 0, "loads": 0, "evictions": 0, "writes": 0}
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            # isolation_level=None — autocommit: одно изменение = одна короткая транзакция
+            self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(self.SCHEMA)
+            row = self.conn.execute("SELECT MAX(seq) FROM progress").fetchone()
+            self.seq = row[0] or 0
+        return self.conn
+
+    def connect_reader(self) -> sqlite3.Connection:
+        if self.reader is None:
+            self.connect()
+            self.reader = sqlite3.connect(self.path, isolation_level=None)
+        return self.reader
+
+    def load(self) -> None:
+        global USER_PROGRESS, USER_FAVORITES, USER_WATCHED_TITLES, CURRENT_TRACK
+        self.connect_reader()
+        # в памяти пока никого — пользователи подтянутся при первом обращении
+        USER_PROGRESS = {}
+        USER_FAVORITES = {}
+        USER_WATCHED_TITLES = {}
+        CURRENT_TRACK = {}
+        self.hot.clear()
+        print(f"Opened users storage {self.path} (sqlite)")
+
+    def ensure_user(self, user_id: int) -> None:
+        if user_id in self.hot:
+            self.hot.move_to_end(user_id)
+            self.stats["hits"] += 1
+            return
+
+        self._load_user(user_id)
+        self._apply_pending_purges(user_id)
+        self.hot[user_id] = None
+        self.stats["loads"] += 1
+
+        for _ in range(len(self.hot)):
+            if len(self.hot) <= self.cache_size:
+                break
+            old_id = next(iter(self.hot))
+            if self.user_write_no.get(old_id, 0) > self.done_write_no:
+                # его изменения ещё в очереди на запись — вытесним позже
+                self.hot.move_to_end(old_id)
+                continue
+            del self.hot[old_id]
+            self.user_write_no.pop(old_id, None)
+            USER_PROGRESS.pop(old_id, None)
+            USER_FAVORITES.pop(old_id, None)
+            USER_WATCHED_TITLES.pop(old_id, None)
+            CURRENT_TRACK.pop(old_id, None)
+            self.stats["evictions"] += 1
+
+    def _load_user(self, user_id: int) -> None:
+        conn = self.connect_reader()
+        prog = {
+            slug: ep
+            for slug, ep in conn.execute(
+                "SELECT slug, ep FROM progress WHERE user_id = ? ORDER BY seq", (user_id,)
+            )
+        }
+        if prog:
+            USER_PROGRESS[user_id] = prog
+
+        favs = {slug for (slug,) in conn.execute("SELECT slug FROM favorites WHERE user_id = ?", (user_id,))}
+        if favs:
+            USER_FAVORITES[user_id] = favs
+
+        watched = {slug for (slug,) in conn.execute("SELECT slug FROM watched WHERE user_id = ?", (user_id,))}
+        if watched:
+            USER_WATCHED_TITLES[user_id] = watched
+
+        tracks = {
+            slug: track
+            for slug, track in conn.execute(
+                "SELECT slug, track FROM current_track WHERE user_id = ?", (user_id,)
+            )
+        }
+        if tracks:
+            CURRENT_TRACK[user_id] = tracks
+
+    def _apply_pending_purges(self, user_id: int) -> None:
+        done = self.done_write_no
+        self.pending_purges = [(no, slug) for no, slug in self.pending_purges if no > done]
+        for _, slug in self.pending_purges:
+            for table in (USER_PROGRESS, CURRENT_TRACK):
+                rows = table.get(user_id)
+                if rows and slug in rows:
+                    del rows[slug]
+                    if not rows:
+                        del table[user_id]
+            for table in (USER_FAVORITES, USER_WATCHED_TITLES):
+                rows = table.get(user_id)
+                if rows and slug in rows:
+                    rows.discard(slug)
+                    if not rows:
+                        del table[user_id]
+
+    def record(self, op: str, user_id: Optional[int], slug: str, value=None) -> None:
+        self.write_no += 1
+        if user_id is not None:
+            self.user_write_no[user_id] = self.write_no
+        elif op == "purge":
+            self.pending_purges.append((self.write_no, slug))
+        seq = None
+        if op == "progress":
+            self.seq += 1
+            seq = self.seq
+        submit_persist(self._write_job, self.write_no, op, user_id, slug, value, seq)
+
+    def _write_job(self, write_no: int, op: str, user_id: Optional[int], slug: str, value, seq: Optional[int]) -> None:
+        conn = self.connect()
+        try:
+            if op == "purge":
+                with conn:
+                    conn.execute("BEGIN")
+                    for table in ("progress", "favorites", "watched", "current_track"):
+                        conn.execute(f"DELETE FROM {table} WHERE slug = ?", (slug,))
+            elif op == "progress":
+                conn.execute(self.SQL[op], (user_id, slug, value, seq))
+            elif op == "track":
+                conn.execute(self.SQL[op], (user_id, slug, value))
+            else:
+                conn.execute(self.SQL[op], (user_id, slug))
+            self.stats["writes"] += 1
+        except Exception as e:
+            print(f"Failed to write users storage ({op}):", e)
+        finally:
+            self.done_write_no = write_no
+
+    def export_json(self) -> None:
+        submit_persist(self._export_json_job)
+
+    def _export_json_job(self) -> bool:
+        conn = self.connect()
+        data_to_save = {
+            "progress": {},
+            "favorites": {},
+            "watched_titles": {},
+            "current_track": {},
+            "journal_seq": _USERS_JOURNAL_SEQ,
+        }
+        try:
+            for user_id, slug, ep in conn.execute("SELECT user_id, slug, ep FROM progress ORDER BY user_id, seq"):
+                data_to_save["progress"].setdefault(str(user_id), {})[slug] = ep
+            for user_id, slug in conn.execute("SELECT user_id, slug FROM favorites"):
+                data_to_save["favorites"].setdefault(str(user_id), []).append(slug)
+            for user_id, slug in conn.execute("SELECT user_id, slug FROM watched"):
+                data_to_save["watched_titles"].setdefault(str(user_id), []).append(slug)
+            for user_id, slug, track in conn.execute("SELECT user_id, slug, track FROM current_track"):
+                data_to_save["current_track"].setdefault(str(user_id), {})[slug] = track
+
+            _atomic_write_text(
+                USERS_JSON_PATH,
+                json.dumps(data_to_save, ensure_ascii=False, indent=2),
+                fsync=USERS_FSYNC != "never",
+            )
+            return True
+        except Exception as e:
+            print("Failed to export users.json:", e)
+            return False
+
+    def close(self) -> None:
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        submit_persist(self._close_job)
+
+    def _close_job(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def stats_lines(self) -> list[str]:
+        st = self.stats
+        return [
+            "\n🗄 users.db (sqlite):\n"
+            f"в памяти: {len(self.hot)} / {self.cache_size}\n"
+            f"попаданий: {st['hits']}, загрузок: {st['loads']}, вытеснено: {st['evictions']}\n"
+            f"записей строк: {st['writes']}"
+        ]
+
+
+def create_user_store() -> UserStore:
+    if USERS_BACKEND == "sqlite":
+        return SqliteUserStore(USERS_DB_PATH, USERS_CACHE_SIZE)
+    return JsonUserStore()
+
+
+USER_STORE: UserStore = JsonUserStore()
+
+
+def migrate_users_to_sqlite(db_path: str = USERS_DB_PATH) -> None:
+    """
+    Импорт users.json (+ недосвёрнутый журнал) в SQLite.
+    Запуск: python bot.py migrate_users [путь_к_users.db]
+    """
+    load_users()
+    if USERS_JOURNAL_ENABLED and _journal_size():
+        # сворачиваем журнал, чтобы users.json и база совпадали
+        compact_users()
+        close_users_journal()
+
+    store = SqliteUserStore(db_path, USERS_CACHE_SIZE)
+    conn = store.connect()
+    with conn:
+        conn.execute("BEGIN")
+        seq = store.seq
+        for user_id, prog in USER_PROGRESS.items():
+            for slug, ep in prog.items():
+                seq += 1
+                conn.execute(
+                    "INSERT OR REPLACE INTO progress (user_id, slug, ep, seq) VALUES (?, ?, ?, ?)",
+                    (user_id, slug, ep, seq),
+                )
+        conn.executemany(
+            "INSERT OR IGNORE INTO favorites (user_id, slug) VALUES (?, ?)",
+            [(uid, slug) for uid, favs in USER_FAVORITES.items() for slug in favs],
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO watched (user_id, slug) VALUES (?, ?)",
+            [(uid, slug) for uid, wt in USER_WATCHED_TITLES.items() for slug in wt],
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO current_track (user_id, slug, track) VALUES (?, ?, ?)",
+            [(uid, slug, t) for uid, tracks in CURRENT_TRACK.items() for slug, t in tracks.items()],
+        )
+    store.close()
+    print(
+        f"Migrated users.json -> {db_path}: "
+        f"progress {len(USER_PROGRESS)}, favorites {len(USER_FAVORITES)}, "
+        f"watched {len(USER_WATCHED_TITLES)}, current_track {len(CURRENT_TRACK)} user(s)"
+    )
+
+
+# ===============================
+# USER ACCESS
+# ===============================
+# Чтение — только через эти функции: они подтягивают пользователя из хранилища.
+def get_user_progress(user_id: int) -> dict[str, int]:
+    USER_STORE.ensure_user(user_id)
+    return USER_PROGRESS.get(user_id, {})
+
+
+def get_user_favorites(user_id: int) -> set[str]:
+    USER_STORE.ensure_user(user_id)
+    return USER_FAVORITES.get(user_id, set())
+
+
+def get_user_watched(user_id: int) -> set[str]:
+    USER_STORE.ensure_user(user_id)
+    return USER_WATCHED_TITLES.get(user_id, set())
+
+
+def get_user_tracks(user_id: int) -> dict[str, str]:
+    USER_STORE.ensure_user(user_id)
+    return CURRENT_TRACK.get(user_id, {})
+
+
+# ===============================
+# USER MUTATIONS
+# ===============================
+# Все изменения пользовательских данных идут через эти функции:
+# применяем к памяти и сохраняем одно изменение через USER_STORE.
+def _record_user_op(op: str, user_id: Optional[int], slug: str, value=None) -> None:
+    if user_id is not None:
+        USER_STORE.ensure_user(user_id)
+    _apply_user_op(op, user_id, slug, value)
+    USER_STORE.record(op, user_id, slug, value)
+
+
+def set_user_progress(user_id: int, slug: str, ep: int) -> None:
+    _record_user_op("progress", user_id, slug, ep)
+    _ensure_continue_limit(user_id)
+
+
+def remove_user_progress(user_id: int, slug: str) -> bool:
+    if slug not in get_user_progress(user_id):
+        return False
+    _record_user_op("progress_del", user_id, slug)
+    return True
+
+
+def add_user_favorite(user_id: int, slug: str) -> None:
+    _record_user_op("fav_add", user_id, slug)
+
+
+def remove_user_favorite(user_id: int, slug: str) -> None:
+    _record_user_op("fav_del", user_id, slug)
+
+
+def add_user_watched(user_id: int, slug: str) -> None:
+    _record_user_op("watched_add", user_id, slug)
+
+
+def remove_user_watched(user_id: int, slug: str) -> None:
+    _record_user_op("watched_del", user_id, slug)
+
+
+def set_user_track(user_id: int, slug: str, track_name: str) -> None:
+    # озвучка переустанавливается при каждом показе серии — пишем только реальную смену
+    if get_user_tracks(user_id).get(slug) == track_name:
+        return
+    _record_user_op("track", user_id, slug, track_name)
+
+
+def purge_slug_from_users(slug: str) -> None:
+    _record_user_op("purge", None, slug)
+
+
+def _ensure_continue_limit(chat_id: int):
+    """
+    Удерживает USER_PROGRESS[chat_id] в размере не больше CONTINUE_LIMIT.
+    Если превысили — удаляем самый старый (первый вставленный) элемент.
+    ВАЖНО: dict сохраняет порядок вставки (py3.7+).
+    """
+    prog = USER_PROGRESS.get(chat_id)
+    if not prog:
+        return
+    while len(prog) > CONTINUE_LIMIT:
+        # удаляем первый элемент (самый старый)
+        oldest_slug = next(iter(prog.keys()))
+        remove_user_progress(chat_id, oldest_slug)
+
+
+# ===============================
+# WRITE-BEHIND: отложенное сохранение users.json
+# ===============================
+# Хэндлеры не пишут файл сами, а только помечают состояние "грязным".
+# Фоновый flusher сбрасывает накопленные изменения одним снапшотом.
+_USERS_DIRTY = 0
+_USERS_DIRTY_EVENT: Optional[asyncio.Event] = None
+_USERS_FLUSHER_TASK: Optional[asyncio.Task] = None
+
+USERS_FLUSH_STATS = {
+    "flushes": 0,
+    "mutations": 0,       # сколько изменений всего ушло на диск
+    "last_ms": 0.0,
+    "max_ms": 0.0,
+    "total_ms": 0.0,
+    "last_coalesced": 0,  # сколько изменений схлопнул последний flush
+    "max_coalesced": 0,
+}
+
+
+def mark_users_dirty() -> None:
+    """
+    Отмечаем, что пользовательские данные изменились.
+    Если flusher не запущен (например, бот ещё не стартовал) — пишем сразу.
+    """
+    global _USERS_DIRTY
+    _USERS_DIRTY += 1
+    if _USERS_FLUSHER_TASK is None:
+        flush_users()
+        return
+    if _USERS_DIRTY >= USERS_FLUSH_MAX_DIRTY and _USERS_DIRTY_EVENT is not None:
+        _USERS_DIRTY_EVENT.set()
+
+
+def flush_users(force_snapshot: bool = False) -> None:
+    """
+    Сбрасывает накопленные изменения на диск.
+    - без журнала: один снапшот users.json на все накопленные изменения;
+    - с журналом: изменения уже в журнале, здесь только fsync (политика "batch")
+      и компакция, если журнал перерос USERS_JOURNAL_COMPACT_BYTES.
+    force_snapshot=True — всегда свернуть всё в users.json (при остановке, /dump_all).
+    Если сохранить не удалось — счётчик изменений остаётся, попробуем в следующий раз.
+    """
+    global _USERS_DIRTY
+    coalesced = _USERS_DIRTY
+    if not coalesced and not (force_snapshot and _journal_size()):
+        return
+    _USERS_DIRTY = 0
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    if (
+        USERS_JOURNAL_ENABLED
+        and not force_snapshot
+        and _journal_size() < USERS_JOURNAL_COMPACT_BYTES
+    ):
+        submit_persist(_run_users_flush, loop, coalesced, _sync_users_journal)
+    else:
+        # снапшот снимаем здесь, в event loop, — пишется он уже в потоке персистентности
+        submit_persist(_run_users_flush, loop, coalesced, _compact_users_job, _users_snapshot())
+
+
+def _requeue_users_dirty(count: int) -> None:
+    global _USERS_DIRTY
+    _USERS_DIRTY += count
+
+
+def _run_users_flush(loop, coalesced: int, job, *args) -> None:
+    started = time.perf_counter()
+    ok = job(*args)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    if not ok:
+        # не записалось — вернём изменения в счётчик (в потоке event loop), попробуем снова
+        if loop is not None:
+            loop.call_soon_threadsafe(_requeue_users_dirty, coalesced)
+        else:
+            _requeue_users_dirty(coalesced)
+        return
+
+    stats = USERS_FLUSH_STATS
+    stats["flushes"] += 1
+    stats["mutations"] += coalesced
+    stats["last_ms"] = elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+    stats["total_ms"] += elapsed_ms
+    stats["last_coalesced"] = coalesced
+    stats["max_coalesced"] = max(stats["max_coalesced"], coalesced)
+    if elapsed_ms >= USERS_FLUSH_SLOW_MS:
+        print(f"Slow users flush: {coalesced} mutation(s) in {elapsed_ms:.1f} ms")
+
+
+async def _users_flusher_loop() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_USERS_DIRTY_EVENT.wait(), timeout=USERS_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _USERS_DIRTY_EVENT.clear()
+        flush_users()
+
+
+def start_users_flusher() -> None:
+    global _USERS_DIRTY_EVENT, _USERS_FLUSHER_TASK
+    if _USERS_FLUSHER_TASK is not None:
+        return
+    _USERS_DIRTY_EVENT = asyncio.Event()
+    _USERS_FLUSHER_TASK = asyncio.create_task(_users_flusher_loop())
+
+
+# ===============================
+# LOOP MONITOR: сколько event loop простаивает заблокированным
+# ===============================
+# Задача просыпается каждые LOOP_LAG_INTERVAL секунд; опоздание пробуждения —
+# это время, на которое кто-то занял event loop синхронной работой.
+_LOOP_MONITOR_TASK: Optional[asyncio.Task] = None
+
+LOOP_LAG_STATS = {
+    "samples": 0,
+    "total_ms": 0.0,
+    "max_ms": 0.0,
+    "stalls": 0,  # опозданий больше LOOP_STALL_MS
+}
+
+
+async def _loop_lag_monitor() -> None:
+    stats = LOOP_LAG_STATS
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag_ms = max(0.0, (time.perf_counter() - started - LOOP_LAG_INTERVAL) * 1000)
+        stats["samples"] += 1
+        stats["total_ms"] += lag_ms
+        stats["max_ms"] = max(stats["max_ms"], lag_ms)
+        if lag_ms >= LOOP_STALL_MS:
+            stats["stalls"] += 1
+
+
+def start_loop_monitor() -> None:
+    global _LOOP_MONITOR_TASK
+    if _LOOP_MONITOR_TASK is None:
+        _LOOP_MONITOR_TASK = asyncio.create_task(_loop_lag_monitor())
+
+
+async def stop_loop_monitor() -> None:
+    global _LOOP_MONITOR_TASK
+    task = _LOOP_MONITOR_TASK
+    _LOOP_MONITOR_TASK = None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+async def stop_users_flusher() -> None:
+    """
+    Останавливаем flusher. Всё, что не успело уйти на диск, сбрасывает USER_STORE.close().
+    """
+    global _USERS_DIRTY_EVENT, _USERS_FLUSHER_TASK
+    task = _USERS_FLUSHER_TASK
+    _USERS_FLUSHER_TASK = None
+    _USERS_DIRTY_EVENT = None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+# ===============================
+# SESSIONS: вытеснение простаивающих чатов
+# ===============================
+_SESSION_SWEEPER_TASK: Optional[asyncio.Task] = None
+
+
+def evict_sessions(now: Optional[float] = None) -> int:
+    """
+    Выкидываем сессии, простаивающие дольше SESSION_TTL, и самые старые сверх SESSION_MAX_COUNT.
+    SESSIONS упорядочен по активности, поэтому смотрим только его начало.
+    """
+    deadline = (time.time() if now is None else now) - SESSION_TTL
+    evicted = 0
+    while SESSIONS:
+        chat_id = next(iter(SESSIONS))
+        if SESSIONS[chat_id].last_active >= deadline:
+            break
+        SESSIONS.popitem(last=False)
+        _SESSIONS_DIRTY.add(chat_id)
+        SESSION_STATS["evicted_ttl"] += 1
+        evicted += 1
+    while len(SESSIONS) > SESSION_MAX_COUNT:
+        chat_id, _ = SESSIONS.popitem(last=False)
+        _SESSIONS_DIRTY.add(chat_id)
+        SESSION_STATS["evicted_lru"] += 1
+        evicted += 1
+    return evicted
+
+
+def session_memory() -> int:
+    """Сколько байт занимают сессии: объекты, кортежи render, ключи и сам SESSIONS."""
+    total = sys.getsizeof(SESSIONS)
+    for chat_id, s in SESSIONS.items():
+        total += sys.getsizeof(chat_id) + sys.getsizeof(s)
+        if s.render is not None:
+            total += sys.getsizeof(s.render)
+    return total
+
+
+# снапшот sessions.json: в event loop собираем только изменившиеся чаты,
+# а полную таблицу держит и пишет persist-поток
+_SESSIONS_DIRTY: set[int] = set()
+# chat_id -> [chat_id, message_id, message_type, media, last_active]; трогает только persist-поток
+_SESSIONS_TABLE: dict[int, list] = {}
+
+SESSION_SNAPSHOT_STATS = {"snapshots": 0, "rows": 0, "last_ms": 0.0}
+
+
+def mark_session_dirty(chat_id: int) -> None:
+    """Сообщение бота в чате сменилось — попадёт в ближайший снапшот."""
+    _SESSIONS_DIRTY.add(chat_id)
+
+
+def load_sessions() -> None:
+    """Восстанавливаем сессии из sessions.json, пропуская истёкшие по SESSION_TTL."""
+    SESSIONS.clear()
+    _SESSIONS_DIRTY.clear()
+    _SESSIONS_TABLE.clear()
+    if not os.path.exists(SESSIONS_PATH):
+        return
+    try:
+        with open(SESSIONS_PATH, "r", encoding="utf-8") as f:
+            header = json.loads(f.readline() or "{}")
+            if header.get("version") != SESSIONS_SNAPSHOT_VERSION:
+                print("Ignoring sessions.json with unknown version:", header.get("version"))
+                return
+            # остальные строки — по JSON-массиву на чат; разбираем их одним json.loads
+            body = f.read().strip()
+        deadline = time.time() - SESSION_TTL
+        rows = [row for row in json.loads("[" + body.replace("\n", ",") + "]") if row[4] >= deadline]
+        rows.sort(key=lambda row: row[4])
+        for row in rows[-SESSION_MAX_COUNT:]:
+            chat_id, message_id, message_type, media, last_active = row
+            s = ChatSession()
+            s.message_id = message_id
+            s.message_type = message_type
+            if media is not None:
+                s.render = (message_id, media, None)
+            s.last_active = last_active
+            SESSIONS[chat_id] = s
+            _SESSIONS_TABLE[chat_id] = row
+        SESSION_STATS["restored"] = len(SESSIONS)
+        print(f"Restored chat sessions: {len(SESSIONS)}")
+    except Exception as e:
+        print("Failed to load sessions.json:", e)
+        SESSIONS.clear()
+        _SESSIONS_TABLE.clear()
 
-        print("Loaded users from users.json")
 
+def _write_sessions(changed: list) -> None:
+    table = _SESSIONS_TABLE
+    for row in changed:
+        if row[1] is None:
+            table.pop(row[0], None)
+        else:
+            table[row[0]] = row
+    deadline = time.time() - SESSION_TTL
+    for chat_id in [chat_id for chat_id, row in table.items() if row[4] < deadline]:
+        del table[chat_id]
+    try:
+        # по строке на чат: много мелких dumps, а не один большой, — event loop не ждёт GIL
+        lines = [json.dumps({"version": SESSIONS_SNAPSHOT_VERSION})]
+        lines.extend(json.dumps(row, ensure_ascii=False) for row in table.values())
+        # потерять пару последних переходов не страшно — fsync не нужен
+        _atomic_write_text(SESSIONS_PATH, "\n".join(lines) + "\n", fsync=False)
     except Exception as e:
-        print("Failed to load users.json:", e)
-        USER_PROGRESS = {}
-        USER_FAVORITES = {}
-        USER_WATCHED_TITLES = {}
-        CURRENT_TRACK = {}
+        print("Failed to save sessions.json:", e)
 
 
-def save_users() -> None:
-    try:
-        data_to_save = {
-            "progress": {},
-            "favorites": {},
-            "watched_titles": {},
-            "current_track": {},
+def save_sessions() -> bool:
+    """
+    Один пакет на все изменившиеся с прошлого раза чаты; запись — в persist-потоке.
+    Если ничего не менялось — ничего не делаем.
+    """
+    if not _SESSIONS_DIRTY:
+        return False
+    started = time.perf_counter()
+    changed = []
+    for chat_id in _SESSIONS_DIRTY:
+        s = SESSIONS.get(chat_id)
+        if s is None or not s.message_id:
+            # вытеснена или сообщения больше нет — строку удаляем
+            changed.append([chat_id, None, None, None, 0.0])
+            continue
+        render = s.render
+        media = render[1] if render is not None and render[0] == s.message_id else None
+        changed.append([chat_id, s.message_id, s.message_type, media, s.last_active])
+    _SESSIONS_DIRTY.clear()
+    stats = SESSION_SNAPSHOT_STATS
+    stats["snapshots"] += 1
+    stats["rows"] = len(changed)
+    stats["last_ms"] = (time.perf_counter() - started) * 1000
+    submit_persist(_write_sessions, changed)
+    return True
+
+
+async def _session_sweeper_loop() -> None:
+    # вытеснение и снапшот — каждое со своим интервалом
+    next_sweep = next_snapshot = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now >= next_sweep:
+            evict_sessions()
+            next_sweep = now + SESSION_SWEEP_INTERVAL
+        if now >= next_snapshot:
+            save_sessions()
+            next_snapshot = now + SESSION_SNAPSHOT_INTERVAL
+        await asyncio.sleep(max(0.0, min(next_sweep, next_snapshot) - time.monotonic()))
+
+
+def start_session_sweeper() -> None:
+    global _SESSION_SWEEPER_TASK
+    if _SESSION_SWEEPER_TASK is None:
+        _SESSION_SWEEPER_TASK = asyncio.create_task(_session_sweeper_loop())
+
+
+async def stop_session_sweeper() -> None:
+    global _SESSION_SWEEPER_TASK
+    task = _SESSION_SWEEPER_TASK
+    _SESSION_SWEEPER_TASK = None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+# ===============================
+# OUTBOUND: очередь исходящих запросов к Bot API
+# ===============================
+# Все вызовы context.bot.* проходят через OutboundScheduler (rate_limiter в ApplicationBuilder).
+# Запрос ждёт токен в общем ведре бота и в ведре своего чата; из ожидающих первым
+# уходит запрос с меньшим приоритетом (ответы на кнопки -> экраны пользователя -> фон).
+# RetryAfter не долетает до хэндлеров: чат (или весь бот) ставится на паузу,
+# запрос повторяется после неё.
+PRIORITY_URGENT = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+_PRIORITY_NAMES = {PRIORITY_URGENT: "срочные", PRIORITY_INTERACTIVE: "экраны", PRIORITY_BACKGROUND: "фон"}
+
+# у Telegram на эти ответы жёсткий таймаут, и лимитов по чату у них нет
+_URGENT_ENDPOINTS = {"answerCallbackQuery", "answerInlineQuery"}
+
+# сколько ведер чатов держим, прежде чем выкинуть простаивающие
+_OUTBOUND_MAX_CHATS = 4096
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд можно будет взять токен (0 — прямо сейчас)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = self.paused_until - now
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return max(wait, 0.0)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        return self.delay(now) == 0 and self.tokens >= self.capacity
+
+
+class OutboundScheduler(BaseRateLimiter[int]):
+    """rate_limit_args — приоритет запроса (PRIORITY_*), по умолчанию зависит от метода."""
+
+    def __init__(self):
+        self._global = _TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST)
+        self._chats: dict[object, _TokenBucket] = {}
+        # куча (приоритет, порядковый номер, chat_id, время постановки, future)
+        self._waiting: list[tuple] = []
+        self._seq = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "requests": 0,
+            "max_depth": 0,
+            "retry_after": 0,
+            "paused_s": 0.0,
+            "waits": {p: {"count": 0, "total_ms": 0.0, "max_ms": 0.0} for p in _PRIORITY_NAMES},
         }
 
-        # progress: user_id -> {slug: ep}
-        for user_id, prog_map in USER_PROGRESS.items():
-            data_to_save["progress"][str(user_id)] = prog_map
+    async def initialize(self) -> None:
+        # Application и Updater инициализируют бота каждый сам по себе
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # кто ещё ждёт — отпускаем без лимита, чтобы завершение не зависло
+        for *_, fut in self._waiting:
+            if not fut.done():
+                fut.set_result(None)
+        self._waiting.clear()
+
+    @property
+    def depth(self) -> int:
+        return len(self._waiting)
+
+    def _bucket(self, chat_id) -> _TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _OUTBOUND_MAX_CHATS:
+                now = time.monotonic()
+                for cid in [cid for cid, b in self._chats.items() if b.idle(now)]:
+                    del self._chats[cid]
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = _TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+            else:
+                bucket = _TokenBucket(OUTBOUND_GROUP_RATE, OUTBOUND_GROUP_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, priority: int, chat_id, seq: int) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, seq, chat_id, time.monotonic(), fut))
+        self.stats["max_depth"] = max(self.stats["max_depth"], len(self._waiting))
+        if self._wakeup is None:
+            # планировщик не запущен (например, бот без initialize) — не держим запрос
+            fut.set_result(None)
+        else:
+            self._wakeup.set()
+        await fut
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            sleep_for = None
+            if self._waiting:
+                now = time.monotonic()
+                sleep_for = self._global.delay(now)
+                if sleep_for == 0:
+                    sleep_for = self._grant_next(now)
+                    if sleep_for == 0:
+                        continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=sleep_for)
+            except asyncio.TimeoutError:
+                pass
 
-        # favorites
-        for user_id, fav_set in USER_FAVORITES.items():
-            data_to_save["favorites"][str(user_id)] = list(fav_set)
+    def _grant_next(self, now: float) -> Optional[float]:
+        """
+        Отпускает самый приоритетный запрос, чей чат не упёрся в лимит.
+        Возвращает 0, если отпустил, иначе — сколько ждать до ближайшего токена.
+        """
+        blocked = []
+        wait = None
+        granted = False
+        while self._waiting:
+            entry = heapq.heappop(self._waiting)
+            priority, _, chat_id, enqueued, fut = entry
+            if fut.done():
+                continue
+            bucket = self._bucket(chat_id) if chat_id is not None else None
+            chat_wait = bucket.delay(now) if bucket is not None else 0.0
+            if chat_wait > 0:
+                blocked.append(entry)
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+
+            self._global.take()
+            if bucket is not None:
+                bucket.take()
+            waited_ms = (now - enqueued) * 1000
+            w = self.stats["waits"][priority]
+            w["count"] += 1
+            w["total_ms"] += waited_ms
+            w["max_ms"] = max(w["max_ms"], waited_ms)
+            fut.set_result(None)
+            granted = True
+            break
+        for entry in blocked:
+            heapq.heappush(self._waiting, entry)
+        return 0 if granted else wait
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        elif endpoint in _URGENT_ENDPOINTS:
+            priority = PRIORITY_URGENT
+        else:
+            priority = PRIORITY_INTERACTIVE
+        chat_id = None if endpoint in _URGENT_ENDPOINTS else data.get("chat_id")
+        self.stats["requests"] += 1
+        self._seq += 1
+        seq = self._seq  # при повторе после RetryAfter запрос не теряет место в очереди
+
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            await self._acquire(priority, chat_id, seq)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = float(e.retry_after)
+                self.stats["retry_after"] += 1
+                self.stats["paused_s"] += delay
+                bucket = self._bucket(chat_id) if chat_id is not None else self._global
+                bucket.paused_until = max(bucket.paused_until, time.monotonic() + delay)
+                print(f"Flood limit on {endpoint} (chat {chat_id}): retry in {delay:.0f} s")
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+
+    def stats_lines(self) -> list[str]:
+        st = self.stats
+        lines = [
+            f"запросов: {st['requests']}, в очереди: {self.depth} (макс. {st['max_depth']})",
+            f"RetryAfter: {st['retry_after']}, пауз на {st['paused_s']:.0f} с",
+        ]
+        for priority, w in st["waits"].items():
+            if w["count"]:
+                lines.append(
+                    f"ожидание ({_PRIORITY_NAMES[priority]}): ср. {w['total_ms'] / w['count']:.1f} мс, "
+                    f"макс. {w['max_ms']:.1f} мс"
+                )
+        return lines
 
-        # watched titles
-        for user_id, wt_set in USER_WATCHED_TITLES.items():
-            data_to_save["watched_titles"][str(user_id)] = list(wt_set)
 
-        # current_track
-        for user_id, track_map in CURRENT_TRACK.items():
-            data_to_save["current_track"][str(user_id)] = track_map
+OUTBOUND = OutboundScheduler()
 
-        with open(USERS_JSON_PATH, "w", encoding="utf-8") as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
 
-    except Exception as e:
-        print("Failed to save users.json:", e)
+# ===============================
+# UPDATES: параллельная обработка с очередью на чат
+# ===============================
+# Разные чаты обрабатываются параллельно, апдейты одного чата — строго по порядку:
+# сессия чата (сообщение бота и его тип) меняется между await'ами, и два одновременных
+# перехода в одном чате оставили бы на экране два сообщения бота.
+UPDATE_STATS = {"processed": 0, "chat_waits": 0}
+
+
+class ChatSerialUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # замок живёт, пока его держат или ждут апдейты этого чата
+        self._locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    # PTB помечает process_update как @final, но его семафор берётся раньше
+    # do_process_update: апдейты, ждущие очереди медленного чата, занимали бы все слоты
+    # и держали апдейты других чатов. Поэтому сначала очередь чата, потом общий слот.
+    async def process_update(self, update, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            # inline-запросы и прочее без чата экран не трогают
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+
+        lock = self._locks.get(chat.id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[chat.id] = lock
+        if lock.locked():
+            UPDATE_STATS["chat_waits"] += 1
+        async with lock:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        UPDATE_STATS["processed"] += 1
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 
 # ===============================
@@ -483,11 +2910,44 @@ def add_or_update_anime_from_message(msg: Message) -> Optional[str]:
         "skip": skip,
     }
 
-    save_anime()
+    reindex_title(slug)
+    CATALOG_STORE.upsert_track(slug, ep, ozv)
 
     return f"✅ Обновлено: {title} (slug: {slug}), серия {ep}, статус: {status}, озвучка: {ozv}"
 
 
+# ===============================
+# RENDER CACHE: клавиатуры, которые зависят только от каталога
+# ===============================
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "4096"))
+
+# (экран, аргументы, CATALOG_VERSION) -> готовая InlineKeyboardMarkup
+# (объекты PTB неизменяемы, одну разметку можно отдавать всем пользователям)
+RENDER_CACHE: "OrderedDict[tuple, InlineKeyboardMarkup]" = OrderedDict()
+RENDER_STATS = {"hits": 0, "misses": 0}
+
+
+def cached_screen(screen: str):
+    """Кэширует билдер клавиатуры до следующего изменения каталога."""
+    def decorator(build):
+        @functools.wraps(build)
+        def wrapper(*args, **kwargs):
+            key = (screen, args, tuple(sorted(kwargs.items())), CATALOG_VERSION)
+            markup = RENDER_CACHE.get(key)
+            if markup is not None:
+                RENDER_CACHE.move_to_end(key)
+                RENDER_STATS["hits"] += 1
+                return markup
+            RENDER_STATS["misses"] += 1
+            markup = build(*args, **kwargs)
+            RENDER_CACHE[key] = markup
+            if len(RENDER_CACHE) > RENDER_CACHE_SIZE:
+                RENDER_CACHE.popitem(last=False)
+            return markup
+        return wrapper
+    return decorator
+
+
 # ===============================
 # UI BUILDERS
 # ===============================
@@ -512,17 +2972,15 @@ def build_main_menu_keyboard(chat_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_screen("genres")
 def build_genre_keyboard() -> InlineKeyboardMarkup:
-    genres_set = set()
-    for anime in ANIME.values():
-        for g in anime.get("genres", []):
-            genres_set.add(g)
-    genres = sorted(genres_set)
+    genres = sorted(GENRE_INDEX)
 
     rows = []
     row = []
     for g in genres:
-        row.append(InlineKeyboardButton(g.capitalize(), callback_data=f"genre:{g}"))
+        label = f"{g.capitalize()} ({len(GENRE_INDEX[g])})"
+        row.append(InlineKeyboardButton(label, callback_data=f"genre:{g}"))
         if len(row) == 2:
             rows.append(row)
             row = []
@@ -532,15 +2990,10 @@ def build_genre_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+@cached_screen("genre_page")
 def build_anime_by_genre_keyboard(genre: str, page: int = 0, per_page: int = 10) -> InlineKeyboardMarkup:
-    # Собираем все тайтлы этого жанра
-    items: list[tuple[str, dict]] = []
-    for slug, anime in ANIME.items():
-        if genre in anime.get("genres", []):
-            items.append((slug, anime))
-
-    # Сортируем по названию
-    items.sort(key=lambda x: x[1].get("title", "").lower())
+    # Тайтлы жанра уже отсортированы по названию в GENRE_INDEX — берём только нужную страницу
+    items = GENRE_INDEX.get(genre, [])
 
     keyboard: list[list[InlineKeyboardButton]] = []
 
@@ -558,7 +3011,8 @@ def build_anime_by_genre_keyboard(genre: str, page: int = 0, per_page: int = 10)
         end = start + per_page
         page_items = items[start:end]
 
-        for slug, anime in page_items:
+        for slug in page_items:
+            anime = ANIME[slug]
             title = anime.get("title", slug)
             status = anime.get("status", "ongoing")
             if status == "ongoing":
@@ -589,6 +3043,7 @@ def build_anime_by_genre_keyboard(genre: str, page: int = 0, per_page: int = 10)
     return InlineKeyboardMarkup(keyboard)
 
 
+@cached_screen("ongoings")
 def build_ongoings_keyboard() -> InlineKeyboardMarkup:
     rows = []
     for slug, anime in ANIME.items():
@@ -603,17 +3058,10 @@ def build_ongoings_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
-def build_tracks_keyboard(slug: str, ep: int, current_track: Optional[str]) -> list[list[InlineKeyboardButton]]:
+def _track_rows(slug: str, ep: int, tracks: dict) -> list[tuple[str, list, list]]:
     """
-    Кнопки выбора озвучки (если больше одной).
+    Кнопки выбора озвучки (если больше одной): (озвучка, строка без галочки, строка с галочкой).
     """
-    anime = ANIME.get(slug)
-    if not anime:
-        return []
-    ep_obj = anime["episodes"].get(ep)
-    if not ep_obj:
-        return []
-    tracks = ep_obj.get("tracks", {})
     if len(tracks) <= 1:
         return []
 
@@ -622,99 +3070,96 @@ def build_tracks_keyboard(slug: str, ep: int, current_track: Optional[str]) -> l
         label = tname
         if label == "default":
             label = "Без названия"
-        prefix = "✅" if tname == current_track else "🎧"
-        btn_text = f"{prefix} {label}"
         # Экранируем ":" в имени озвучки, заменяя на специальную последовательность
         safe_tname = tname.replace(":", "__colon__")
-        rows.append(
-            [
-                InlineKeyboardButton(
-                    btn_text,
-                    callback_data=f"track:{slug}:{ep}:{safe_tname}",
-                )
-            ]
-        )
+        callback_data = f"track:{slug}:{ep}:{safe_tname}"
+        rows.append((
+            tname,
+            [InlineKeyboardButton(f"🎧 {label}", callback_data=callback_data)],
+            [InlineKeyboardButton(f"✅ {label}", callback_data=callback_data)],
+        ))
     return rows
 
 
-def build_episode_keyboard(slug: str, ep: int, chat_id: int, current_track: Optional[str]) -> InlineKeyboardMarkup:
+@cached_screen("episode_skeleton")
+def _episode_skeleton(slug: str, ep: int) -> dict:
+    """
+    Всё, что на экране серии зависит только от каталога: готовые кнопки
+    и строки во всех вариантах. build_episode_keyboard только выбирает нужные.
+    """
     episodes = ANIME[slug]["episodes"]
+    tracks = episodes[ep].get("tracks", {}) if ep in episodes else {}
 
-    # определяем выбранню озвучку из CURRENT_TRACK, если не передали
-    user_tracks = CURRENT_TRACK.get(chat_id, {})
-    stored_track = user_tracks.get(slug)
-    if stored_track:
-        current_track = stored_track
+    prev_btn = []
+    if (ep - 1) in episodes:
+        prev_btn = [InlineKeyboardButton("◀️ Предыдущая", callback_data=f"prev:{slug}:{ep}")]
 
     # --- ЛОГИКА НАЛИЧИЯ СЛЕДУЮЩЕЙ СЕРИИ В ТЕКУЩЕЙ/ДРУГОЙ ОЗВУЧКЕ ---
-    has_prev = (ep - 1) in episodes
+    # какая из строк навигации нужна, решается по выбранной озвучке пользователя
+    next_ep = ep + 1
+    next_tracks = frozenset(episodes[next_ep].get("tracks", {})) if next_ep in episodes else frozenset()
+
+    return {
+        "list_row": [InlineKeyboardButton("📺 Серии", callback_data=f"list:{slug}")],
+        "fav_add_row": [InlineKeyboardButton("💖 В избранное", callback_data=f"fav_add:{slug}")],
+        "fav_remove_row": [InlineKeyboardButton("💔 Убрать из избранного", callback_data=f"fav_remove:{slug}")],
+        "watch_row": [InlineKeyboardButton("👁 Тайтл просмотрен", callback_data=f"watch_title:{slug}")],
+        "unwatch_row": [
+            InlineKeyboardButton("👁 Убрать тайтл из просмотренного", callback_data=f"unwatch_title:{slug}")
+        ],
+        "track_rows": _track_rows(slug, ep, tracks),
+        "next_tracks": next_tracks,
+        # следующая серия есть в той же озвучке — обычная кнопка
+        "nav_same": prev_btn + [InlineKeyboardButton("Следующая ▶️", callback_data=f"next:{slug}:{ep}")],
+        # только в другой озвучке — другая кнопка
+        "nav_other": prev_btn + [
+            InlineKeyboardButton("Следущая (другая озвучка) ▶️", callback_data=f"next_other:{slug}:{ep}")
+        ],
+        "nav_none": prev_btn,
+    }
 
-    has_next_same_track = False
-    has_next_other_track = False
 
-    # Проверяем следующую серию (ep+1)
-    next_ep = ep + 1
-    if next_ep in episodes:
-        next_tracks = episodes[next_ep].get("tracks", {})
-        if current_track and current_track in next_tracks:
-            has_next_same_track = True
-        else:
-            # если хоть одна дорожка есть у следующей серии, то есть "в другой озвучке"
-            if next_tracks:
-                has_next_other_track = True
-
-    nav: list[InlineKeyboardButton] = []
-    if has_prev:
-        nav.append(InlineKeyboardButton("◀️ Предыдущая", callback_data=f"prev:{slug}:{ep}"))
-
-    # Если есть следующая серия в той же озвучке — обычная кнопка
-    if has_next_same_track:
-        nav.append(InlineKeyboardButton("Следующая ▶️", callback_data=f"next:{slug}:{ep}"))
-    # Если только в другой озвучке — другая кнопка
-    elif has_next_other_track:
-        nav.append(InlineKeyboardButton("Следущая (другая озвучка) ▶️", callback_data=f"next_other:{slug}:{ep}"))
-
-    fav_set = USER_FAVORITES.get(chat_id, set())
-    if slug in fav_set:
-        fav_button = InlineKeyboardButton("💔 Убрать из избранного", callback_data=f"fav_remove:{slug}")
-    else:
-        fav_button = InlineKeyboardButton("💖 В избранное", callback_data=f"fav_add:{slug}")
+_RANDOM_ROW = [InlineKeyboardButton("🎲 Случайное", callback_data="random")]
+_MENU_ROW = [InlineKeyboardButton("🍄 Меню", callback_data="menu")]
 
-    watched_titles = USER_WATCHED_TITLES.get(chat_id, set())
-    if slug in watched_titles:
-        watched_button = InlineKeyboardButton(
-            "👁 Убрать тайтл из просмотренного",
-            callback_data=f"unwatch_title:{slug}",
-        )
-    else:
-        watched_button = InlineKeyboardButton(
-            "👁 Тайтл просмотрен",
-            callback_data=f"watch_title:{slug}",
-        )
+
+def build_episode_keyboard(slug: str, ep: int, chat_id: int, current_track: Optional[str]) -> InlineKeyboardMarkup:
+    sk = _episode_skeleton(slug, ep)
+
+    # определяем выбранню озвучку из CURRENT_TRACK, если не передали
+    stored_track = get_user_tracks(chat_id).get(slug)
+    if stored_track:
+        current_track = stored_track
 
     rows: list[list[InlineKeyboardButton]] = [
-        [
-            InlineKeyboardButton("📺 Серии", callback_data=f"list:{slug}"),
-        ],
-        [fav_button],
-        [watched_button],
+        sk["list_row"],
+        sk["fav_remove_row"] if slug in get_user_favorites(chat_id) else sk["fav_add_row"],
+        sk["unwatch_row"] if slug in get_user_watched(chat_id) else sk["watch_row"],
     ]
 
     # Кнопки выбора озвучки (если есть несколько)
-    track_rows = build_tracks_keyboard(slug, ep, current_track)
-    rows.extend(track_rows)
-
+    for tname, plain_row, checked_row in sk["track_rows"]:
+        rows.append(checked_row if tname == current_track else plain_row)
+
+    next_tracks = sk["next_tracks"]
+    if current_track and current_track in next_tracks:
+        nav = sk["nav_same"]
+    elif next_tracks:
+        nav = sk["nav_other"]
+    else:
+        nav = sk["nav_none"]
     if nav:
         rows.append(nav)
 
     # Добавляем кнопку "Случайное" на экран серии только если режим случайного включён для чата
-    if RANDOM_MODE.get(chat_id, False):
-        rows.append([InlineKeyboardButton("🎲 Случайное", callback_data="random")])
+    if session(chat_id).random_mode:
+        rows.append(_RANDOM_ROW)
 
-    rows.append([InlineKeyboardButton("🍄 Меню", callback_data="menu")])
+    rows.append(_MENU_ROW)
     return InlineKeyboardMarkup(rows)
 
 
+@cached_screen("episode_list")
 def build_episode_list_keyboard(slug: str) -> InlineKeyboardMarkup:
     eps = sorted(ANIME[slug]["episodes"].keys())
     rows = []
@@ -730,7 +3175,8 @@ def build_episode_list_keyboard(slug: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
-def build_anime_menu(chat_id: int) -> InlineKeyboardMarkup:
+@cached_screen("anime_menu")
+def build_anime_menu() -> InlineKeyboardMarkup:
     keyboard = []
     for slug, anime in ANIME.items():
         title = anime["title"]
@@ -745,12 +3191,9 @@ def build_anime_menu(chat_id: int) -> InlineKeyboardMarkup:
 
 
 def build_favorites_keyboard(chat_id: int) -> InlineKeyboardMarkup:
-    favs = USER_FAVORITES.get(chat_id, set())
+    favs = get_user_favorites(chat_id)
     # сортируем по названию
-    sorted_slugs = sorted(
-        list(favs),
-        key=lambda s: ANIME.get(s, {}).get("title", s).lower()
-    )
+    sorted_slugs = sorted(favs, key=title_rank)
     rows = []
     for slug in sorted_slugs:
         anime = ANIME.get(slug, {})
@@ -766,11 +3209,8 @@ def build_favorites_keyboard(chat_id: int) -> InlineKeyboardMarkup:
 
 
 def build_watched_titles_keyboard(chat_id: int, page: int = 0, per_page: int = 10) -> InlineKeyboardMarkup:
-    watched_titles = USER_WATCHED_TITLES.get(chat_id, set())
-    watched_list = sorted(
-        list(watched_titles),
-        key=lambda s: ANIME.get(s, {}).get("title", s).lower()
-    )
+    watched_titles = get_user_watched(chat_id)
+    watched_list = sorted(watched_titles, key=title_rank)
 
     keyboard: list[list[InlineKeyboardButton]] = []
 
@@ -820,7 +3260,7 @@ def build_continue_keyboard(chat_id: int, page: int = 0, per_page: int = CONTINU
     """
     Пагинация по 10 на экран. Сортировка по названию.
     """
-    user_prog = USER_PROGRESS.get(chat_id, {})
+    user_prog = get_user_progress(chat_id)
     rows = []
 
     if not user_prog:
@@ -829,10 +3269,7 @@ def build_continue_keyboard(chat_id: int, page: int = 0, per_page: int = CONTINU
         return InlineKeyboardMarkup(rows)
 
     # Сортируем элементы по названию отображаемого тайтла
-    items = sorted(
-        list(user_prog.items()),
-        key=lambda pair: ANIME.get(pair[0], {}).get("title", pair[0]).lower()
-    )
+    items = sorted(user_prog.items(), key=lambda pair: title_rank(pair[0]))
 
     total = len(items)
     total_pages = (total + per_page - 1) // per_page
@@ -872,7 +3309,7 @@ def build_continue_keyboard(chat_id: int, page: int = 0, per_page: int = CONTINU
 
 
 def build_continue_item_keyboard(chat_id: int, slug: str) -> InlineKeyboardMarkup:
-    ep = USER_PROGRESS.get(chat_id, {}).get(slug)
+    ep = get_user_progress(chat_id).get(slug)
     anime = ANIME.get(slug, {})
     title = anime.get("title", slug)
     status = anime.get("status", "ongoing")
@@ -908,14 +3345,9 @@ def build_continue_item_keyboard(chat_id: int, slug: str) -> InlineKeyboardMarku
 
 
 def build_search_results_keyboard(matches: list[str]) -> InlineKeyboardMarkup:
-    # сортируем совпадения по названию
-    matches_sorted = sorted(
-        matches,
-        key=lambda s: ANIME.get(s, {}).get("title", s).lower()
-    )
-
+    # совпадения уже отсортированы по релевантности в search_titles
     rows = []
-    for slug in matches_sorted:
+    for slug in matches:
         anime = ANIME.get(slug, {})
         title = anime.get("title", slug)
         status = anime.get("status", "ongoing")
@@ -928,9 +3360,359 @@ def build_search_results_keyboard(matches: list[str]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+# ===============================
+# MEDIA REGISTRY: картинки загружаем в Telegram один раз
+# ===============================
+# После первой загрузки запоминаем file_id и дальше шлём только его.
+# Запись привязана к sha256 файла: заменили картинку — загрузим заново.
+
+# путь -> {"sha256": ..., "file_id": ...}
+MEDIA_REGISTRY: dict[str, dict] = {}
+# путь -> (mtime_ns, size, sha256): файл перечитываем, только если он изменился
+_MEDIA_HASHES: dict[str, tuple[int, int, str]] = {}
+MEDIA_STATS = {"uploads": 0, "upload_bytes": 0, "reused": 0, "stale": 0}
+MEDIA_WARMUP_STATS = {"uploaded": 0, "skipped": 0, "failed": 0, "ms": 0.0}
+
+
+def load_media_registry() -> None:
+    global MEDIA_REGISTRY
+    if not os.path.exists(MEDIA_REGISTRY_PATH):
+        MEDIA_REGISTRY = {}
+        return
+    try:
+        with open(MEDIA_REGISTRY_PATH, "r", encoding="utf-8") as f:
+            MEDIA_REGISTRY = json.load(f)
+        print(f"Loaded media registry, items: {len(MEDIA_REGISTRY)}")
+    except Exception as e:
+        print("Failed to load media.json:", e)
+        MEDIA_REGISTRY = {}
+
+
+def _write_media_registry(data_to_save: dict) -> None:
+    try:
+        _atomic_write_text(MEDIA_REGISTRY_PATH, json.dumps(data_to_save, ensure_ascii=False, indent=2))
+    except Exception as e:
+        print("Failed to save media.json:", e)
+
+
+def save_media_registry() -> None:
+    submit_persist(_write_media_registry, dict(MEDIA_REGISTRY))
+
+
+def _media_hash(path: str) -> Optional[str]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    cached = _MEDIA_HASHES.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    _MEDIA_HASHES[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def photo_media(path: str) -> tuple[object, bool]:
+    """
+    Что передать в send_photo / InputMediaPhoto: file_id, если картинка уже загружена
+    и не менялась, иначе байты файла. Второе значение — идёт ли загрузка.
+    """
+    entry = MEDIA_REGISTRY.get(path)
+    if entry and entry.get("sha256") == _media_hash(path):
+        MEDIA_STATS["reused"] += 1
+        return entry["file_id"], False
+
+    with open(path, "rb") as f:
+        data = f.read()
+    MEDIA_STATS["uploads"] += 1
+    MEDIA_STATS["upload_bytes"] += len(data)
+    return data, True
+
+
+def remember_photo(path: str, message, save: bool = True) -> None:
+    """Запоминаем file_id из ответа Telegram на загрузку."""
+    if not isinstance(message, Message) or not message.photo:
+        return
+    MEDIA_REGISTRY[path] = {"sha256": _media_hash(path), "file_id": message.photo[-1].file_id}
+    if save:
+        save_media_registry()
+
+
+def forget_photo(path: str) -> None:
+    """file_id больше не принимается (например, сменился токен бота)."""
+    if MEDIA_REGISTRY.pop(path, None) is not None:
+        MEDIA_STATS["stale"] += 1
+        save_media_registry()
+
+
+def _media_files() -> list[str]:
+    """Приветственная картинка, картинки достижений и всё остальное из images/."""
+    paths = [WELCOME_PHOTO] + [path for path, _ in ACHIEVEMENTS.values()]
+    if os.path.isdir(MEDIA_DIR):
+        for name in sorted(os.listdir(MEDIA_DIR)):
+            if name.lower().endswith((".jpg", ".jpeg", ".png")):
+                paths.append(os.path.join(MEDIA_DIR, name))
+    return [path for path in dict.fromkeys(paths) if os.path.isfile(path)]
+
+
+async def warm_up_media(bot) -> None:
+    """
+    Загружаем в MEDIA_WARMUP_CHAT_ID все картинки, для которых ещё нет file_id,
+    чтобы первый пользователь после деплоя не ждал загрузку.
+    """
+    if not MEDIA_WARMUP_CHAT_ID:
+        return
+    started = time.perf_counter()
+    stats = MEDIA_WARMUP_STATS
+    # один и тот же файл под другим именем грузить не нужно
+    known = {entry.get("sha256"): entry["file_id"] for entry in MEDIA_REGISTRY.values()}
+    semaphore = asyncio.Semaphore(MEDIA_WARMUP_CONCURRENCY)
+
+    async def upload(path: str) -> None:
+        digest = _media_hash(path)
+        entry = MEDIA_REGISTRY.get(path)
+        if entry and entry.get("sha256") == digest:
+            stats["skipped"] += 1
+            return
+        if digest in known:
+            MEDIA_REGISTRY[path] = {"sha256": digest, "file_id": known[digest]}
+            stats["skipped"] += 1
+            return
+
+        async with semaphore:
+            try:
+                media, _ = photo_media(path)
+                sent = await bot.send_photo(
+                    chat_id=MEDIA_WARMUP_CHAT_ID,
+                    photo=media,
+                    disable_notification=True,
+                    rate_limit_args=PRIORITY_BACKGROUND,
+                )
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"Media warm-up failed for {path}:", e)
+                return
+            remember_photo(path, sent, save=False)
+            stats["uploaded"] += 1
+            try:
+                # file_id остаётся рабочим и после удаления сообщения
+                await bot.delete_message(
+                    chat_id=MEDIA_WARMUP_CHAT_ID,
+                    message_id=sent.message_id,
+                    rate_limit_args=PRIORITY_BACKGROUND,
+                )
+            except Exception:
+                pass
+
+    registry_before = dict(MEDIA_REGISTRY)
+    await asyncio.gather(*(upload(path) for path in _media_files()))
+    if MEDIA_REGISTRY != registry_before:
+        save_media_registry()
+
+    stats["ms"] = (time.perf_counter() - started) * 1000
+    print(
+        f"Media warm-up: {stats['uploaded']} uploaded, {stats['skipped']} already known, "
+        f"{stats['failed']} failed in {stats['ms']:.0f} ms"
+    )
+
+
 # ===============================
 # HELPERS: single-message logic
 # ===============================
+# Сколько вызовов API экономит один пропуск повторной отрисовки (RENDER_SKIP_STATS["calls_saved"]):
+# без пропуска тот же экран стоил бы одну правку, которую Telegram отклонит с
+# "message is not modified" — _render и edit_caption_only считают её успехом и не переотправляют.
+_CALLS_PER_REDUNDANT_RENDER = 1
+RENDER_SKIP_STATS = {"skipped": 0, "calls_saved": 0}
+
+# "откуда->куда" (типы message_type, "none" — сообщения ещё нет) -> экранов и вызовов API
+TRANSITION_STATS: dict[str, dict[str, int]] = {}
+
+
+def _record_transition(from_type: str, to_type: str, calls: int) -> None:
+    st = TRANSITION_STATS.setdefault(f"{from_type}->{to_type}", {"renders": 0, "calls": 0})
+    st["renders"] += 1
+    st["calls"] += calls
+
+
+def _not_modified(e: Exception) -> bool:
+    """Telegram отказал в правке, потому что на экране уже ровно это — это не ошибка."""
+    return isinstance(e, BadRequest) and "not modified" in str(e).lower()
+
+
+def _already_rendered(sess: ChatSession, msg_id: Optional[int], content: int, media: Optional[str] = None) -> bool:
+    """
+    На экране уже ровно это: то же сообщение, та же подпись и клавиатура
+    (и та же картинка/видео, если media передан).
+    """
+    last = sess.render
+    if (
+        msg_id is None
+        or last is None
+        or last[0] != msg_id
+        or last[2] != content
+        or (media is not None and last[1] != media)
+    ):
+        return False
+    RENDER_SKIP_STATS["skipped"] += 1
+    RENDER_SKIP_STATS["calls_saved"] += _CALLS_PER_REDUNDANT_RENDER
+    return True
+
+
+async def _edit_text_or_caption(
+    chat_id: int,
+    context: ContextTypes.DEFAULT_TYPE,
+    msg_id: int,
+    msg_type: str,
+    caption: str,
+    reply_markup: Optional[InlineKeyboardMarkup],
+) -> None:
+    """Правка без смены медиа: у текстового сообщения — текст, у фото/видео — подпись."""
+    if msg_type == "text":
+        await context.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=msg_id,
+            text=caption,
+            reply_markup=reply_markup,
+        )
+    else:
+        await context.bot.edit_message_caption(
+            chat_id=chat_id,
+            message_id=msg_id,
+            caption=caption,
+            reply_markup=reply_markup,
+        )
+
+
+async def _send_new(
+    chat_id: int,
+    context: ContextTypes.DEFAULT_TYPE,
+    kind: str,
+    media_key: str,
+    caption: str,
+    reply_markup: InlineKeyboardMarkup,
+) -> tuple[Message, int]:
+    """Новое сообщение нужного типа. Возвращает его и число сделанных вызовов API."""
+    if kind == "text":
+        sent = await context.bot.send_message(chat_id=chat_id, text=caption, reply_markup=reply_markup)
+        return sent, 1
+    if kind == "video":
+        sent = await context.bot.send_video(
+            chat_id=chat_id,
+            video=media_key,
+            caption=caption,
+            reply_markup=reply_markup,
+        )
+        return sent, 1
+
+    media, uploading = photo_media(media_key)
+    calls = 1
+    try:
+        sent = await context.bot.send_photo(
+            chat_id=chat_id,
+            photo=media,
+            caption=caption,
+            reply_markup=reply_markup,
+        )
+    except BadRequest:
+        if uploading:
+            raise
+        # сохранённый file_id не подошёл — забываем его и грузим файл заново
+        forget_photo(media_key)
+        media, uploading = photo_media(media_key)
+        calls += 1
+        sent = await context.bot.send_photo(
+            chat_id=chat_id,
+            photo=media,
+            caption=caption,
+            reply_markup=reply_markup,
+        )
+    if uploading:
+        remember_photo(media_key, sent)
+    return sent, calls
+
+
+async def _render(
+    chat_id: int,
+    context: ContextTypes.DEFAULT_TYPE,
+    kind: str,
+    media_key: str,
+    caption: str,
+    reply_markup: InlineKeyboardMarkup,
+) -> int:
+    """
+    Переход экрана чата к (kind, media_key, caption, reply_markup) самым дешёвым способом.
+    kind — "text", "photo" или "video"; media_key — путь к картинке, file_id видео или "" для текста.
+    По типу сообщения и последней отрисовке из сессии чата:
+    - медиа уже то же (или нужен просто текст) -> edit_message_text / edit_message_caption;
+    - фото/видео -> другое фото/видео -> edit_message_media;
+    - текстовое сообщение Telegram в медиа не превращает -> сразу удаляем и шлём новое.
+    Клавиатура всегда уходит в том же запросе. Удаление + новое сообщение — и как запасной путь,
+    если правка не удалась.
+    """
+    sess = session(chat_id)
+    msg_id = sess.message_id
+    content = hash((caption, reply_markup))
+    if _already_rendered(sess, msg_id, content, media_key):
+        # экран тот же, но чат активен — last_active в снапшоте тоже должен обновиться
+        mark_session_dirty(chat_id)
+        return msg_id
+    # пока не отрисовали заново, не знаем, что на экране
+    last, sess.render = sess.render, None
+    from_type = (sess.message_type or "photo") if msg_id else "none"
+    shown_media = last[1] if last and last[0] == msg_id else None
+
+    calls = 0
+    try:
+        if msg_id and (kind == "text" or from_type != "text"):
+            try:
+                calls += 1
+                if kind == "text" or (kind == from_type and shown_media == media_key):
+                    await _edit_text_or_caption(chat_id, context, msg_id, from_type, caption, reply_markup)
+                else:
+                    if kind == "photo":
+                        media, uploading = photo_media(media_key)
+                        input_media = InputMediaPhoto(media=media, caption=caption)
+                    else:
+                        uploading = False
+                        input_media = InputMediaVideo(media=media_key, caption=caption)
+                    edited = await context.bot.edit_message_media(
+                        media=input_media,
+                        chat_id=chat_id,
+                        message_id=msg_id,
+                        reply_markup=reply_markup,
+                    )
+                    if uploading:
+                        remember_photo(media_key, edited)
+                    sess.message_type = kind
+                sess.render = (msg_id, media_key, content)
+                return msg_id
+            except Exception as e:
+                if _not_modified(e):
+                    sess.render = (msg_id, media_key, content)
+                    return msg_id
+                # правка по-настоящему не удалась (сообщение удалено, слишком старое и т.п.)
+                print("Failed to edit message, resending:", e)
+
+        if msg_id:
+            calls += 1
+            try:
+                await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
+            except Exception:
+                pass
+
+        sent, send_calls = await _send_new(chat_id, context, kind, media_key, caption, reply_markup)
+        calls += send_calls
+        sess.message_id = sent.message_id
+        sess.message_type = kind
+        sess.render = (sent.message_id, media_key, content)
+        return sent.message_id
+    finally:
+        _record_transition(from_type, kind, calls)
+        mark_session_dirty(chat_id)
+
+
 async def send_or_edit_photo(
     chat_id: int,
     context: ContextTypes.DEFAULT_TYPE,
@@ -949,67 +3731,10 @@ async def send_or_edit_photo(
     elif WELCOME_PHOTO and os.path.exists(WELCOME_PHOTO):
         use_path = WELCOME_PHOTO
 
-    msg_id = LAST_MESSAGE.get(chat_id)
-
     # если нет ни одной картинки — работаем только с текстом
     if not use_path:
-        if msg_id:
-            try:
-                await context.bot.edit_message_caption(
-                    chat_id=chat_id,
-                    message_id=msg_id,
-                    caption=caption,
-                    reply_markup=reply_markup,
-                )
-                LAST_MESSAGE_TYPE[chat_id] = "text"
-                return msg_id
-            except Exception:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                except Exception:
-                    pass
-
-        sent = await context.bot.send_message(
-            chat_id=chat_id,
-            text=caption,
-            reply_markup=reply_markup,
-        )
-        LAST_MESSAGE[chat_id] = sent.message_id
-        LAST_MESSAGE_TYPE[chat_id] = "text"
-        return sent.message_id
-
-    # если картинка есть — пробуем редактировать / отправить фото
-    if msg_id:
-        try:
-            with open(use_path, "rb") as ph:
-                await context.bot.edit_message_media(
-                    media=InputMediaPhoto(media=ph, caption=caption),
-                    chat_id=chat_id,
-                    message_id=msg_id,
-                )
-            await context.bot.edit_message_reply_markup(
-                chat_id=chat_id,
-                message_id=msg_id,
-                reply_markup=reply_markup,
-            )
-            LAST_MESSAGE_TYPE[chat_id] = "photo"
-            return msg_id
-        except Exception:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-            except Exception:
-                pass
-
-    with open(use_path, "rb") as ph:
-        sent = await context.bot.send_photo(
-            chat_id=chat_id,
-            photo=ph,
-            caption=caption,
-            reply_markup=reply_markup,
-        )
-    LAST_MESSAGE[chat_id] = sent.message_id
-    LAST_MESSAGE_TYPE[chat_id] = "photo"
-    return sent.message_id
+        return await _render(chat_id, context, "text", "", caption, reply_markup)
+    return await _render(chat_id, context, "photo", use_path, caption, reply_markup)
 
 
 async def send_or_edit_video(
@@ -1019,37 +3744,7 @@ async def send_or_edit_video(
     caption: str,
     reply_markup: InlineKeyboardMarkup,
 ):
-    msg_id = LAST_MESSAGE.get(chat_id)
-    media = InputMediaVideo(media=file_id_or_path, caption=caption)
-    if msg_id:
-        try:
-            await context.bot.edit_message_media(
-                media=media,
-                chat_id=chat_id,
-                message_id=msg_id,
-            )
-            await context.bot.edit_message_reply_markup(
-                chat_id=chat_id,
-                message_id=msg_id,
-                reply_markup=reply_markup,
-            )
-            LAST_MESSAGE_TYPE[chat_id] = "video"
-            return msg_id
-        except Exception:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-            except Exception:
-                pass
-
-    sent = await context.bot.send_video(
-        chat_id=chat_id,
-        video=file_id_or_path,
-        caption=caption,
-        reply_markup=reply_markup,
-    )
-    LAST_MESSAGE[chat_id] = sent.message_id
-    LAST_MESSAGE_TYPE[chat_id] = "video"
-    return sent.message_id
+    return await _render(chat_id, context, "video", file_id_or_path, caption, reply_markup)
 
 
 async def edit_caption_only(
@@ -1063,7 +3758,8 @@ async def edit_caption_only(
     - если исходное сообщение было с фото и оно пропало, используем send_or_edit_photo,
       который сам решает, есть ли картинка или только текст.
     """
-    msg_id = LAST_MESSAGE.get(chat_id)
+    sess = session(chat_id)
+    msg_id = sess.message_id
     if not msg_id:
         # просто выводим как "экран" через send_or_edit_photo (она сама решит: есть картинка или нет)
         return await send_or_edit_photo(
@@ -1074,19 +3770,35 @@ async def edit_caption_only(
             reply_markup or build_main_menu_keyboard(chat_id),
         )
 
+    # подпись меняется на месте, но last_active в снапшоте должен обновиться,
+    # иначе чат, где ходят только по таким экранам, выпадет из sessions.json по TTL
+    mark_session_dirty(chat_id)
+    content = hash((caption, reply_markup))
+    if _already_rendered(sess, msg_id, content):
+        return msg_id
+    last, sess.render = sess.render, None
+    msg_type = sess.message_type or "photo"
+    # картинка/видео остаются прежними — меняется только подпись
+    media = last[1] if last and last[0] == msg_id else None
+
     try:
-        await context.bot.edit_message_caption(
-            chat_id=chat_id,
-            message_id=msg_id,
-            caption=caption,
-            reply_markup=reply_markup,
-        )
+        # текстовому сообщению — edit_message_text, фото/видео — edit_message_caption
+        await _edit_text_or_caption(chat_id, context, msg_id, msg_type, caption, reply_markup)
+        _record_transition(msg_type, msg_type, 1)
+        sess.render = (msg_id, media, content)
         return msg_id
-    except Exception:
+    except Exception as e:
+        if _not_modified(e):
+            _record_transition(msg_type, msg_type, 1)
+            sess.render = (msg_id, media, content)
+            return msg_id
+        # неудачная правка + удаление; новое сообщение посчитает send_or_edit_photo
+        _record_transition(msg_type, msg_type, 2)
         try:
             await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
         except Exception:
             pass
+        sess.message_id = None
         # fallback — снова через send_or_edit_photo (с проверкой на наличие файлов)
         return await send_or_edit_photo(
             chat_id,
@@ -1102,52 +3814,52 @@ async def edit_caption_only(
 # ===============================
 async def show_main_menu(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     # выход из random режима
-    RANDOM_MODE[chat_id] = False
+    session(chat_id).random_mode = False
 
     caption = "Приятного просмотра ✨\nВсе управление через кнопки ниже."
     kb = build_main_menu_keyboard(chat_id)
     await send_or_edit_photo(chat_id, context, WELCOME_PHOTO, caption, kb)
-    SEARCH_MODE[chat_id] = False
+    session(chat_id).search_mode = False
 
 
 async def show_genres(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     # выход из random режима
-    RANDOM_MODE[chat_id] = False
+    session(chat_id).random_mode = False
 
     caption = "Выбери жанр:"
     kb = build_genre_keyboard()
     await edit_caption_only(chat_id, context, caption, kb)
-    SEARCH_MODE[chat_id] = False
+    session(chat_id).search_mode = False
 
 
 async def show_anime_list(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     # выход из random режима
-    RANDOM_MODE[chat_id] = False
+    session(chat_id).random_mode = False
 
     caption = "Список аниме:"
-    kb = build_anime_menu(chat_id)
+    kb = build_anime_menu()
     await edit_caption_only(chat_id, context, caption, kb)
-    SEARCH_MODE[chat_id] = False
+    session(chat_id).search_mode = False
 
 
 async def show_anime_by_genre(chat_id: int, context: ContextTypes.DEFAULT_TYPE, genre: str, page: int = 0):
     # выход из random режима
-    RANDOM_MODE[chat_id] = False
+    session(chat_id).random_mode = False
 
     caption = f"Жанр: {genre.capitalize()}\nВыбери аниме:"
     kb = build_anime_by_genre_keyboard(genre, page=page)
     await edit_caption_only(chat_id, context, caption, kb)
-    SEARCH_MODE[chat_id] = False
+    session(chat_id).search_mode = False
 
 
 async def show_ongoings(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     # выход из random режима
-    RANDOM_MODE[chat_id] = False
+    session(chat_id).random_mode = False
 
     caption = "Онгоинги (ещё выходят):"
     kb = build_ongoings_keyboard()
     await edit_caption_only(chat_id, context, caption, kb)
-    SEARCH_MODE[chat_id] = False
+    session(chat_id).search_mode = False
 
 
 def _pick_track_for_episode(slug: str, ep: int, chat_id: int, track_name: Optional[str]) -> tuple[Optional[str], Optional[dict]]:
@@ -1173,7 +3885,7 @@ def _pick_track_for_episode(slug: str, ep: int, chat_id: int, track_name: Option
         return track_name, tracks[track_name]
 
     # 2) сохранённый трек
-    user_tracks = CURRENT_TRACK.get(chat_id, {})
+    user_tracks = get_user_tracks(chat_id)
     stored_track = user_tracks.get(slug)
     if stored_track and stored_track in tracks:
         return stored_track, tracks[stored_track]
@@ -1183,29 +3895,11 @@ def _pick_track_for_episode(slug: str, ep: int, chat_id: int, track_name: Option
     return first_name, tracks[first_name]
 
 
-def _ensure_continue_limit(chat_id: int):
-    """
-    Удерживает USER_PROGRESS[chat_id] в размере не больше CONTINUE_LIMIT.
-    Если превысили — удаляем самый старый (первый вставленный) элемент.
-    ВАЖНО: dict сохраняет порядок вставки (py3.7+).
-    """
-    prog = USER_PROGRESS.get(chat_id)
-    if not prog:
-        return
-    while len(prog) > CONTINUE_LIMIT:
-        # удаляем первый элемент (самый старый)
-        oldest_slug = next(iter(prog.keys()))
-        del prog[oldest_slug]
-
-
 def add_progress_on_next(chat_id: int, slug: str, next_ep: int):
     """
     Добавление прогресса при нажатии Next.
     """
-    USER_PROGRESS.setdefault(chat_id, {})
-    USER_PROGRESS[chat_id][slug] = next_ep
-    _ensure_continue_limit(chat_id)
-    save_users()
+    set_user_progress(chat_id, slug, next_ep)
 
 
 async def show_episode(
@@ -1229,7 +3923,7 @@ async def show_episode(
         return
 
     # сохраняем выбранную озвучку как текущую для этого пользователя и тайтла
-    CURRENT_TRACK.setdefault(chat_id, {})[slug] = chosen_track_name
+    set_user_track(chat_id, slug, chosen_track_name)
 
     source = track.get("source")
     skip = track.get("skip")
@@ -1251,13 +3945,13 @@ async def show_episode(
     kb = build_episode_keyboard(slug, ep, chat_id, chosen_track_name)
     await send_or_edit_video(chat_id, context, source, caption, kb)
 
-    SEARCH_MODE[chat_id] = False
-    # RANDOM_MODE оставляем как есть (включается/выключается в соответствующих местах)
+    session(chat_id).search_mode = False
+    # random_mode оставляем как есть (включается/выключается в соответствующих местах)
 
 
 async def show_episode_list(chat_id: int, context: ContextTypes.DEFAULT_TYPE, slug: str):
     # выход из random режима — показываем список эпизодов обычным способом
-    RANDOM_MODE[chat_id] = False
+    session(chat_id).random_mode = False
 
     anime = ANIME.get(slug)
     if not anime:
@@ -1269,7 +3963,7 @@ async def show_episode_list(chat_id: int, context: ContextTypes.DEFAULT_TYPE, sl
     caption = f"{title} ({status_label})\nВыбери серию:"
     kb = build_episode_list_keyboard(slug)
     await edit_caption_only(chat_id, context, caption, kb)
-    SEARCH_MODE[chat_id] = False
+    session(chat_id).search_mode = False
 
 
 async def show_random(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
@@ -1278,7 +3972,7 @@ async def show_random(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # включаем random режим для чата, чтобы кнопка "случайное" отображалась на экране серии
-    RANDOM_MODE[chat_id] = True
+    session(chat_id).random_mode = True
 
     slug = random.choice(list(ANIME.keys()))
     # Выбираем первую серию
@@ -1286,30 +3980,30 @@ async def show_random(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     if not eps:
         await edit_caption_only(chat_id, context, "Нет серий у этого тайтла 😔", build_main_menu_keyboard(chat_id))
         return
-    # Показываем выбранную серию — режим RANDOM_MODE сохранится и на её экране будет кнопка "🎲 Случайное"
+    # Показываем выбранную серию — режим random_mode сохранится и на её экране будет кнопка "🎲 Случайное"
     await show_episode(chat_id, context, slug, eps[0])
 
 
 async def show_favorites(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     # выход из random режима
-    RANDOM_MODE[chat_id] = False
+    session(chat_id).random_mode = False
 
     caption = "Избранное:"
     kb = build_favorites_keyboard(chat_id)
     await edit_caption_only(chat_id, context, caption, kb)
-    SEARCH_MODE[chat_id] = False
+    session(chat_id).search_mode = False
 
 
 async def show_watched_titles(chat_id: int, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
     # выход из random режима
-    RANDOM_MODE[chat_id] = False
+    session(chat_id).random_mode = False
 
     """
     Экран просмотренных тайтлов:
     - показывает пиратский ранг (достижение) как картинку + текст
     - список тайтлов с пагинацией по 10, отсортированный по алфавиту
     """
-    count = len(USER_WATCHED_TITLES.get(chat_id, set()))
+    count = len(get_user_watched(chat_id))
     achievement = get_achievement_for_count(count)
 
     kb = build_watched_titles_keyboard(chat_id, page=page)
@@ -1323,294 +4017,355 @@ async def show_watched_titles(chat_id: int, context: ContextTypes.DEFAULT_TYPE,
         caption = f"Просмотренные тайтлы (всего: {count}):"
         await edit_caption_only(chat_id, context, caption, kb)
 
-    SEARCH_MODE[chat_id] = False
+    session(chat_id).search_mode = False
 
 
 async def show_continue_list(chat_id: int, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
     # выход из random режима
-    RANDOM_MODE[chat_id] = False
+    session(chat_id).random_mode = False
 
     caption = "Тайтлы, которые ты сейчас смотришь:"
     kb = build_continue_keyboard(chat_id, page=page)
     await edit_caption_only(chat_id, context, caption, kb)
-    SEARCH_MODE[chat_id] = False
+    session(chat_id).search_mode = False
 # ===============================
 # CALLBACKS
 # ===============================
+# callback_data — "<маршрут>" или "<маршрут>:<арг>:<арг>..."; маршрут ищем в таблице
+# одним обращением к dict, аргументы разбираем заранее заданными парсерами.
+class _CallbackRoute:
+    __slots__ = ("name", "handler", "parse", "optional", "calls", "malformed", "total_ms", "max_ms")
+
+    def __init__(self, name: str, handler, parsers: tuple, optional: bool):
+        self.name = name
+        self.handler = handler
+        # "арг:арг:..." -> кортеж значений; ValueError — кривые данные
+        self.parse = _compile_callback_parser(parsers)
+        # аргументы можно не передавать вовсе — тогда у хэндлера значения по умолчанию
+        self.optional = optional
+        self.calls = 0
+        self.malformed = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+
+CALLBACK_ROUTES: dict[str, _CallbackRoute] = {}
+
+CALLBACK_STATS = {"unknown": 0}
+
+
+def _compile_callback_parser(parsers: tuple):
+    """Разборщик под конкретное число аргументов — без циклов и генераторов на каждое нажатие."""
+    if not parsers:
+        return None
+    if len(parsers) == 1:
+        (p0,) = parsers
+        return lambda rest: (p0(rest),)
+    if len(parsers) == 2:
+        p0, p1 = parsers
+
+        def parse2(rest: str) -> tuple:
+            a, b = rest.split(":", 1)
+            return p0(a), p1(b)
+
+        return parse2
+    n = len(parsers)
+
+    def parse_n(rest: str) -> tuple:
+        parts = rest.split(":", n - 1)
+        if len(parts) != n:
+            raise ValueError("not enough callback arguments")
+        return tuple([parse(part) for parse, part in zip(parsers, parts)])
+
+    return parse_n
+
+
+def callback_route(*names: str, args: tuple = (), optional: bool = False):
+    """Регистрирует хэндлер кнопки: handler(query, context, chat_id, *разобранные аргументы)."""
+
+    def decorator(fn):
+        for name in names:
+            CALLBACK_ROUTES[name] = _CallbackRoute(name, fn, args, optional)
+        return fn
+
+    return decorator
+
+
+def _arg_str(value: str) -> str:
+    if not value:
+        raise ValueError("empty callback argument")
+    return value
+
+
+def _arg_page(value: str) -> int:
+    # номер страницы прощаем: кривой — значит первая
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def _arg_track(value: str) -> str:
+    return _arg_str(value).replace("__colon__", ":")
+
+
+def parse_callback(data: str) -> tuple[Optional[_CallbackRoute], Optional[tuple]]:
+    """
+    (маршрут, аргументы). Неизвестный маршрут — (None, None),
+    кривые аргументы (ep: без номера и т.п.) — (маршрут, None).
+    """
+    name, sep, rest = data.partition(":")
+    route = CALLBACK_ROUTES.get(name)
+    if route is None:
+        return None, None
+    if not sep:
+        return route, (() if route.parse is None or route.optional else None)
+    if route.parse is None:
+        return route, None
+    try:
+        return route, route.parse(rest)
+    except ValueError:
+        return route, None
+
+
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data
+    data = query.data or ""
     chat_id = query.message.chat_id
 
-    if data == "menu":
+    route, args = parse_callback(data)
+    if route is None:
+        CALLBACK_STATS["unknown"] += 1
+        return
+    if args is None:
+        route.malformed += 1
+        print("Malformed callback data:", data)
         await show_main_menu(chat_id, context)
         return
 
-    if data == "catalog":
-        await show_genres(chat_id, context)
-        return
+    started = time.perf_counter()
+    try:
+        await route.handler(query, context, chat_id, *args)
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        route.calls += 1
+        route.total_ms += elapsed_ms
+        if elapsed_ms > route.max_ms:
+            route.max_ms = elapsed_ms
+
+
+def _current_episode(chat_id: int, slug: str) -> int:
+    """Серия, на которой пользователь сейчас в тайтле: по прогрессу, иначе первая."""
+    ep = get_user_progress(chat_id).get(slug)
+    if ep is None:
+        anime = ANIME.get(slug)
+        if anime and anime.get("episodes"):
+            ep = sorted(anime["episodes"].keys())[0]
+        else:
+            ep = 1
+    return ep
 
-    if data == "random":
-        # when pressed random we want to pick another random and show it
-        await show_random(chat_id, context)
-        return
 
-    if data == "ongoings":
-        await show_ongoings(chat_id, context)
-        return
+@callback_route("menu")
+async def _cb_menu(query, context, chat_id):
+    await show_main_menu(chat_id, context)
 
-    if data == "continue":
-        await show_continue_list(chat_id, context, page=0)
-        return
 
-    if data == "continue_list":
-        await show_continue_list(chat_id, context, page=0)
-        return
+@callback_route("catalog")
+async def _cb_catalog(query, context, chat_id):
+    await show_genres(chat_id, context)
 
-    if data.startswith("continue_page:"):
-        _, page_str = data.split(":", 1)
-        try:
-            page = int(page_str)
-        except ValueError:
-            page = 0
-        await show_continue_list(chat_id, context, page=page)
-        return
 
-    if data.startswith("cont:"):
-        slug = data.split(":", 1)[1]
-        caption = "Что сделать с этим тайтлом?"
-        kb = build_continue_item_keyboard(chat_id, slug)
-        await edit_caption_only(chat_id, context, caption, kb)
-        return
+@callback_route("random")
+async def _cb_random(query, context, chat_id):
+    # when pressed random we want to pick another random and show it
+    await show_random(chat_id, context)
+
+
+@callback_route("ongoings")
+async def _cb_ongoings(query, context, chat_id):
+    await show_ongoings(chat_id, context)
 
-    if data.startswith("cont_play:"):
-        slug = data.split(":", 1)[1]
-        ep = USER_PROGRESS.get(chat_id, {}).get(slug)
-        if not ep:
-            await query.answer("Нет сохранённого прогресса для этого тайтла.", show_alert=True)
-            await show_continue_list(chat_id, context)
-            return
-        await show_episode(chat_id, context, slug, ep)
-        return
 
-    if data.startswith("cont_remove:"):
-        slug = data.split(":", 1)[1]
-        if chat_id in USER_PROGRESS and slug in USER_PROGRESS[chat_id]:
-            del USER_PROGRESS[chat_id][slug]
-            if not USER_PROGRESS[chat_id]:
-                del USER_PROGRESS[chat_id]
-            save_users()
-        await query.answer("Убрано из продолжения.")
+@callback_route("continue", "continue_list", "continue_page", args=(_arg_page,), optional=True)
+async def _cb_continue(query, context, chat_id, page=0):
+    await show_continue_list(chat_id, context, page=page)
+
+
+@callback_route("cont", args=(_arg_str,))
+async def _cb_cont(query, context, chat_id, slug):
+    caption = "Что сделать с этим тайтлом?"
+    kb = build_continue_item_keyboard(chat_id, slug)
+    await edit_caption_only(chat_id, context, caption, kb)
+
+
+@callback_route("cont_play", args=(_arg_str,))
+async def _cb_cont_play(query, context, chat_id, slug):
+    ep = get_user_progress(chat_id).get(slug)
+    if not ep:
+        await query.answer("Нет сохранённого прогресса для этого тайтла.", show_alert=True)
         await show_continue_list(chat_id, context)
         return
+    await show_episode(chat_id, context, slug, ep)
 
-    if data == "search":
-        SEARCH_MODE[chat_id] = True
-        # выход из random режима
-        RANDOM_MODE[chat_id] = False
 
-        caption = "🔍 Введи название аниме сообщением (или его часть).\n(Текст потом удалю, реагирую только на кнопки)"
-        await edit_caption_only(chat_id, context, caption, build_main_menu_keyboard(chat_id))
-        return
+@callback_route("cont_remove", args=(_arg_str,))
+async def _cb_cont_remove(query, context, chat_id, slug):
+    remove_user_progress(chat_id, slug)
+    await query.answer("Убрано из продолжения.")
+    await show_continue_list(chat_id, context)
 
-    if data == "favorites":
-        await show_favorites(chat_id, context)
-        return
 
-    # просмотренные + пагинация
-    if data == "watched":
-        await show_watched_titles(chat_id, context, page=0)
-        return
+@callback_route("search")
+async def _cb_search(query, context, chat_id):
+    sess = session(chat_id)
+    sess.search_mode = True
+    # выход из random режима
+    sess.random_mode = False
 
-    if data.startswith("watched:"):
-        _, page_str = data.split(":", 1)
-        try:
-            page = int(page_str)
-        except ValueError:
-            page = 0
-        await show_watched_titles(chat_id, context, page=page)
+    caption = "🔍 Введи название аниме сообщением (или его часть).\n(Текст потом удалю, реагирую только на кнопки)"
+    await edit_caption_only(chat_id, context, caption, build_main_menu_keyboard(chat_id))
+
+
+@callback_route("favorites")
+async def _cb_favorites(query, context, chat_id):
+    await show_favorites(chat_id, context)
+
+
+# просмотренные + пагинация: watched / watched:<page>
+@callback_route("watched", args=(_arg_page,), optional=True)
+async def _cb_watched(query, context, chat_id, page=0):
+    await show_watched_titles(chat_id, context, page=page)
+
+
+@callback_route("genre", args=(_arg_str,))
+async def _cb_genre(query, context, chat_id, genre):
+    await show_anime_by_genre(chat_id, context, genre, page=0)
+
+
+# >>> PAGINATION callback: genre_page:<genre>:<page>
+@callback_route("genre_page", args=(_arg_str, _arg_page))
+async def _cb_genre_page(query, context, chat_id, genre, page):
+    await show_anime_by_genre(chat_id, context, genre, page=page)
+
+
+@callback_route("anime", args=(_arg_str,))
+async def _cb_anime(query, context, chat_id, slug):
+    # первая серия
+    anime = ANIME.get(slug)
+    if not anime or not anime.get("episodes"):
+        await edit_caption_only(chat_id, context, "У этого тайтла ещё нет серий.", build_main_menu_keyboard(chat_id))
         return
+    first_ep = sorted(anime["episodes"].keys())[0]
+    # переход в просмотр серии — выключаем random режим (т.к. пользователь явно открыл тайтл не через random)
+    session(chat_id).random_mode = False
+    await show_episode(chat_id, context, slug, first_ep)
+
 
-    if data.startswith("genre:"):
-        genre = data.split(":", 1)[1]
-        await show_anime_by_genre(chat_id, context, genre, page=0)
+@callback_route("list", args=(_arg_str,))
+async def _cb_list(query, context, chat_id, slug):
+    await show_episode_list(chat_id, context, slug)
+
+
+@callback_route("ep", args=(_arg_str, int))
+async def _cb_ep(query, context, chat_id, slug, ep):
+    # пользователь выбрал эп — выключаем random режим (очевидно пользователь работает с каталогом)
+    session(chat_id).random_mode = False
+    await show_episode(chat_id, context, slug, ep)
+
+
+@callback_route("next", args=(_arg_str, int))
+async def _cb_next(query, context, chat_id, slug, current):
+    next_ep = current + 1
+
+    anime = ANIME.get(slug)
+    if not anime:
+        await edit_caption_only(chat_id, context, "Аниме не найдено", build_main_menu_keyboard(chat_id))
         return
 
-    # >>> PAGINATION callback: genre_page:<genre>:<page>
-    if data.startswith("genre_page:"):
-        _, genre, page_str = data.split(":", 2)
-        try:
-            page = int(page_str)
-        except ValueError:
-            page = 0
-        await show_anime_by_genre(chat_id, context, genre, page=page)
+    episodes = anime.get("episodes", {})
+    if next_ep in episodes:
+        # сохраняем прогресс — т.к. нажали "следующая"
+        add_progress_on_next(chat_id, slug, next_ep)
+        await show_episode(chat_id, context, slug, next_ep)
         return
 
-    if data.startswith("anime:"):
-        slug = data.split(":", 1)[1]
-        # первая серия
-        anime = ANIME.get(slug)
-        if not anime or not anime.get("episodes"):
-            await edit_caption_only(chat_id, context, "У этого тайтла ещё нет серий.", build_main_menu_keyboard(chat_id))
-            return
-        first_ep = sorted(anime["episodes"].keys())[0]
-        # переход в просмотр серии — выключаем random режим (т.к. пользователь явно открыл тайтл не через random)
-        RANDOM_MODE[chat_id] = False
-        await show_episode(chat_id, context, slug, first_ep)
+    # следующей серии нет
+    status = anime.get("status", "ongoing")
+    if status == "finish":
+        # если тайтл завершён — убираем из продолжения (если был)
+        remove_user_progress(chat_id, slug)
+    await edit_caption_only(chat_id, context, "Следующей серии нет.", build_main_menu_keyboard(chat_id))
+
+
+# НОВЫЙ КЕЙС: следующая серия только в другой озвучке
+@callback_route("next_other", args=(_arg_str, int))
+async def _cb_next_other(query, context, chat_id, slug, current):
+    next_ep = current + 1
+
+    anime = ANIME.get(slug)
+    if not anime:
+        await edit_caption_only(chat_id, context, "Аниме не найдено", build_main_menu_keyboard(chat_id))
         return
 
-    if data.startswith("list:"):
-        slug = data.split(":", 1)[1]
-        await show_episode_list(chat_id, context, slug)
+    episodes = anime.get("episodes", {})
+    ep_obj = episodes.get(next_ep)
+    if not ep_obj:
+        # следующей серии нет
+        status = anime.get("status", "ongoing")
+        if status == "finish":
+            remove_user_progress(chat_id, slug)
+        await edit_caption_only(chat_id, context, "Следующей серии нет.", build_main_menu_keyboard(chat_id))
         return
 
-    if data.startswith("ep:"):
-        _, slug, ep_str = data.split(":")
-        ep = int(ep_str)
-        # пользователь выбрал эп — выключаем random режим (очевидно пользователь работает с каталогом)
-        RANDOM_MODE[chat_id] = False
-        await show_episode(chat_id, context, slug, ep)
+    tracks = ep_obj.get("tracks", {})
+    if not tracks:
+        await edit_caption_only(chat_id, context, "У следующей серии нет доступных дорожек.", build_main_menu_keyboard(chat_id))
         return
 
-    if data.startswith("next:"):
-        _, slug, ep_str = data.split(":")
-        current = int(ep_str)
-        next_ep = current + 1
+    # Берём первую доступную озвучку у следующей серии
+    some_track_name = next(iter(tracks.keys()))
+    # сохраняем прогресс — т.к. нажали "следующая (другая озвучка)"
+    add_progress_on_next(chat_id, slug, next_ep)
+    await show_episode(chat_id, context, slug, next_ep, track_name=some_track_name)
 
-        anime = ANIME.get(slug)
-        if not anime:
-            await edit_caption_only(chat_id, context, "Аниме не найдено", build_main_menu_keyboard(chat_id))
-            return
 
-        episodes = anime.get("episodes", {})
-        if next_ep in episodes:
-            # сохраняем прогресс — т.к. нажали "следующая"
-            add_progress_on_next(chat_id, slug, next_ep)
-            await show_episode(chat_id, context, slug, next_ep)
-            return
-        else:
-            # следующей серии нет
-            status = anime.get("status", "ongoing")
-            if status == "finish":
-                # если тайтл завершён — убираем из продолжения (если был)
-                if chat_id in USER_PROGRESS and slug in USER_PROGRESS[chat_id]:
-                    del USER_PROGRESS[chat_id][slug]
-                    if not USER_PROGRESS[chat_id]:
-                        del USER_PROGRESS[chat_id]
-                    save_users()
-            await edit_caption_only(chat_id, context, "Следующей серии нет.", build_main_menu_keyboard(chat_id))
-            return
+@callback_route("prev", args=(_arg_str, int))
+async def _cb_prev(query, context, chat_id, slug, current):
+    await show_episode(chat_id, context, slug, current - 1)
 
-    # НОВЫЙ КЕЙС: следующая серия только в другой озвучке
-    if data.startswith("next_other:"):
-        _, slug, ep_str = data.split(":")
-        current = int(ep_str)
-        next_ep = current + 1
 
-        anime = ANIME.get(slug)
-        if not anime:
-            await edit_caption_only(chat_id, context, "Аниме не найдено", build_main_menu_keyboard(chat_id))
-            return
+@callback_route("fav_add", args=(_arg_str,))
+async def _cb_fav_add(query, context, chat_id, slug):
+    add_user_favorite(chat_id, slug)
+    await show_episode(chat_id, context, slug, _current_episode(chat_id, slug))
 
-        episodes = anime.get("episodes", {})
-        ep_obj = episodes.get(next_ep)
-        if not ep_obj:
-            # следующей серии нет
-            status = anime.get("status", "ongoing")
-            if status == "finish":
-                if chat_id in USER_PROGRESS and slug in USER_PROGRESS[chat_id]:
-                    del USER_PROGRESS[chat_id][slug]
-                    if not USER_PROGRESS[chat_id]:
-                        del USER_PROGRESS[chat_id]
-                    save_users()
-            await edit_caption_only(chat_id, context, "Следующей серии нет.", build_main_menu_keyboard(chat_id))
-            return
 
-        tracks = ep_obj.get("tracks", {})
-        if not tracks:
-            await edit_caption_only(chat_id, context, "У следующей серии нет доступных дорожек.", build_main_menu_keyboard(chat_id))
-            return
+@callback_route("fav_remove", args=(_arg_str,))
+async def _cb_fav_remove(query, context, chat_id, slug):
+    remove_user_favorite(chat_id, slug)
+    await show_episode(chat_id, context, slug, _current_episode(chat_id, slug))
 
-        # Берём первую доступную озвучку у следующей серии
-        some_track_name = next(iter(tracks.keys()))
-        # сохраняем прогресс — т.к. нажали "следующая (другая озвучка)"
-        add_progress_on_next(chat_id, slug, next_ep)
-        await show_episode(chat_id, context, slug, next_ep, track_name=some_track_name)
-        return
 
-    if data.startswith("prev:"):
-        _, slug, ep_str = data.split(":")
-        current = int(ep_str)
-        await show_episode(chat_id, context, slug, current - 1)
-        return
+@callback_route("watch_title", args=(_arg_str,))
+async def _cb_watch_title(query, context, chat_id, slug):
+    add_user_watched(chat_id, slug)
+    # просто остаёмся на серии, НИЧЕГО не показываем по рангам здесь
+    await show_episode(chat_id, context, slug, _current_episode(chat_id, slug))
 
-    if data.startswith("fav_add:"):
-        slug = data.split(":", 1)[1]
-        USER_FAVORITES.setdefault(chat_id, set()).add(slug)
-        save_users()
-        ep = USER_PROGRESS.get(chat_id, {}).get(slug)
-        if ep is None:
-            anime = ANIME.get(slug)
-            if anime and anime.get("episodes"):
-                ep = sorted(anime["episodes"].keys())[0]
-            else:
-                ep = 1
-        await show_episode(chat_id, context, slug, ep)
-        return
-
-    if data.startswith("fav_remove:"):
-        slug = data.split(":", 1)[1]
-        USER_FAVORITES.setdefault(chat_id, set()).discard(slug)
-        save_users()
-        ep = USER_PROGRESS.get(chat_id, {}).get(slug)
-        if ep is None:
-            anime = ANIME.get(slug)
-            if anime and anime.get("episodes"):
-                ep = sorted(anime["episodes"].keys())[0]
-            else:
-                ep = 1
-        await show_episode(chat_id, context, slug, ep)
-        return
 
-    if data.startswith("watch_title:"):
-        slug = data.split(":", 1)[1]
-        USER_WATCHED_TITLES.setdefault(chat_id, set()).add(slug)
-        save_users()
+@callback_route("unwatch_title", args=(_arg_str,))
+async def _cb_unwatch_title(query, context, chat_id, slug):
+    remove_user_watched(chat_id, slug)
+    await show_episode(chat_id, context, slug, _current_episode(chat_id, slug))
 
-        # просто остаёмся на серии, НИЧЕГО не показываем по рангам здесь
-        ep = USER_PROGRESS.get(chat_id, {}).get(slug)
-        if ep is None:
-            anime = ANIME.get(slug)
-            if anime and anime.get("episodes"):
-                ep = sorted(anime["episodes"].keys())[0]
-            else:
-                ep = 1
-        await show_episode(chat_id, context, slug, ep)
-        return
-
-    if data.startswith("unwatch_title:"):
-        slug = data.split(":", 1)[1]
-        USER_WATCHED_TITLES.setdefault(chat_id, set()).discard(slug)
-        save_users()
-        ep = USER_PROGRESS.get(chat_id, {}).get(slug)
-        if ep is None:
-            anime = ANIME.get(slug)
-            if anime and anime.get("episodes"):
-                ep = sorted(anime["episodes"].keys())[0]
-            else:
-                ep = 1
-        await show_episode(chat_id, context, slug, ep)
-        return
 
-    if data.startswith("track:"):
-        # формат: track:slug:ep:track_name_escaped
-        _, slug, ep_str, safe_tname = data.split(":", 3)
-        ep = int(ep_str)
-        track_name = safe_tname.replace("__colon__", ":")
-        # при смене дорожки сразу обновляем CURRENT_TRACK и показываем серию
-        await show_episode(chat_id, context, slug, ep, track_name=track_name)
-        return
+# формат: track:slug:ep:track_name_escaped
+@callback_route("track", args=(_arg_str, int, _arg_track))
+async def _cb_track(query, context, chat_id, slug, ep, track_name):
+    # при смене дорожки сразу обновляем CURRENT_TRACK и показываем серию
+    await show_episode(chat_id, context, slug, ep, track_name=track_name)
 
 
 # ===============================
@@ -1623,18 +4378,14 @@ async def handle_user_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
 
     # Если это текст от пользователя, а не команда и мы не в режиме поиска — сразу удаляем
-    if not SEARCH_MODE.get(chat_id, False):
+    if not session(chat_id).search_mode:
         try:
             await update.message.delete()
         except Exception:
             pass
         return
 
-    q = text.lower()
-    matches: list[str] = []
-    for slug, anime in ANIME.items():
-        if q in anime["title"].lower():
-            matches.append(slug)
+    matches = search_titles(text)
 
     # Удаляем сообщение с текстом поиска
     try:
@@ -1649,7 +4400,7 @@ async def handle_user_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "😔 Ничего не нашёл по этому названию.\nПопробуй другое слово.\n(Я реагирую только на кнопки)",
             build_main_menu_keyboard(chat_id),
         )
-        SEARCH_MODE[chat_id] = False
+        session(chat_id).search_mode = False
         return
 
     # Если найден один — сразу открываем первую серию
@@ -1663,13 +4414,13 @@ async def handle_user_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "У этого тайтла ещё нет серий.",
                 build_main_menu_keyboard(chat_id),
             )
-            SEARCH_MODE[chat_id] = False
+            session(chat_id).search_mode = False
             return
         first_ep = sorted(anime["episodes"].keys())[0]
         # пользователь пришёл через поиск — выключаем random режим
-        RANDOM_MODE[chat_id] = False
+        session(chat_id).random_mode = False
         await show_episode(chat_id, context, found_slug, first_ep)
-        SEARCH_MODE[chat_id] = False
+        session(chat_id).search_mode = False
         return
 
     # Если совпадений несколько — показываем список клавиатурой
@@ -1680,7 +4431,52 @@ async def handle_user_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🔍 Нашёл несколько тайтлов по запросу «{text}»:\nВыбери нужный:",
         kb,
     )
-    SEARCH_MODE[chat_id] = False
+    session(chat_id).search_mode = False
+
+
+# ===============================
+# INLINE MODE: @bot <название>
+# ===============================
+def _inline_article(slug: str, bot_username: str) -> Optional[InlineQueryResultArticle]:
+    anime = ANIME.get(slug)
+    if not anime or not anime.get("episodes"):
+        return None
+    first_ep = min(anime["episodes"])
+    # deep link ведёт в /start <slug>_<ep> -> show_episode
+    url = f"https://t.me/{bot_username}?start={slug}_{first_ep}"
+    status_label = "Онгоинг" if anime.get("status", "ongoing") == "ongoing" else "Завершён"
+    return InlineQueryResultArticle(
+        id=slug,
+        title=anime["title"],
+        description=f"{status_label} · серий: {len(anime['episodes'])}",
+        input_message_content=InputTextMessageContent(f"🎬 {anime['title']}\n{url}"),
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("▶️ Смотреть", url=url)]]),
+    )
+
+
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    inline_query = update.inline_query
+    if not inline_query:
+        return
+
+    q = _normalize_search_text(inline_query.query)
+    results = INLINE_CACHE.get(q)
+    if results is None:
+        results = []
+        for slug in prefix_search(q):
+            article = _inline_article(slug, context.bot.username)
+            if article is not None:
+                results.append(article)
+        INLINE_CACHE[q] = results
+        if len(INLINE_CACHE) > INLINE_CACHE_SIZE:
+            INLINE_CACHE.popitem(last=False)
+    else:
+        INLINE_CACHE.move_to_end(q)
+
+    try:
+        await inline_query.answer(results, cache_time=INLINE_CACHE_TIME)
+    except Exception as e:
+        print("Failed to answer inline query:", e)
 
 
 # ===============================
@@ -1773,13 +4569,21 @@ async def cmd_dump_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text("⛔ Эта команда только для админов.")
         return
 
+    # для sqlite/шардов собираем anime.json в прежнем формате,
+    # для пользователей — сворачиваем журнал / выгружаем базу; ждём, пока всё ляжет на диск
+    CATALOG_STORE.export_json()
+    USER_STORE.export_json()
+    await wait_persist()
+
     if os.path.exists(ANIME_JSON_PATH):
         try:
             with open(ANIME_JSON_PATH, "rb") as f:
-                await msg.reply_document(
+                await context.bot.send_document(
+                    chat_id=chat_id,
                     document=f,
                     filename="anime.json",
                     caption="📁 Текущий anime.json",
+                    rate_limit_args=PRIORITY_BACKGROUND,
                 )
         except Exception as e:
             await msg.reply_text(f"❌ Не удалось отправить anime.json: {e}")
@@ -1789,10 +4593,12 @@ async def cmd_dump_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if os.path.exists(USERS_JSON_PATH):
         try:
             with open(USERS_JSON_PATH, "rb") as f:
-                await msg.reply_document(
+                await context.bot.send_document(
+                    chat_id=chat_id,
                     document=f,
                     filename="users.json",
                     caption="📁 Текущий users.json",
+                    rate_limit_args=PRIORITY_BACKGROUND,
                 )
         except Exception as e:
             await msg.reply_text(f"❌ Не удалось отправить users.json: {e}")
@@ -1800,6 +4606,114 @@ async def cmd_dump_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text("⚠️ Файл users.json ещё не создан.")
 
 
+# ===============================
+# /stats — метрики бота (только админы)
+# ===============================
+def build_stats_text() -> str:
+    lines = ["📊 Статистика"]
+
+    ls = LOOP_LAG_STATS
+    avg_lag = ls["total_ms"] / ls["samples"] if ls["samples"] else 0.0
+    lines.append(
+        "\n⏱ Event loop:\n"
+        f"задержка: ср. {avg_lag:.1f} мс, макс. {ls['max_ms']:.1f} мс\n"
+        f"подвисаний > {LOOP_STALL_MS:.0f} мс: {ls['stalls']} из {ls['samples']}"
+    )
+
+    ps = PERSIST_STATS
+    lines.append(
+        "\n🧵 Запись на диск (фоновый поток):\n"
+        f"в очереди: {ps['submitted'] - ps['done']}, выполнено: {ps['done']}, ошибок: {ps['failed']}\n"
+        f"занято: {ps['busy_ms']:.0f} мс, макс. задача {ps['max_ms']:.1f} мс"
+    )
+
+    lines.append(
+        f"\n📚 Хранилище каталога: {CATALOG_STORE.name}, тайтлов: {len(ANIME)}\n"
+        f"загружен при старте из {CATALOG_LOAD_STATS['source']} за {CATALOG_LOAD_STATS['ms']:.1f} мс"
+    )
+    lines.extend(CATALOG_STORE.stats_lines())
+
+    lines.append(
+        f"\n📨 Апдейты: обработано {UPDATE_STATS['processed']}, параллельно до {UPDATES_CONCURRENCY}, "
+        f"ждали очереди своего чата: {UPDATE_STATS['chat_waits']}"
+    )
+
+    lines.append("\n📤 Исходящие запросы к Bot API:")
+    lines.extend(OUTBOUND.stats_lines())
+
+    ms = MEDIA_STATS
+    lines.append(
+        f"\n🖼 Картинки (известных file_id: {len(MEDIA_REGISTRY)}):\n"
+        f"отправлено по file_id: {ms['reused']}, загружено файлов: {ms['uploads']} "
+        f"({ms['upload_bytes'] / 1024:.0f} КБ), устаревших file_id: {ms['stale']}"
+    )
+    if MEDIA_WARMUP_CHAT_ID:
+        ws = MEDIA_WARMUP_STATS
+        lines.append(
+            f"прогрев при старте: загружено {ws['uploaded']}, уже были {ws['skipped']}, "
+            f"ошибок {ws['failed']} за {ws['ms']:.0f} мс"
+        )
+
+    lines.append(
+        f"\n♻️ Повторные отрисовки пропущено: {RENDER_SKIP_STATS['skipped']}, "
+        f"сэкономлено вызовов API: {RENDER_SKIP_STATS['calls_saved']}"
+    )
+
+    if TRANSITION_STATS:
+        lines.append("\n🔀 Переходы экранов (вызовов API на экран):")
+        for name, st in sorted(TRANSITION_STATS.items()):
+            lines.append(f"{name}: {st['renders']}, {st['calls'] / st['renders']:.2f}")
+
+    rs = RENDER_STATS
+    lookups = rs["hits"] + rs["misses"]
+    hit_rate = rs["hits"] / lookups * 100 if lookups else 0.0
+    lines.append(
+        f"\n🧩 Кэш клавиатур (версия каталога {CATALOG_VERSION}):\n"
+        f"записей: {len(RENDER_CACHE)}, попаданий: {rs['hits']}, промахов: {rs['misses']} ({hit_rate:.0f}%)"
+    )
+
+    routes = sorted((r for r in CALLBACK_ROUTES.values() if r.calls or r.malformed), key=lambda r: -(r.calls + r.malformed))
+    if routes or CALLBACK_STATS["unknown"]:
+        lines.append(f"\n🔘 Кнопки (неизвестных: {CALLBACK_STATS['unknown']}):")
+        for r in routes[:10]:
+            avg_ms = r.total_ms / r.calls if r.calls else 0.0
+            line = f"{r.name}: {r.calls}, ср. {avg_ms:.1f} мс, макс. {r.max_ms:.1f} мс"
+            if r.malformed:
+                line += f", кривых: {r.malformed}"
+            lines.append(line)
+
+    n_sessions = len(SESSIONS)
+    mem = session_memory()
+    per_session = mem / n_sessions if n_sessions else 0.0
+    lines.append(
+        f"\n🗂 Сессии чатов: {n_sessions} (лимит {SESSION_MAX_COUNT}, TTL {SESSION_TTL / 3600:g} ч)\n"
+        f"память: {mem / 1024:.1f} КБ, ~{per_session:.0f} байт на сессию\n"
+        f"создано: {SESSION_STATS['created']}, вытеснено по TTL: {SESSION_STATS['evicted_ttl']}, "
+        f"по лимиту: {SESSION_STATS['evicted_lru']}\n"
+        f"восстановлено при старте: {SESSION_STATS['restored']}, "
+        f"снапшотов: {SESSION_SNAPSHOT_STATS['snapshots']} "
+        f"(посл. {SESSION_SNAPSHOT_STATS['rows']} изменений, {SESSION_SNAPSHOT_STATS['last_ms']:.1f} мс)"
+    )
+
+    lines.append(f"\n👥 Хранилище пользователей: {USER_STORE.name}")
+    lines.extend(USER_STORE.stats_lines())
+
+    return "\n".join(lines)
+
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not msg:
+        return
+
+    chat_id = update.effective_chat.id
+    if chat_id not in (ADMIN_ID, ADMIN2_ID):
+        await msg.reply_text("⛔ Эта команда только для админов.")
+        return
+
+    await msg.reply_text(build_stats_text())
+
+
 # ===============================
 # /clear_slug — удалить весь тайтл
 # ===============================
@@ -1825,34 +4739,12 @@ async def cmd_clear_slug(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Удаляем из ANIME
     del ANIME[slug]
+    reindex_title(slug)
 
-    # Чистим у всех пользователей
-    # progress
-    for uid in list(USER_PROGRESS.keys()):
-        if slug in USER_PROGRESS[uid]:
-            del USER_PROGRESS[uid][slug]
-            if not USER_PROGRESS[uid]:
-                del USER_PROGRESS[uid]
-
-    # favorites
-    for uid in list(USER_FAVORITES.keys()):
-        if slug in USER_FAVORITES[uid]:
-            USER_FAVORITES[uid].discard(slug)
-
-    # watched_titles
-    for uid in list(USER_WATCHED_TITLES.keys()):
-        if slug in USER_WATCHED_TITLES[uid]:
-            USER_WATCHED_TITLES[uid].discard(slug)
-
-    # current_track
-    for uid in list(CURRENT_TRACK.keys()):
-        if slug in CURRENT_TRACK[uid]:
-            del CURRENT_TRACK[uid][slug]
-            if not CURRENT_TRACK[uid]:
-                del CURRENT_TRACK[uid]
+    # Чистим у всех пользователей (progress, favorites, watched_titles, current_track)
+    purge_slug_from_users(slug)
 
-    save_anime()
-    save_users()
+    CATALOG_STORE.delete_title(slug)
 
     await msg.reply_text(f"✅ Тайтл '{slug}' и все связанные данные удалены.")
 
@@ -1900,37 +4792,20 @@ async def cmd_clear_ep(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Если серий не осталось — удаляем тайтл полностью
     if not episodes:
         del ANIME[slug]
+        reindex_title(slug)
 
         # Чистим все пользовательские данные по этому slug
-        for uid in list(USER_PROGRESS.keys()):
-            if slug in USER_PROGRESS[uid]:
-                del USER_PROGRESS[uid][slug]
-                if not USER_PROGRESS[uid]:
-                    del USER_PROGRESS[uid]
-
-        for uid in list(USER_FAVORITES.keys()):
-            if slug in USER_FAVORITES[uid]:
-                USER_FAVORITES[uid].discard(slug)
-
-        for uid in list(USER_WATCHED_TITLES.keys()):
-            if slug in USER_WATCHED_TITLES[uid]:
-                USER_WATCHED_TITLES[uid].discard(slug)
-
-        for uid in list(CURRENT_TRACK.keys()):
-            if slug in CURRENT_TRACK[uid]:
-                del CURRENT_TRACK[uid][slug]
-                if not CURRENT_TRACK[uid]:
-                    del CURRENT_TRACK[uid]
+        purge_slug_from_users(slug)
 
-        save_anime()
-        save_users()
+        CATALOG_STORE.delete_title(slug)
 
         await msg.reply_text(f"✅ Серия {ep} удалена. У тайтла не осталось серий, тайтл '{slug}' полностью удалён.")
         return
 
     # если тайтл остался — просто сохраняем
     ANIME[slug]["episodes"] = episodes
-    save_anime()
+    reindex_title(slug)
+    CATALOG_STORE.delete_episode(slug, ep)
 
     await msg.reply_text(f"✅ У тайтла '{slug}' удалена серия {ep}.")
 
@@ -1941,27 +4816,27 @@ async def send_start_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
     chat_id = update.effective_chat.id
 
     # ✅ удаляем предыдущее сообщение бота
-    last_id = LAST_MESSAGE.get(chat_id)
+    sess = session(chat_id)
+    last_id = sess.message_id
     if last_id:
         try:
             await context.bot.delete_message(chat_id=chat_id, message_id=last_id)
         except Exception:
             pass
 
-    LAST_MESSAGE.pop(chat_id, None)
-    LAST_MESSAGE_TYPE.pop(chat_id, None)
+    sess.message_id = None
+    sess.message_type = None
+    sess.render = None
+    mark_session_dirty(chat_id)
 
     # ✅ СНАЧАЛА обрабатываем deeplink
     if context.args:
         payload = context.args[0]   # например: sandad_1
 
         if "_" in payload:
-            slug, ep_str = payload.split("_", 1)
-
-            try:
-                ep = int(ep_str)
-            except ValueError:
-                ep = None
+            # в slug тоже бывает "_" — номер серии после последнего
+            slug, ep_str = payload.rsplit("_", 1)
+            ep = int(ep_str) if ep_str.isdecimal() else None
 
             if ep and slug in ANIME and ep in ANIME[slug]["episodes"]:
                 # ✅ открываем серию
@@ -1998,22 +4873,80 @@ async def debug_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ===============================
 # BOOT
 # ===============================
-def main():
-    load_anime()
-    load_users()
+async def on_startup(app) -> None:
+    # post_init отрабатывает до начала polling'а — картинки будут готовы к первому апдейту
+    await warm_up_media(app.bot)
+    start_users_flusher()
+    start_loop_monitor()
+    start_session_sweeper()
+
+
+async def on_shutdown(app) -> None:
+    await stop_users_flusher()
+    await stop_loop_monitor()
+    await stop_session_sweeper()
+    save_sessions()
+    USER_STORE.close()
+    CATALOG_STORE.close()
+    # последняя версия каталога должна попасть в снапшот
+    flush_anime_snapshot()
+    # дожидаемся, пока фоновый поток допишет всё поставленное в очередь
+    shutdown_persist()
+
+
+def load_state() -> None:
+    global USER_STORE, CATALOG_STORE
+    CATALOG_STORE = create_catalog_store()
+    started = time.perf_counter()
+    CATALOG_STORE.load()
+    CATALOG_LOAD_STATS["ms"] = (time.perf_counter() - started) * 1000
+    if not CATALOG_LOAD_STATS["source"]:
+        CATALOG_LOAD_STATS["source"] = CATALOG_STORE.name
+    USER_STORE = create_user_store()
+    USER_STORE.load()
+    load_media_registry()
+    load_sessions()
+
+
+def webhook_settings() -> dict:
+    """Аргументы для run_webhook / updater.start_webhook."""
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_URL")
+    path = WEBHOOK_PATH.strip("/")
+    return {
+        "listen": WEBHOOK_LISTEN,
+        "port": WEBHOOK_PORT,
+        "url_path": path,
+        "webhook_url": f"{WEBHOOK_URL.rstrip('/')}/{path}",
+        "secret_token": WEBHOOK_SECRET or secrets.token_urlsafe(32),
+        "max_connections": WEBHOOK_MAX_CONNECTIONS,
+    }
 
+
+def build_application():
     if not BOT_TOKEN:
         raise RuntimeError("Не задан BOT_TOKEN в переменных окружения")
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .rate_limiter(OUTBOUND)
+        .concurrent_updates(ChatSerialUpdateProcessor(UPDATES_CONCURRENCY))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", send_start_message))
     app.add_handler(CommandHandler("fix", cmd_fix))
     app.add_handler(CommandHandler("dump_all", cmd_dump_all))
     app.add_handler(CommandHandler("clear_slug", cmd_clear_slug))
     app.add_handler(CommandHandler("clear_ep", cmd_clear_ep))
+    app.add_handler(CommandHandler("stats", cmd_stats))
 
     app.add_handler(CallbackQueryHandler(handle_callback))
+    app.add_handler(InlineQueryHandler(handle_inline_query))
 
     # Поиск — только текст, не команды, не из SOURCE_CHAT_ID
     app.add_handler(
@@ -2042,11 +4975,26 @@ def main():
         )
     )
 
-    print("BOT STARTED...")
-    app.run_polling()
+    return app
+
+
+def main():
+    load_state()
+    app = build_application()
+
+    if BOT_MODE == "webhook":
+        settings = webhook_settings()
+        print(f"BOT STARTED (webhook {settings['listen']}:{settings['port']}/{settings['url_path']})...")
+        app.run_webhook(**settings)
+    else:
+        print("BOT STARTED...")
+        app.run_polling()
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate_users":
+        migrate_users_to_sqlite(*sys.argv[2:3])
+    else:
+        main()
 
 
@@ -0,0 +1,93 @@
+import asyncio
+import contextlib
+import io
+
+import pytest
+
+import bot
+
+
+def _entry(title, *eps):
+    return bot._normalize_anime_entry({
+        "title": title,
+        "genres": ["драма"],
+        "episodes": {str(ep): {"tracks": {"aniliberty": {"source": f"F{ep}"}}} for ep in eps},
+    })
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "ANIME_JSON_PATH", str(tmp_path / "anime.json"))
+    monkeypatch.setattr(bot, "ANIME_SNAPSHOT_PATH", str(tmp_path / "anime.snapshot"))
+    monkeypatch.setattr(bot, "ANIME_SNAPSHOT_DELAY", 3600)
+    # задачи persist-потока копим и выполняем вручную
+    queued = []
+    monkeypatch.setattr(bot, "submit_persist", lambda fn, *args: queued.append((fn, args)))
+    bot.ANIME = {"a": _entry("Альфа", 1)}
+    bot.rebuild_catalog_indexes()
+    yield queued
+    bot.flush_anime_snapshot()
+
+
+def _run_queued(queued):
+    while queued:
+        fn, args = queued.pop(0)
+        fn(*args)
+
+
+def _indexes():
+    return {
+        "genres": bot.GENRE_INDEX,
+        "order": bot.TITLE_ORDER,
+        "search": bot._SEARCH_TITLES,
+        "trigrams": bot.TRIGRAM_INDEX,
+        "trie": bot.TITLE_TRIE,
+    }
+
+
+def test_saves_coalesce_into_one_snapshot_of_latest_catalog(catalog):
+    written = bot.ANIME_SNAPSHOT_STATS["written"]
+
+    async def edit_catalog():
+        for slug, title in (("b", "Бета"), ("c", "Гамма"), ("d", "Дельта")):
+            bot.ANIME[slug] = _entry(title, 1, 2)
+            bot.reindex_title(slug)
+            bot.save_anime()
+        # три записи anime.json, снапшот ждёт таймера
+        assert [fn for fn, _ in catalog] == [bot._write_anime_snapshot] * 3
+        bot.flush_anime_snapshot()
+
+    asyncio.run(edit_catalog())
+    _run_queued(catalog)
+    assert bot.ANIME_SNAPSHOT_STATS["written"] == written + 1
+
+    expected_anime = bot.ANIME
+    expected_indexes = _indexes()
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot.load_anime()
+    assert bot.CATALOG_LOAD_STATS["source"] == bot.ANIME_SNAPSHOT_PATH
+    assert bot.ANIME == expected_anime
+    assert _indexes() == expected_indexes
+    # снапшот с диска годен — заново не писали
+    assert bot.ANIME_SNAPSHOT_STATS["written"] == written + 1
+
+
+def test_snapshot_waits_for_save_after_reindex(catalog):
+    async def edit_catalog():
+        bot.ANIME["b"] = _entry("Бета", 1)
+        bot.reindex_title("b")
+        bot.save_anime()
+        # индекс ушёл вперёд, а save_anime ещё не было — снапшот не снимаем
+        bot.ANIME["c"] = _entry("Гамма", 1)
+        bot.reindex_title("c")
+        bot.flush_anime_snapshot()
+        assert [fn for fn, _ in catalog] == [bot._write_anime_snapshot]
+        bot.save_anime()
+        bot.flush_anime_snapshot()
+
+    asyncio.run(edit_catalog())
+    _run_queued(catalog)
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot.load_anime()
+    assert bot.CATALOG_LOAD_STATS["source"] == bot.ANIME_SNAPSHOT_PATH
+    assert sorted(bot.ANIME) == ["a", "b", "c"]
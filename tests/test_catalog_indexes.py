@@ -0,0 +1,35 @@
+import random
+
+import bot
+
+
+def _indexes():
+    return {
+        "genres": bot.GENRE_INDEX,
+        "genre_keys": bot._GENRE_KEYS,
+        "order": bot.TITLE_ORDER,
+        "keys": bot._TITLE_KEYS,
+        "rank": bot.TITLE_RANK,
+        "titles": bot._INDEXED_TITLES,
+    }
+
+
+def test_reindex_title_matches_full_rebuild():
+    rnd = random.Random(3)
+    genres = ["драма", "экшен", "комедия", "фэнтези"]
+    bot.ANIME = {}
+    bot.rebuild_catalog_indexes()
+    for _ in range(300):
+        slug = f"t{rnd.randrange(40)}"
+        if slug in bot.ANIME and rnd.random() < 0.3:
+            del bot.ANIME[slug]
+        else:
+            bot.ANIME[slug] = {
+                "title": rnd.choice(["Бета", "альфа", "Гамма", "дельта"]) + str(rnd.randrange(5)),
+                "genres": rnd.sample(genres, rnd.randint(0, 3)),
+            }
+        bot.reindex_title(slug)
+
+    incremental = {k: (dict(v) if isinstance(v, dict) else list(v)) for k, v in _indexes().items()}
+    bot.rebuild_catalog_indexes()
+    assert incremental == _indexes()
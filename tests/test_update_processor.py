@@ -0,0 +1,40 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update
+
+import bot
+
+
+def _update(update_id, chat_id):
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    return Update(update_id, message=Message(update_id, datetime.now(), chat))
+
+
+def test_slow_chat_does_not_block_other_chats():
+    async def scenario():
+        processor = bot.ChatSerialUpdateProcessor(2)
+        release = asyncio.Event()
+        done = []
+
+        async def handle(name, slow=False):
+            if slow:
+                await release.wait()
+            done.append(name)
+
+        # первый апдейт медленного чата висит, ещё три ждут очереди этого же чата
+        tasks = [asyncio.create_task(processor.process_update(_update(1, 100), handle("slow1", slow=True)))]
+        for i in range(2, 5):
+            tasks.append(asyncio.create_task(processor.process_update(_update(i, 100), handle(f"slow{i}"))))
+        await asyncio.sleep(0)
+        other = asyncio.create_task(processor.process_update(_update(5, 200), handle("other")))
+
+        await asyncio.wait_for(other, timeout=1)
+        assert done == ["other"]
+
+        release.set()
+        await asyncio.gather(*tasks)
+        # апдейты одного чата — по порядку
+        assert done == ["other", "slow1", "slow2", "slow3", "slow4"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def journal_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, "USERS_JOURNAL_ENABLED", True)
+    monkeypatch.setattr(bot, "_USERS_JOURNAL_FILE", None)
+    yield tmp_path
+    bot._close_users_journal_file()
+
+
+def _line(seq, op, user_id, slug, value=None):
+    return json.dumps([seq, op, user_id, slug, value])
+
+
+def _reboot():
+    bot._close_users_journal_file()
+    bot.load_users()
+
+
+def test_torn_tail_is_truncated_and_later_appends_survive(journal_dir):
+    with open(bot.USERS_JOURNAL_PATH, "w", encoding="utf-8") as f:
+        f.write(_line(1, "fav_add", 1, "a") + "\n" + '[2, "fav_ad')
+
+    _reboot()
+    assert bot.USER_FAVORITES == {1: {"a"}}
+
+    bot._journal_write(_line(2, "fav_add", 1, "c"))
+    bot._journal_write(_line(3, "fav_add", 1, "d"))
+
+    _reboot()
+    assert bot.USER_FAVORITES == {1: {"a", "c", "d"}}
+
+
+def test_last_record_without_newline_is_kept(journal_dir):
+    with open(bot.USERS_JOURNAL_PATH, "w", encoding="utf-8") as f:
+        f.write(_line(1, "fav_add", 1, "a") + "\n" + _line(2, "fav_add", 1, "b"))
+
+    _reboot()
+    assert bot.USER_FAVORITES == {1: {"a", "b"}}
+
+    bot._journal_write(_line(3, "fav_add", 1, "c"))
+
+    _reboot()
+    assert bot.USER_FAVORITES == {1: {"a", "b", "c"}}
@@ -0,0 +1,57 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # задачи persist-потока копим и выполняем вручную — так видно порядок
+    queued = []
+    monkeypatch.setattr(bot, "submit_persist", lambda fn, *args: queued.append((fn, args)))
+    store = bot.SqliteUserStore(str(tmp_path / "users.db"), cache_size=1)
+    store.load()
+    store.queued = queued
+    yield store
+    store.reader.close()
+    store.conn.close()
+
+
+def _run_queued(store):
+    while store.queued:
+        fn, args = store.queued.pop(0)
+        fn(*args)
+
+
+def _evict(store, user_id):
+    # cache_size=1: загрузка другого пользователя вытесняет этого
+    store.ensure_user(user_id + 1000)
+    assert user_id not in store.hot
+
+
+def test_purge_then_lazy_load_does_not_resurrect_slug(store):
+    store.ensure_user(1)
+    for op in ("fav_add", "watched_add"):
+        bot._apply_user_op(op, 1, "gone")
+        store.record(op, 1, "gone")
+    bot._apply_user_op("progress", 1, "gone", 3)
+    store.record("progress", 1, "gone", 3)
+    bot._apply_user_op("fav_add", 1, "kept")
+    store.record("fav_add", 1, "kept")
+    _run_queued(store)
+    _evict(store, 1)
+
+    # тайтл удалён, но DELETE ещё стоит в очереди persist-потока
+    bot._apply_user_op("purge", None, "gone")
+    store.record("purge", None, "gone")
+
+    store.ensure_user(1)
+    assert bot.USER_FAVORITES.get(1) == {"kept"}
+    assert 1 not in bot.USER_PROGRESS
+    assert 1 not in bot.USER_WATCHED_TITLES
+
+    _run_queued(store)
+    _evict(store, 1)
+    store.ensure_user(1)
+    assert bot.USER_FAVORITES.get(1) == {"kept"}
+    assert 1 not in bot.USER_PROGRESS
+    assert store.pending_purges == []